@@ -0,0 +1,300 @@
+"""Cold storage for old messages: immutable, compressed archive segments.
+
+A segment holds messages sorted by (conversation, id), cut into blocks of
+BLOCK_RECORDS that are zlib-compressed one by one. A sparse index with
+the first (conversation, id) of every block sits in the footer, so a
+history page needs one binary search and usually one or two block reads.
+The footer also holds a Bloom filter of the segment's conversations:
+readers skip segments that cannot contain the conversation without
+decompressing anything. Segments are written to a temporary file and
+renamed into place, and never modified afterwards; runs of small segments
+are merged into a new one that names the segments it replaces.
+
+    segment = MAGIC | block | block | ... | index | footer
+    footer  = index offset (u64) | index length (u32) | MAGIC
+"""
+import base64
+import bisect
+import glob
+import hashlib
+import heapq
+import json
+import os
+import struct
+import threading
+import zlib
+
+MAGIC = b'CHATSEG1'
+FOOTER = struct.Struct('>QI8s')
+BLOCK_RECORDS = 128
+SEGMENT_RECORDS = 50000
+FILTER_BITS_PER_KEY = 10  # ~1% ложных срабатываний при FILTER_HASHES = 7
+FILTER_HASHES = 7
+
+# Запись в сегменте: [id, sender_id, receiver_id, content, file_path, sent_at, thumbnail_path, file_meta]
+ID, SENDER, RECEIVER, FILE_PATH, THUMBNAIL_PATH = 0, 1, 2, 4, 6
+
+
+def conversation_key(record):
+    low, high = sorted((record[SENDER], record[RECEIVER]))
+    return low, high
+
+
+def filter_positions(key, bits, hashes):
+    digest = hashlib.blake2b(f'{key[0]}:{key[1]}'.encode(), digest_size=16).digest()
+    first, step = struct.unpack('>QQ', digest)
+    return [(first + i * step) % bits for i in range(hashes)]
+
+
+def build_filter(keys):
+    """Bloom filter of conversation keys, as stored in the segment footer"""
+    bits = max(64, len(keys) * FILTER_BITS_PER_KEY)
+    data = bytearray((bits + 7) // 8)
+    for key in keys:
+        for position in filter_positions(key, bits, FILTER_HASHES):
+            data[position >> 3] |= 1 << (position & 7)
+    return {'bits': bits, 'hashes': FILTER_HASHES, 'data': base64.b64encode(bytes(data)).decode()}
+
+
+def write_segment(path, records, replaces=()):
+    """Write records into a new segment at path; returns the number of bytes written.
+
+    replaces names the segment files (basenames) whose records this one
+    carries, so they are dropped if the process stops before deleting them.
+    """
+    records = sorted(records, key=lambda r: conversation_key(r) + (r[ID],))
+    index = []
+    thumbnails = {}
+    files = {}
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC)
+        for start in range(0, len(records), BLOCK_RECORDS):
+            block = records[start:start + BLOCK_RECORDS]
+            data = zlib.compress(json.dumps(block, ensure_ascii=False).encode(), 6)
+            index.append(list(conversation_key(block[0])) + [block[0][ID], f.tell(), len(data)])
+            f.write(data)
+        for record in records:
+            if record[THUMBNAIL_PATH]:
+                # Превью старых вложений тоже должны находиться без чтения блоков
+                thumbnails[record[THUMBNAIL_PATH]] = [record[FILE_PATH], record[SENDER], record[RECEIVER]]
+            if record[FILE_PATH]:
+                participants = files.setdefault(record[FILE_PATH], [])
+                participants.extend(u for u in (record[SENDER], record[RECEIVER]) if u not in participants)
+        meta = zlib.compress(json.dumps({
+            'count': len(records),
+            'min_id': min(r[ID] for r in records),
+            'max_id': max(r[ID] for r in records),
+            'index': index,
+            'thumbnails': thumbnails,
+            'files': files,
+            'filter': build_filter({conversation_key(r) for r in records}),
+            'replaces': list(replaces),
+        }, ensure_ascii=False).encode())
+        offset = f.tell()
+        f.write(meta)
+        f.write(FOOTER.pack(offset, len(meta), MAGIC))
+        size = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return size
+
+
+class Segment:
+    """Read side of one segment file; only the index is kept in memory"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not an archive segment')
+            f.seek(-FOOTER.size, os.SEEK_END)
+            offset, length, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} has no footer (incomplete write?)')
+            f.seek(offset)
+            meta = json.loads(zlib.decompress(f.read(length)))
+        self.count = meta['count']
+        self.min_id = meta['min_id']
+        self.max_id = meta['max_id']
+        self.blocks = [(entry[3], entry[4]) for entry in meta['index']]  # (offset, length)
+        self.keys = [tuple(entry[:3]) for entry in meta['index']]  # (low, high, first id)
+        self.thumbnails = meta['thumbnails']
+        self.files = meta.get('files')  # {file_path: [user ids]}; в старых сегментах нет
+        self.replaces = meta.get('replaces', [])
+        bloom = meta.get('filter')  # в старых сегментах нет: такой сегмент читается всегда
+        self.filter = (bloom['bits'], bloom['hashes'], base64.b64decode(bloom['data'])) if bloom else None
+
+    def may_contain(self, key):
+        """False only if conversation key has no records in this segment"""
+        if self.filter is None:
+            return True
+        bits, hashes, data = self.filter
+        return all(data[p >> 3] & (1 << (p & 7)) for p in filter_positions(key, bits, hashes))
+
+    def records(self):
+        for number in range(len(self.blocks)):
+            yield from self.read_block(number)
+
+    def read_block(self, number):
+        offset, length = self.blocks[number]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def attachment(self, file_path):
+        """Ids of the users a file was exchanged between in this segment, or None"""
+        if self.files is None:
+            # Сегмент записан до появления карты файлов: строим её один раз по блокам
+            files = {}
+            for record in self.records():
+                if record[FILE_PATH]:
+                    participants = files.setdefault(record[FILE_PATH], [])
+                    participants.extend(u for u in (record[SENDER], record[RECEIVER]) if u not in participants)
+            self.files = files
+        return self.files.get(file_path)
+
+    def history(self, key, before, limit):
+        """Newest records of conversation key with id < before, newest first"""
+        found = []
+        # Последний блок, который начинается раньше (key, before), и дальше назад
+        number = bisect.bisect_left(self.keys, key + (before,)) - 1
+        while number >= 0 and (limit is None or len(found) < limit):
+            for record in reversed(self.read_block(number)):
+                if conversation_key(record) == key and record[ID] < before:
+                    found.append(record)
+                    if limit is not None and len(found) >= limit:
+                        break
+            if self.keys[number][:2] < key:
+                break  # блок начался с более раннего диалога - раньше key не встречается
+            number -= 1
+        return found
+
+    def iter_records(self, key):
+        """All records of conversation key, oldest first, one block in memory at a time"""
+        # Первые записи диалога могут лежать в конце блока, начавшегося с предыдущего диалога
+        number = max(0, bisect.bisect_left(self.keys, key + (0,)) - 1)
+        while number < len(self.keys) and self.keys[number][:2] <= key:
+            for record in self.read_block(number):
+                if conversation_key(record) == key:
+                    yield record
+            number += 1
+
+
+class Archive:
+    """All segments of one archive directory, in the order they were written"""
+
+    def __init__(self, directory='archive'):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.merge_lock = threading.Lock()
+        self.retired = []  # пути слитых сегментов: удаляются при следующем слиянии
+        for leftover in glob.glob(os.path.join(directory, '*.seg.tmp')):
+            os.remove(leftover)  # недописанный сегмент: строки остались в горячей базе
+        paths = sorted(glob.glob(os.path.join(directory, 'segment-*.seg')))
+        self.sequence = int(os.path.basename(paths[-1])[8:-4]) if paths else 0
+        segments = [Segment(path) for path in paths]
+        # Слияние прервали после записи нового сегмента: его части ещё лежат рядом
+        replaced = {name for segment in segments for name in segment.replaces}
+        for segment in segments:
+            if os.path.basename(segment.path) in replaced:
+                os.remove(segment.path)
+        self.segments = [s for s in segments if os.path.basename(s.path) not in replaced]
+
+    def next_path(self):
+        with self.lock:
+            self.sequence += 1
+            return os.path.join(self.directory, f'segment-{self.sequence:08d}.seg')
+
+    def write(self, records):
+        """Write records as a new segment and make it visible to readers"""
+        path = self.next_path()
+        write_segment(path, records)
+        segment = Segment(path)
+        with self.lock:
+            # Список заменяется целиком: читатели итерируют свою копию без блокировки
+            self.segments = self.segments + [segment]
+        return segment
+
+    def merge(self, target=SEGMENT_RECORDS):
+        """Rewrite each run of adjacent small segments as one; returns how many segments went away.
+
+        Every compaction run writes at least one segment per shard, however
+        few messages aged out, and each segment costs readers a filter check
+        and sometimes a block read. Merged segments stay on disk until the
+        next merge, so a history stream that started on them can finish.
+        """
+        with self.merge_lock:
+            for path in self.retired:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.retired = []
+            groups, run, total = [], [], 0
+            for segment in self.segments:
+                small = segment.count < target // 2
+                if small and total + segment.count <= target:
+                    run.append(segment)
+                    total += segment.count
+                    continue
+                groups.append(run)
+                run, total = ([segment], segment.count) if small else ([], 0)
+            groups.append(run)
+            removed = 0
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                path = self.next_path()
+                records = [record for segment in group for record in segment.records()]
+                write_segment(path, records, replaces=[os.path.basename(s.path) for s in group])
+                merged = Segment(path)
+                with self.lock:
+                    self.segments = [s for s in self.segments if s not in group] + [merged]
+                self.retired.extend(s.path for s in group)
+                removed += len(group) - 1
+            return removed
+
+    def history(self, user_a, user_b, before=None, limit=None):
+        """Newest archived records of a conversation with id < before, oldest first"""
+        key = tuple(sorted((user_a, user_b)))
+        before = before if before is not None else float('inf')
+        found = []
+        for segment in self.segments:
+            if segment.min_id < before and segment.may_contain(key):
+                found.extend(segment.history(key, before, limit))
+        found.sort(key=lambda r: r[ID])
+        return found[-limit:] if limit is not None else found
+
+    def iter_history(self, user_a, user_b):
+        """All archived records of a conversation, oldest first, without loading them all"""
+        key = tuple(sorted((user_a, user_b)))
+        return heapq.merge(*(segment.iter_records(key) for segment in self.segments if segment.may_contain(key)),
+                           key=lambda r: r[ID])
+
+    def has_attachment(self, user_id, file_path):
+        for segment in self.segments:
+            entry = segment.attachment(file_path)
+            if entry and user_id in entry:
+                return True
+        return False
+
+    def thumbnail_source(self, user_id, thumbnail_path):
+        for segment in self.segments:
+            entry = segment.thumbnails.get(thumbnail_path)
+            if entry and user_id in (entry[1], entry[2]):
+                return entry[0]
+        return None
+
+    def max_id(self):
+        return max((segment.max_id for segment in self.segments), default=0)
+
+    def stats(self):
+        segments = self.segments
+        return {
+            'segments': len(segments),
+            'messages': sum(s.count for s in segments),
+            'bytes': sum(os.path.getsize(s.path) for s in segments),
+        }
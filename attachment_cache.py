@@ -0,0 +1,133 @@
+"""Client-side cache of downloaded attachments.
+
+Files are stored once per content: the blob is named after its sha256,
+and index.json maps each server file path to the hash of its content.
+The index also records the size and last use of every blob. Once the
+blobs go over `max_bytes`, the least recently used ones are deleted.
+The blob just added is never evicted, so a file bigger than the whole
+budget still opens; it goes with the next put.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# Что пишет сам кэш: блобы <sha256><расширение>, их .tmp и index.json(.tmp)
+OWN_NAME = re.compile(r'([0-9a-f]{64}(\.[^.]*)?|index\.json)(\.tmp)?')
+
+
+class AttachmentCache:
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        self.files = {}  # {путь файла на сервере: sha256}
+        self.blobs = {}  # {sha256: {'name': имя файла в кэше, 'size': байт, 'used': time.time()}}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            self.files = index['files']
+            self.blobs = index['blobs']
+        except (OSError, ValueError, KeyError):
+            pass  # нет индекса или он испорчен: начинаем с пустого кэша
+        # Блобы, удалённые вручную, забываем; файлы без записи в индексе - недописанные
+        self.blobs = {sha: blob for sha, blob in self.blobs.items() if self._intact(blob)}
+        self.files = {path: sha for path, sha in self.files.items() if sha in self.blobs}
+        # Каталог может оказаться и чужим: удаляем только свои недописанные и забытые файлы
+        known = {blob['name'] for blob in self.blobs.values()} | {'index.json'}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name not in known and OWN_NAME.fullmatch(entry.name) \
+                        and entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+
+    def _intact(self, blob):
+        try:
+            return os.path.getsize(os.path.join(self.directory, blob['name'])) == blob['size']
+        except OSError:
+            return False
+
+    def get(self, file_path):
+        """Local path of a cached attachment, or None"""
+        with self.lock:
+            sha = self.files.get(file_path)
+            blob = self.blobs.get(sha)
+            if blob is None or not self._intact(blob):
+                if blob is not None:
+                    self._forget(sha)
+                    self._save()
+                self.misses += 1
+                return None
+            blob['used'] = time.time()
+            self.hits += 1
+            self._save()
+            return os.path.join(self.directory, blob['name'])
+
+    def put(self, file_path, data, sha256=None):
+        """Store downloaded bytes and return their local path.
+
+        Raises ValueError if data does not match the sha256 the server sent.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if sha256 is not None and digest != sha256:
+            raise ValueError(f'{file_path}: checksum mismatch')
+        with self.lock:
+            blob = self.blobs.get(digest)
+            if blob is None or not self._intact(blob):
+                # Расширение сохраняем, чтобы система знала, чем открыть файл
+                blob = {'name': digest + os.path.splitext(file_path)[1].lower(), 'size': len(data)}
+                path = os.path.join(self.directory, blob['name'])
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                self.blobs[digest] = blob
+            blob['used'] = time.time()
+            self.files[file_path] = digest
+            self._evict(keep=digest)
+            self._save()
+            return os.path.join(self.directory, blob['name'])
+
+    def _evict(self, keep):
+        total = sum(blob['size'] for blob in self.blobs.values())
+        for sha in sorted(self.blobs, key=lambda s: self.blobs[s]['used']):
+            if total <= self.max_bytes:
+                break
+            if sha == keep:
+                continue
+            total -= self.blobs[sha]['size']
+            self._forget(sha)
+            self.evicted += 1
+
+    def _forget(self, sha):
+        blob = self.blobs.pop(sha)
+        self.files = {path: s for path, s in self.files.items() if s != sha}
+        try:
+            os.remove(os.path.join(self.directory, blob['name']))
+        except OSError:
+            pass
+
+    def _save(self):
+        # Индекс пишется целиком и подменяется атомарно: после сбоя остаётся старый или новый
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files, 'blobs': self.blobs}, f)
+        os.replace(temporary, self.index_path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'blobs': len(self.blobs),
+                'bytes': sum(blob['size'] for blob in self.blobs.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+            }
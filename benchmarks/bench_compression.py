@@ -0,0 +1,103 @@
+"""Bytes on the wire and CPU cost of frame compression per payload type.
+
+    python -m benchmarks.bench_compression [--json results.json]
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+import compression
+
+PAYLOAD_TYPES = ('chat_message', 'contacts_list', 'history_small', 'history_large', 'file_text', 'file_binary')
+
+
+def build_payloads(seed=11):
+    rng = random.Random(seed)
+    # Отдельный seed: словарь обучаем не на тех же кадрах, что меряем
+    frames = compression.synthetic_frames(count=2000, seed=seed)
+    chat = next(f for f in frames if b'"action": "message"' in f)
+    contacts = json.dumps({'status': 'success', 'action': 'contacts',
+                           'contacts': [f'user{i}' for i in range(200)]}).encode()
+
+    def history(count):
+        words = ['hi', 'ok', 'later', 'привет', 'sure', 'meeting', 'lunch?', 'done', 'see attached']
+        messages = [{'sender': rng.choice(['alice', 'bob']),
+                     'content': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 15))),
+                     'file_path': None,
+                     'timestamp': f'2024-0{rng.randint(1, 9)}-{rng.randint(10, 28)} '
+                                  f'{rng.randint(10, 23)}:{rng.randint(10, 59)}:{rng.randint(10, 59)}'}
+                    for _ in range(count)]
+        return json.dumps({'status': 'success', 'action': 'history', 'messages': messages},
+                          ensure_ascii=False).encode()
+
+    def file_frame(data):
+        return json.dumps({'action': 'file', 'receiver': 'bob', 'file_name': 'attachment.bin',
+                           'file_data': base64.b64encode(data).decode()}).encode()
+
+    text = ('\n'.join(f'{i},sensor-{i % 17},{rng.random():.6f},ok' for i in range(20000))).encode()
+    return {
+        'chat_message': chat,
+        'contacts_list': contacts,
+        'history_small': history(30),
+        'history_large': history(20000),
+        'file_text': file_frame(text[:512 * 1024]),
+        'file_binary': file_frame(os.urandom(512 * 1024)),
+    }
+
+
+def measure(codec, payload, dictionary, repeat):
+    frame = codec.encode(payload) if codec else len(payload).to_bytes(4, 'big') + payload
+    compressed = int.from_bytes(frame[:4], 'big') & compression.COMPRESSED_FLAG
+    started = time.process_time()
+    for _ in range(repeat):
+        codec.encode(payload) if codec else None
+    encode_us = (time.process_time() - started) / repeat * 1e6
+    decode_us = 0.0
+    if compressed:
+        started = time.process_time()
+        for _ in range(repeat):
+            compression.decompress(frame[4:], dictionary)
+        decode_us = (time.process_time() - started) / repeat * 1e6
+    return {'wire_bytes': len(frame), 'compressed': bool(compressed),
+            'encode_us': encode_us, 'decode_us': decode_us}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--threshold', type=int, default=compression.DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    payloads = build_payloads()
+    dictionary = compression.train_dictionary(compression.synthetic_frames(count=2000, seed=3))
+    variants = [('none', None, None)]
+    for name in compression.available_codecs():
+        variants.append((name, compression.FrameCodec(name, args.threshold), None))
+        variants.append((f'{name}+dict', compression.FrameCodec(name, args.threshold, dictionary=dictionary),
+                         dictionary))
+
+    results = {'dictionary_bytes': len(dictionary), 'threshold': args.threshold, 'payloads': {}}
+    print(f"{'payload':<14} {'codec':<10} {'raw':>10} {'wire':>10} {'ratio':>7} {'enc µs':>10} {'dec µs':>10}")
+    for payload_name in PAYLOAD_TYPES:
+        payload = payloads[payload_name]
+        repeat = max(3, min(2000, 2_000_000 // max(len(payload), 1)))
+        rows = {}
+        for variant, codec, variant_dictionary in variants:
+            row = measure(codec, payload, variant_dictionary, repeat)
+            row['raw_bytes'] = len(payload)
+            rows[variant] = row
+            print(f"{payload_name:<14} {variant:<10} {len(payload):>10} {row['wire_bytes']:>10} "
+                  f"{row['wire_bytes'] / (len(payload) + 4):>7.3f} {row['encode_us']:>10.1f} {row['decode_us']:>10.1f}")
+        results['payloads'][payload_name] = rows
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'results written to {args.json}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
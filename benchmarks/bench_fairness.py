@@ -0,0 +1,192 @@
+"""Measure how chat latency holds up while other connections flood the server.
+
+Starts a server for each --workers value. Chat users exchange messages at a
+Poisson rate, first alone and then while bulk users pull full histories
+(and optionally send files) in a tight loop with several requests in flight.
+Bulk users run in their own process, so decoding their replies does not
+hold up the chat clients that measure latency.
+Prints message delivery latency for both phases, the bulk throughput and
+how many bulk requests were turned away with retry_after.
+
+    python -m benchmarks.bench_fairness [--chat-users 50] [--bulk-users 50] [--workers 0 16]
+"""
+import argparse
+import json
+import multiprocessing
+import queue
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import loadgen
+from loadgen import SERVER_SCRIPT, LoadClient, Stats, free_port, run_parallel, user_loop, wait_for_port
+
+
+def bulk_loop(client, contact, deadline, depth, file_payload, stats):
+    """Keep `depth` history (or file) requests in flight until the deadline"""
+    rng = random.Random(client.username)
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        expected = []
+        try:
+            for _ in range(depth):
+                if file_payload and rng.random() < 0.2:
+                    client.send({'action': 'file', 'receiver': contact, 'file_name': 'bulk.bin',
+                                 'file_data': file_payload})
+                    expected.append('file')
+                else:
+                    client.send({'action': 'contacts', 'contact_action': 'history',
+                                 'contact_username': contact, 'stream': True})
+                    expected.append('history_end')
+        except OSError as e:
+            stats.error('bulk', type(e).__name__)
+            return
+        while expected:
+            try:
+                response = client.responses.get(timeout=client.timeout)
+            except queue.Empty:
+                stats.error('bulk', 'timeout')
+                return
+            if response is None:
+                stats.error('bulk', 'disconnected')
+                return
+            # Файлы от соседа приходят с тем же action, что и ответ на свой
+            if response.get('action') not in expected or response.get('is_file'):
+                continue
+            expected.remove(response['action'])
+            if response.get('status') == 'error':
+                stats.error('bulk', response.get('message', 'error'))
+            else:
+                stats.record('bulk', (time.perf_counter() - started) * 1000)
+
+
+def bulk_users(port, args, ready, start, results):
+    """Child process: log in bulk users, seed their conversations, then flood when `start` is set"""
+    stats = Stats()
+    clients = [LoadClient('127.0.0.1', port, f'b{i}', stats, args.timeout) for i in range(args.bulk_users)]
+    try:
+        run_parallel(clients, LoadClient.register, 32)
+        run_parallel(clients, LoadClient.login, 32)
+        # Каждый bulk-пользователь читает длинную переписку с соседом
+        for i, client in enumerate(clients):
+            client.add_contact(clients[(i + 1) % len(clients)].username)
+
+        def seed(client):
+            for n in range(args.history):
+                client.send({'action': 'message', 'receiver': client.contacts[0], 'content': f'seed {n}'})
+            # Запросы соединения выполняются по порядку: ответ значит, что всё отправленное уже записано
+            client.list_contacts()
+        run_parallel(clients, seed, 16)
+        ready.put(stats.snapshot()[1])
+        start.wait()
+        stats.reset()
+        deadline = time.monotonic() + args.duration
+        payload = 'x' * args.file_size if args.file_size else ''
+        threads = [threading.Thread(target=bulk_loop, args=(c, c.contacts[0], deadline, args.depth, payload, stats),
+                                    daemon=True) for c in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies, errors = stats.snapshot()
+        results.put(loadgen.summarize(latencies, errors, args.duration))
+    finally:
+        for client in clients:
+            client.close()
+
+
+def phase(chat, stats, load, args):
+    stats.reset()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=user_loop, args=(c, load, deadline, ''), daemon=True) for c in chat]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(1.0)  # доставки в пути
+    latencies, errors = stats.snapshot()
+    return loadgen.summarize(latencies, errors, args.duration)
+
+
+def run_server(workers, args):
+    workdir = tempfile.mkdtemp(prefix='chat-bench-fairness-')
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                                '--workers', str(workers)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port('127.0.0.1', port, 30):
+        process.kill()
+        raise SystemExit('server did not start listening')
+    load = argparse.Namespace(**dict(loadgen.SCENARIOS['chat'], message_rate=args.message_rate, history_rate=0.0,
+                                     inbox_rate=0.0, message_size=64))
+    stats = Stats()
+    chat = []
+    context = multiprocessing.get_context('spawn')
+    ready, results, start = context.Queue(), context.Queue(), context.Event()
+    bulk = context.Process(target=bulk_users, args=(port, args, ready, start, results), daemon=True)
+    bulk.start()
+    try:
+        chat = [LoadClient('127.0.0.1', port, f'c{i}', stats, args.timeout) for i in range(args.chat_users)]
+        run_parallel(chat, LoadClient.register, 32)
+        run_parallel(chat, LoadClient.login, 32)
+        rng = random.Random(7)
+        names = [c.username for c in chat]
+        for client in chat:
+            for peer in rng.sample([n for n in names if n != client.username], min(load.contacts, len(names) - 1)):
+                client.add_contact(peer)
+        ready.get()
+        alone = phase(chat, stats, load, args)
+        start.set()
+        loaded = phase(chat, stats, load, args)
+        loaded.update(results.get())
+    finally:
+        for client in chat:
+            client.close()
+        bulk.join(10)
+        if bulk.is_alive():
+            bulk.kill()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return {'alone': alone, 'loaded': loaded}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chat-users', type=int, default=50)
+    parser.add_argument('--bulk-users', type=int, default=50)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 16],
+                        help='server --workers values to compare (0: no scheduler)')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per phase')
+    parser.add_argument('--message-rate', type=float, default=1.0, help='messages per chat user per second')
+    parser.add_argument('--history', type=int, default=500, help='messages in each bulk conversation')
+    parser.add_argument('--depth', type=int, default=4, help='bulk requests in flight per connection')
+    parser.add_argument('--file-size', type=int, default=0, help='also mix in files of this size')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    results = {str(workers): run_server(workers, args) for workers in args.workers}
+    print(f"{'workers':>7} {'phase':<7} {'msgs':>6} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'bulk ok':>8} {'bulk p50':>9} {'shed':>6}")
+    for workers, phases in results.items():
+        for name, actions in phases.items():
+            delivery = actions.get('message_delivery', {})
+            bulk = actions.get('bulk', {})
+            shed = bulk.get('error_reasons', {}).get('Server busy', 0)
+            print(f"{workers:>7} {name:<7} {delivery.get('count', 0):>6} {delivery.get('p50_ms') or 0:>8.2f} "
+                  f"{delivery.get('p99_ms') or 0:>8.2f} {bulk.get('count', 0):>8} {bulk.get('p50_ms') or 0:>9.1f} "
+                  f"{shed:>6}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Measure what an open profiling window costs a loaded server.
+
+Logs in N users with contacts and runs the same Poisson chat load in
+alternating phases: plain, then with a `profile` window covering the
+whole phase. Compares throughput and latency between the two and prints
+the overhead the profiler measured itself.
+
+    python -m benchmarks.bench_profiler [--users 200] [--duration 20] [--rounds 2]
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import loadgen
+import profiler
+from loadgen import SERVER_SCRIPT, LoadClient, Stats, free_port, run_parallel, summarize, user_loop, wait_for_port
+
+
+def steady(clients, stats, load, duration):
+    stats.reset()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=user_loop, args=(c, load, deadline, ''), daemon=True) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(1.0)  # доставки в пути
+    latencies, errors = stats.snapshot()
+    return summarize(latencies, errors, duration)
+
+
+def merge(phases):
+    """Sum counts and average latencies of the same kind of phase over rounds"""
+    merged = {}
+    for actions in phases:
+        for action, row in actions.items():
+            total = merged.setdefault(action, {'count': 0, 'errors': 0, 'p50_ms': [], 'p99_ms': []})
+            total['count'] += row['count']
+            total['errors'] += row['errors']
+            for key in ('p50_ms', 'p99_ms'):
+                if row[key] is not None:
+                    total[key].append(row[key])
+    for total in merged.values():
+        for key in ('p50_ms', 'p99_ms'):
+            total[key] = sum(total[key]) / len(total[key]) if total[key] else None
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per phase')
+    parser.add_argument('--rounds', type=int, default=2, help='plain/profiled phase pairs')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-profiler-')
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port('127.0.0.1', port, 30):
+        process.kill()
+        raise SystemExit('server did not start listening')
+    load = argparse.Namespace(**dict(loadgen.SCENARIOS['chat'], message_size=64))
+    stats = Stats()
+    clients = []
+    try:
+        clients = [LoadClient('127.0.0.1', port, f'p{i}', stats, args.timeout) for i in range(args.users)]
+        run_parallel(clients, LoadClient.register, 32)
+        run_parallel(clients, LoadClient.login, 32)
+        rng = random.Random(7)
+        names = [c.username for c in clients]
+        for client in clients:
+            for peer in rng.sample([n for n in names if n != client.username], min(load.contacts, len(names) - 1)):
+                client.add_contact(peer)
+
+        plain, profiled, summaries = [], [], []
+        for _ in range(args.rounds):
+            plain.append(steady(clients, stats, load, args.duration))
+            holder = {}
+            window = threading.Thread(target=lambda: holder.update(
+                profiler.request_profile('127.0.0.1', port, args.duration + 1)))
+            window.start()
+            profiled.append(steady(clients, stats, load, args.duration))
+            window.join()
+            summaries.append(holder)
+    finally:
+        for client in clients:
+            client.close()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    results = {'plain': merge(plain), 'profiled': merge(profiled),
+               'profiler': [{key: summary.get(key) for key in
+                             ('samples', 'interval_ms', 'sampler_overhead', 'cprofile_overhead', 'cprofile_stopped',
+                              'folded')} for summary in summaries]}
+    print(f"{'action':<18} {'plain ops':>10} {'prof ops':>9} {'plain p50':>10} {'prof p50':>9} "
+          f"{'plain p99':>10} {'prof p99':>9}")
+    for action, row in results['plain'].items():
+        other = results['profiled'].get(action, {})
+        print(f"{action:<18} {row['count']:>10} {other.get('count', 0):>9} {row['p50_ms'] or 0:>10.2f} "
+              f"{other.get('p50_ms') or 0:>9.2f} {row['p99_ms'] or 0:>10.2f} {other.get('p99_ms') or 0:>9.2f}")
+    for summary in results['profiler']:
+        print(f"profile: {summary['samples']} samples, interval {summary['interval_ms'] or 0:.0f} ms, "
+              f"sampler {summary['sampler_overhead'] or 0:.2%}, cProfile {summary['cprofile_overhead'] or 0:.2%}"
+              f"{' (stopped)' if summary['cprofile_stopped'] else ''}")
+    print(f'profiles in {os.path.join(workdir, "profiles")}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
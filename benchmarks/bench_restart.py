@@ -0,0 +1,147 @@
+"""Restart a loaded server with SIGHUP and watch what clients see.
+
+Logs in N users, sends SIGHUP to the server and lets every user follow
+the reconnect hint: wait the advised delay, connect, log in again. A
+prober opens a fresh connection every 50 ms during the
+restart and counts refusals. Runs once with reconnects spread out and
+once with --reconnect-spread 0 (everyone at once) for comparison.
+
+    python -m benchmarks.bench_restart [--users 200] [--spread 5]
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from loadgen import SERVER_SCRIPT, LoadClient, Stats, free_port, percentile, run_parallel, wait_for_port
+
+
+def probe(port, stop, counts):
+    while not stop.is_set():
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=5).close()
+            counts['ok'] += 1
+        except ConnectionRefusedError:
+            counts['refused'] += 1
+        except OSError:
+            counts['other'] += 1
+        time.sleep(0.05)  # реже: непринятые соединения занимают очередь listen()
+
+
+def successor_pid(workdir):
+    with open(os.path.join(workdir, 'server.log')) as f:
+        found = re.findall(r'successor pid (\d+)', f.read())
+    return int(found[-1]) if found else None
+
+
+def follow_hint(client, port, stats, timeout, logins):
+    """Wait for the reconnect notice, obey it and log in on a new connection"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            message = client.responses.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            stats.error('notice', 'timeout')
+            return
+        if message is None:
+            stats.error('notice', 'disconnected without notice')
+            return
+        if message.get('action') == 'reconnect':
+            break
+    client.close()
+    time.sleep(message['after'])
+    fresh = LoadClient('127.0.0.1', port, client.username, stats, timeout)
+    if fresh.login():
+        logins.append(time.monotonic())
+    fresh.close()
+
+
+def run(users, spread, timeout):
+    workdir = tempfile.mkdtemp(prefix='chat-bench-restart-')
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                                '--reconnect-spread', str(spread)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port('127.0.0.1', port, 30):
+        process.kill()
+        raise SystemExit('server did not start listening')
+    stats = Stats()
+    successor = None
+    try:
+        clients = [LoadClient('127.0.0.1', port, f'r{i}', stats, timeout) for i in range(users)]
+        run_parallel(clients, LoadClient.register, 32)
+        run_parallel(clients, LoadClient.login, 32)
+        stats.reset()
+
+        stop = threading.Event()
+        counts = {'ok': 0, 'refused': 0, 'other': 0}
+        prober = threading.Thread(target=probe, args=(port, stop, counts), daemon=True)
+        prober.start()
+        logins = []
+        threads = [threading.Thread(target=follow_hint, args=(c, port, stats, timeout, logins)) for c in clients]
+        for thread in threads:
+            thread.start()
+        started = time.monotonic()
+        process.send_signal(signal.SIGHUP)
+        for thread in threads:
+            thread.join()
+        process.wait(timeout)
+        stop.set()
+        prober.join()
+        successor = successor_pid(workdir)
+
+        snapshot = stats.snapshot()
+        latencies = sorted(snapshot[0].get('login', []))
+        buckets = {}
+        for moment in logins:
+            buckets[int(moment - started)] = buckets.get(int(moment - started), 0) + 1
+        return {
+            'spread_s': spread,
+            'users': users,
+            'relogged': len(logins),
+            'errors': snapshot[1],
+            'last_login_s': max(logins) - started if logins else None,
+            'peak_logins_per_s': max(buckets.values()) if buckets else 0,
+            'login_p50_ms': percentile(latencies, 0.5),
+            'login_p99_ms': percentile(latencies, 0.99),
+            'probes': counts,
+        }
+    finally:
+        for pid in (process.pid, successor):
+            if pid:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--spread', type=float, default=5, help='--reconnect-spread for the spread-out run')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    results = [run(args.users, args.spread, args.timeout), run(args.users, 0, args.timeout)]
+    print(f"{'spread s':>8} {'relogged':>9} {'refused':>8} {'peak/s':>7} {'login p50 ms':>13} "
+          f"{'login p99 ms':>13} {'done s':>7}")
+    for row in results:
+        print(f"{row['spread_s']:>8.1f} {row['relogged']:>9} {row['probes']['refused']:>8} "
+              f"{row['peak_logins_per_s']:>7} {row['login_p50_ms'] or 0:>13.1f} {row['login_p99_ms'] or 0:>13.1f} "
+              f"{row['last_login_s'] or 0:>7.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Compare the v1 and v2 message row formats on one large shard.
+
+Builds a shard in the old format (text timestamps, no conversation id,
+history through the (sender, receiver) index), measures it, migrates a
+copy in place with shards.migrate() and measures again: file size,
+bytes per message, single-message insert rate and history page latency.
+
+    python -m benchmarks.bench_row_format [--messages 1000000] [--users 2000]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import shards
+from loadgen import percentile
+
+# Схема первой версии, как её создавал shards.py до перехода на формат 2
+V1_SCHEMA = (
+    '''
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        content TEXT,
+        file_path TEXT,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        thumbnail_path TEXT,
+        file_meta TEXT
+    )
+    ''',
+    'CREATE INDEX idx_messages_pair ON messages (sender_id, receiver_id, id)',
+    '''
+    CREATE TABLE conversations (
+        user_id INTEGER NOT NULL,
+        peer_id INTEGER NOT NULL,
+        last_message_id INTEGER,
+        last_sender_id INTEGER,
+        last_preview TEXT,
+        last_activity TIMESTAMP,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        read_cursor INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, peer_id)
+    )
+    ''',
+)
+V1_HISTORY = '''
+    SELECT id, sender_id, content, file_path, sent_at, thumbnail_path, file_meta
+    FROM messages
+    WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)) AND id < ?
+    ORDER BY id DESC LIMIT ?
+'''
+V2_HISTORY = '''
+    SELECT id, sender_id, content, file_path, sent_at, thumbnail_path, file_meta
+    FROM messages
+    WHERE conversation_id = ? AND id < ?
+    ORDER BY id DESC LIMIT ?
+'''
+PAGE = 50
+
+
+def build_v1(path, messages, users, seed=11):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    for statement in V1_SCHEMA:
+        conn.execute(statement)
+    started = time.time() - 86400 * 90
+    rows = []
+    for i in range(1, messages + 1):
+        a, b = rng.sample(range(1, users + 1), 2)
+        moment = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(started + i * 86400 * 90 / messages))
+        rows.append((i, a, b, f'message {i} ' + 'x' * rng.randint(5, 60), moment))
+        if len(rows) == shards.IMPORT_BATCH:
+            conn.executemany('INSERT INTO messages (id, sender_id, receiver_id, content, sent_at) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO messages (id, sender_id, receiver_id, content, sent_at) '
+                     'VALUES (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    pairs = conn.execute('SELECT sender_id, receiver_id FROM messages GROUP BY sender_id, receiver_id').fetchall()
+    conn.close()
+    return pairs
+
+
+def measure(path, version, pairs, reads, inserts, seed=5):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    latencies = []
+    for a, b in rng.sample(pairs, min(reads, len(pairs))):
+        started = time.perf_counter()
+        if version == 1:
+            conn.execute(V1_HISTORY, (a, b, b, a, 2 ** 63 - 1, PAGE)).fetchall()
+        else:
+            conn.execute(V2_HISTORY, (shards.conversation_id(a, b), 2 ** 63 - 1, PAGE)).fetchall()
+        latencies.append((time.perf_counter() - started) * 1e6)
+    latencies.sort()
+    # Размер снимается до вставок; вставки по одной в своей транзакции, как на сервере
+    size = os.path.getsize(path)
+    count = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    next_id = conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] + 1
+    started = time.perf_counter()
+    for i in range(inserts):
+        a, b = rng.choice(pairs)
+        if version == 1:
+            conn.execute('INSERT INTO messages (id, sender_id, receiver_id, content) VALUES (?, ?, ?, ?)',
+                         (next_id + i, a, b, f'new {i}'))
+        else:
+            conn.execute('INSERT INTO messages (id, conversation_id, sender_id, receiver_id, sent_at, content) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (next_id + i, shards.conversation_id(a, b), a, b, shards.now_millis(), f'new {i}'))
+        conn.commit()
+    insert_seconds = time.perf_counter() - started
+    conn.close()
+    return {'bytes': size, 'bytes_per_message': size / count, 'inserts_per_s': inserts / insert_seconds,
+            'history_p50_us': percentile(latencies, 0.5), 'history_p99_us': percentile(latencies, 0.99)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--inserts', type=int, default=2000)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='chat-bench-rows-') as workdir:
+        v1_path = os.path.join(workdir, 'v1.db')
+        v2_path = os.path.join(workdir, 'v2.db')
+        pairs = build_v1(v1_path, args.messages, args.users)
+        shutil.copyfile(v1_path, v2_path)
+        conn = sqlite3.connect(v2_path)
+        started = time.perf_counter()
+        shards.migrate(conn)
+        for statement in shards.SCHEMA:  # индексы формата 2 создаёт Shard после миграции
+            conn.execute(statement)
+        conn.commit()
+        migration_seconds = time.perf_counter() - started
+        conn.close()
+        results = {
+            'messages': args.messages,
+            'migration_s': migration_seconds,
+            'v1': measure(v1_path, 1, pairs, args.reads, args.inserts),
+            'v2': measure(v2_path, 2, pairs, args.reads, args.inserts),
+        }
+
+    print(f"{args.messages} messages, migration {results['migration_s']:.1f}s")
+    print(f"{'format':<7} {'MB':>8} {'B/msg':>7} {'inserts/s':>10} {'hist p50 us':>12} {'hist p99 us':>12}")
+    for version in ('v1', 'v2'):
+        row = results[version]
+        print(f"{version:<7} {row['bytes'] / 2 ** 20:>8.1f} {row['bytes_per_message']:>7.1f} "
+              f"{row['inserts_per_s']:>10.0f} {row['history_p50_us']:>12.1f} {row['history_p99_us']:>12.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
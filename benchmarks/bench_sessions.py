@@ -0,0 +1,165 @@
+"""Measure per-connection memory of the server's session state.
+
+Two parts:
+
+- Python heap, measured with tracemalloc, of N sessions (100k by default)
+  built in this process. Compares the layout before Session, with one dict
+  entry per field keyed by socket and a 16 KiB reader per connection,
+  against Session objects in a SessionRegistry. Sockets are small stubs
+  created before measuring, so only the server's own bookkeeping counts.
+- Resident memory of a real server process before and after K idle
+  connections (hello only, no login), divided by K. This includes the
+  thread each connection gets and the kernel socket buffers the process
+  touches.
+
+    python -m benchmarks.bench_sessions [--sessions 100000] [--connections 2000]
+"""
+import argparse
+import gc
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import compression
+from loadgen import SERVER_SCRIPT, free_port, wait_for_port
+from protocol import RECV_BUFFER, FrameReader, encode_frame
+from session import Session, SessionRegistry
+
+
+class StubSocket:
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class LegacyReader:
+    """FrameReader fields as they were before sessions: no slots, full buffer, own decoder"""
+
+    def __init__(self):
+        self.capacity = RECV_BUFFER
+        self.buffer = bytearray(RECV_BUFFER)
+        self.start = 0
+        self.end = 0
+        self.skip = 0
+        self.checked = False
+        self.reserved = 0
+        self.frame_size = 0
+        self.decoder = json.JSONDecoder()
+        self.dictionary = None
+        self.limits = None
+        self.budget = None
+
+
+def legacy(sockets, names):
+    clients, codecs, send_locks, last_seen, readers = {}, {}, {}, {}, {}
+    for sock, name in zip(sockets, names):
+        readers[sock] = LegacyReader()  # раньше - локальная переменная потока handle_client
+        send_locks[sock] = threading.Lock()
+        last_seen[sock] = time.monotonic()
+        clients[sock] = name
+        codecs[sock] = None
+    return clients, codecs, send_locks, last_seen, readers
+
+
+def sessions(sockets, names):
+    registry = SessionRegistry()
+    for sock, name in zip(sockets, names):
+        session = Session(sock, FrameReader())
+        registry.add(session)
+        registry.login(session, name)
+    return registry
+
+
+def measure(build, sockets, names):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build(sockets, names)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del state
+    return used
+
+
+def rss_kib(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def real_connections(count, timeout):
+    workdir = tempfile.mkdtemp(prefix='chat-bench-sessions-')
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                                '--max-connections', str(count + 10)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    connections = []
+    try:
+        if not wait_for_port('127.0.0.1', port, 30):
+            raise SystemExit('server did not start listening')
+        time.sleep(1.0)
+        baseline = rss_kib(process.pid)
+        hello = encode_frame(compression.hello())
+        for _ in range(count):
+            sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+            sock.sendall(hello)
+            connections.append(sock)
+        for sock in connections:
+            sock.recv(65536)  # ответ на hello: соединение обслуживается
+        time.sleep(1.0)
+        loaded = rss_kib(process.pid)
+    finally:
+        for sock in connections:
+            sock.close()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return baseline, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--connections', type=int, default=2000, help='idle connections to a real server (0: skip)')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    sockets = [StubSocket(fd) for fd in range(args.sessions)]
+    names = [f'user{fd}' for fd in range(args.sessions)]
+    results = {'sessions': args.sessions}
+    for name, build in (('dicts', legacy), ('session', sessions)):
+        used = measure(build, sockets, names)
+        results[name] = {'bytes': used, 'per_session': used / args.sessions}
+        print(f'{name:<8} {used / 2**20:>9.1f} MiB for {args.sessions} sessions, '
+              f'{used / args.sessions:>8.0f} B each')
+    print(f'saved    {(results["dicts"]["bytes"] - results["session"]["bytes"]) / 2**20:>9.1f} MiB')
+
+    if args.connections:
+        baseline, loaded = real_connections(args.connections, args.timeout)
+        per = (loaded - baseline) * 1024 / args.connections
+        results['server'] = {'connections': args.connections, 'rss_before_kib': baseline, 'rss_after_kib': loaded,
+                             'per_connection': per}
+        print(f'server   RSS {baseline / 1024:.1f} -> {loaded / 1024:.1f} MiB with {args.connections} idle '
+              f'connections, {per / 1024:.1f} KiB each')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
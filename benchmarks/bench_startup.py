@@ -0,0 +1,185 @@
+"""Cold start of the GUI client: import time and time to a usable window.
+
+Two parts:
+
+- Imports, measured with `python -X importtime -c "import client"` in a
+  fresh interpreter each run: the total, the slowest direct imports, and
+  what the modules the client now imports on first use (PIL, dialogs,
+  tempfile...) would add if they were loaded up front. Runs anywhere.
+- Startup of the real window: client.py --profile-startup against a
+  spawned server, logging in a registered user from the command line.
+  The client writes when each milestone was reached: window created,
+  login form built, first paint, chat UI built, connected, logged in,
+  contacts shown (from the cache of the previous run, then from the
+  server). Needs a display; without one it runs under xvfb-run when that
+  is installed, and is skipped otherwise.
+
+    python -m benchmarks.bench_startup [--runs 5] [--json out.json]
+                                       [--max-import-ms 400] [--max-paint-ms 800]
+
+With --max-*-ms the exit status is 1 when a median goes over the budget,
+so CI can track regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadgen import SERVER_SCRIPT, free_port, wait_for_port
+
+PACKAGE_DIR = os.path.dirname(SERVER_SCRIPT)
+CLIENT_SCRIPT = os.path.join(PACKAGE_DIR, 'client.py')
+# Что клиент импортирует только при первом использовании
+DEFERRED = ('thumbnails', 'PIL.ImageTk', 'tkinter.filedialog', 'tkinter.simpledialog', 'tempfile', 'shutil',
+            'ctypes')
+MILESTONES = ('window', 'login_frame', 'cached_contacts', 'first_paint', 'gui', 'connected', 'logged_in',
+              'contacts')
+
+
+def import_times(code):
+    """{module: (self us, cumulative us, depth)} from one fresh interpreter"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PACKAGE_DIR,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        # Вложенность импорта - отступ по два пробела на уровень
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(own), int(cumulative), depth)
+    return times
+
+
+def measure_imports(runs):
+    totals = []
+    direct = {}
+    deferred = []
+    for _ in range(runs):
+        times = import_times('import client')
+        totals.append(times['client'][1] / 1000)
+        # Прямые импорты client идут уровнем ниже него
+        for name, (_, cumulative, depth) in times.items():
+            if depth == 1:
+                direct.setdefault(name, []).append(cumulative / 1000)
+        loaded = set(times)
+        after = import_times('import client; import ' + ', '.join(DEFERRED))
+        deferred.append(sum(after[name][1] for name in DEFERRED if name in after and name not in loaded) / 1000)
+    leaked = sorted(name for name in DEFERRED if name in loaded)
+    slowest = sorted(((statistics.median(v), k) for k, v in direct.items()), reverse=True)[:8]
+    return {
+        'import_ms': statistics.median(totals),
+        'deferred_ms': statistics.median(deferred),
+        'slowest': {name: ms for ms, name in slowest},
+        'loaded_eagerly': leaked,
+    }
+
+
+def display_prefix():
+    """Command prefix that gives the client a display, or None if there is none"""
+    if sys.platform in ('win32', 'darwin') or os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'):
+        return []
+    if shutil.which('xvfb-run'):
+        return ['xvfb-run', '-a']
+    return None
+
+
+async def prepare_user(port, username, password, contacts):
+    import sdk
+    async with sdk.AsyncChatClient('127.0.0.1', port) as chat:
+        for name in [username] + contacts:
+            await chat.register(name, password)
+        await chat.login(username, password)
+        for name in contacts:
+            await chat.add_contact(name)
+
+
+def measure_startup(prefix, runs, timeout):
+    workdir = tempfile.mkdtemp(prefix='chat-bench-startup-')
+    port = free_port()
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port)],
+                              cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    samples = []
+    try:
+        if not wait_for_port('127.0.0.1', port, 30):
+            raise SystemExit('server did not start listening')
+        asyncio.run(prepare_user(port, 'bench', 'bench-password', [f'friend{i}' for i in range(20)]))
+        state = os.path.join(workdir, 'state.json')
+        env = dict(os.environ, CHAT_PASSWORD='bench-password')
+        for run in range(runs):
+            profile = os.path.join(workdir, f'profile-{run}.json')
+            started = time.perf_counter()
+            # Первый запуск - без кэша контактов, остальные показывают его сразу
+            subprocess.run(prefix + [sys.executable, CLIENT_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                                     '--username', 'bench', '--state', state, '--cache-mb', '0',
+                                     '--profile-startup', profile],
+                           cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=timeout, check=True)
+            wall = (time.perf_counter() - started) * 1000
+            with open(profile) as f:
+                milestones = json.load(f)
+            samples.append(dict(milestones, process_ms=wall))
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    warm = samples[1:] or samples
+    return {
+        'runs': samples,
+        'median': {name: statistics.median(s[name] for s in warm if name in s)
+                   for name in MILESTONES + ('process_ms',) if any(name in s for s in warm)},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds one client start may take')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--max-import-ms', type=float, help='fail if the median import time is higher')
+    parser.add_argument('--max-paint-ms', type=float, help='fail if the median time to first paint is higher')
+    args = parser.parse_args(argv)
+
+    results = {'imports': measure_imports(args.runs)}
+    imports = results['imports']
+    print(f"import client    {imports['import_ms']:>7.1f} ms (median of {args.runs})")
+    for name, ms in imports['slowest'].items():
+        print(f"  {name:<22} {ms:>7.1f} ms")
+    print(f"deferred imports {imports['deferred_ms']:>7.1f} ms not paid at start")
+    if imports['loaded_eagerly']:
+        print(f"loaded at import although deferred: {', '.join(imports['loaded_eagerly'])}")
+
+    prefix = display_prefix()
+    if prefix is None:
+        print('window startup skipped: no display and no xvfb-run')
+    else:
+        results['startup'] = measure_startup(prefix, args.runs, args.timeout)
+        print("window startup, ms since client.py was loaded (median of warm runs; first run has no cache):")
+        for name, ms in results['startup']['median'].items():
+            print(f"  {name:<16} {ms:>7.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = []
+    if args.max_import_ms is not None and imports['import_ms'] > args.max_import_ms:
+        failed.append(f"import {imports['import_ms']:.1f} ms > {args.max_import_ms} ms")
+    paint = results.get('startup', {}).get('median', {}).get('first_paint')
+    if args.max_paint_ms is not None and paint is not None and paint > args.max_paint_ms:
+        failed.append(f"first paint {paint:.1f} ms > {args.max_paint_ms} ms")
+    if failed:
+        print('over budget: ' + '; '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
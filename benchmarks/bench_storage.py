@@ -0,0 +1,109 @@
+"""Split request cost into storage and network/protocol parts.
+
+Runs the same operations twice per engine: directly against the Storage
+object (storage cost only), and end to end through a spawned server under
+loadgen (network, framing, routing and storage). With the memory engine
+the end-to-end latency is almost all network and CPU; the gap to the
+sqlite engine is what the disk costs.
+
+    python -m benchmarks.bench_storage [--messages 20000] [--duration 10]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import loadgen
+import storage
+from loadgen import percentile
+from storage_conformance import make_storage
+
+
+def time_calls(func, calls):
+    latencies = []
+    for args in calls:
+        started = time.perf_counter()
+        func(*args)
+        latencies.append((time.perf_counter() - started) * 1e6)
+    latencies.sort()
+    return {'ops': len(latencies), 'ops_per_s': len(latencies) / (sum(latencies) / 1e6),
+            'p50_us': percentile(latencies, 0.5), 'p99_us': percentile(latencies, 0.99)}
+
+
+def storage_only(engine, users, messages, reads, seed=3):
+    rng = random.Random(seed)
+    names = [f'user{i}' for i in range(users)]
+    pairs = [tuple(rng.sample(names, 2)) for _ in range(messages)]
+    with tempfile.TemporaryDirectory(prefix='chat-bench-storage-') as workdir:
+        s = make_storage(engine, workdir)
+        try:
+            for name in names:
+                s.create_user(name, b'x' * 60)
+            results = {
+                'store_message': time_calls(s.store_message,
+                                            [(a, b, f'message {i} ' + 'x' * 40) for i, (a, b) in enumerate(pairs)]),
+                'history': time_calls(s.history, rng.sample(pairs, min(reads, len(pairs)))),
+                'conversations': time_calls(s.conversations, [(rng.choice(names), 50) for _ in range(reads)]),
+                'password_hash': time_calls(s.password_hash, [(rng.choice(names),) for _ in range(reads)]),
+            }
+        finally:
+            s.close()
+    return results
+
+
+def end_to_end(engine, users, duration):
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        output = f.name
+    try:
+        loadgen.main(['run', '--scenario', 'chat', '--users', str(users), '--duration', str(duration),
+                      '--server-arg=--storage', f'--server-arg={engine}', '--output', output])
+        with open(output) as f:
+            report = json.load(f)
+    finally:
+        os.remove(output)
+    actions = report['steady']['actions']
+    return {name: {'p50_ms': stats['p50_ms'], 'p99_ms': stats['p99_ms'], 'per_s': stats['throughput_per_s']}
+            for name, stats in actions.items() if stats['count']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--load-users', type=int, default=20, help='loadgen users for the end-to-end part')
+    parser.add_argument('--duration', type=float, default=10, help='loadgen steady-state seconds')
+    parser.add_argument('--skip-network', action='store_true', help='only time the storage layer')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    results = {'storage_only': {}, 'end_to_end': {}}
+    for engine in storage.ENGINES:
+        results['storage_only'][engine] = storage_only(engine, args.users, args.messages, args.reads)
+        if not args.skip_network:
+            results['end_to_end'][engine] = end_to_end(engine, args.load_users, args.duration)
+
+    print(f"{'engine':<8} {'operation':<15} {'ops/s':>10} {'p50 us':>9} {'p99 us':>9}")
+    for engine, ops in results['storage_only'].items():
+        for name, row in ops.items():
+            print(f"{engine:<8} {name:<15} {row['ops_per_s']:>10.0f} {row['p50_us']:>9.1f} {row['p99_us']:>9.1f}")
+    if results['end_to_end']:
+        print()
+        print(f"{'action':<18} " + ' '.join(f"{engine + ' p50 ms':>15}" for engine in storage.ENGINES)
+              + f" {'storage share':>14}")
+        actions = sorted(set().union(*(r.keys() for r in results['end_to_end'].values())))
+        for action in actions:
+            p50 = [results['end_to_end'][engine].get(action, {}).get('p50_ms') for engine in storage.ENGINES]
+            # Доля диска: насколько sqlite медленнее той же операции в памяти
+            share = (p50[0] - p50[1]) / p50[0] * 100 if all(p50) and p50[0] else None
+            print(f"{action:<18} " + ' '.join(f"{v:>15.2f}" if v is not None else f"{'-':>15}" for v in p50)
+                  + (f" {share:>13.0f}%" if share is not None else f" {'-':>14}"))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Connection setup cost: plain TCP vs full TLS handshake vs resumed TLS.
+
+Spawns server.py with a freshly generated test certificate and times
+connect + handshake + one `hello` round trip for each mode.
+
+    python -m benchmarks.bench_tls [--connections 500] [--concurrency 8]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import socket
+
+import compression
+import tls
+from loadgen import SERVER_SCRIPT, free_port, percentile, wait_for_port
+from protocol import FrameReader, encode_frame
+
+
+def setup_connection(host, port, context=None, session_cache=None):
+    """Open a connection and finish one round trip; returns (seconds, resumed)"""
+    started = time.perf_counter()
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if context:
+        sock = tls.wrap_client_socket(context, sock, host, session_cache)
+    try:
+        sock.sendall(encode_frame(compression.hello(codecs=[])))
+        reader = FrameReader()
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError('server closed the connection')
+            reader.feed(data)
+            if next(reader.frames(), None) is not None:
+                break
+        elapsed = time.perf_counter() - started
+        resumed = bool(context and sock.session_reused)
+        if session_cache is not None:
+            session_cache.store((host, port), sock)
+        return elapsed, resumed
+    finally:
+        sock.close()
+
+
+def run_mode(name, host, port, connections, concurrency, context=None, resume=False):
+    latencies = []
+    resumed = 0
+    lock = threading.Lock()
+    remaining = [connections]
+
+    def worker():
+        nonlocal resumed
+        # Каждый поток держит свой кэш: так имитируется один клиент, который переподключается
+        cache = tls.SessionCache() if resume else None
+        if resume:
+            setup_connection(host, port, context, cache)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            elapsed, reused = setup_connection(host, port, context, cache)
+            with lock:
+                latencies.append(elapsed * 1000)
+                resumed += reused
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'mode': name,
+        'connections': len(latencies),
+        'setups_per_s': len(latencies) / wall,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'resumed': resumed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-tls-')
+    cert, key = tls.generate_test_certificate(os.path.join(workdir, 'server.crt'),
+                                              os.path.join(workdir, 'server.key'))
+    host = '127.0.0.1'
+    plain_port, tls_port = free_port(), free_port()
+    servers = [
+        subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', host, '--port', str(plain_port)],
+                         cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', host, '--port', str(tls_port),
+                          '--tls-cert', cert, '--tls-key', key],
+                         cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+    ]
+    try:
+        if not (wait_for_port(host, plain_port, 30) and wait_for_port(host, tls_port, 30)):
+            raise SystemExit('servers did not start')
+        context = tls.client_context(cafile=cert)
+        results = [
+            run_mode('plain', host, plain_port, args.connections, args.concurrency),
+            run_mode('tls_full', host, tls_port, args.connections, args.concurrency, context),
+            run_mode('tls_resumed', host, tls_port, args.connections, args.concurrency, context, resume=True),
+        ]
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    print(f"{'mode':<12} {'setups/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'resumed':>8}")
+    for row in results:
+        print(f"{row['mode']:<12} {row['setups_per_s']:>10.1f} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} "
+              f"{row['resumed']:>8}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,135 @@
+import time
+
+STARTED = time.perf_counter()  # Профиль запуска считается от этой точки, до тяжёлых импортов
+
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox, simpledialog
-import socket
-import json
+from tkinter import ttk, messagebox
+import asyncio
 import threading
 import os
-from PIL import Image, ImageTk
 import base64
 import tkinter.font as tkFont
-import ctypes
 import sys
 import subprocess
-import shutil
 from datetime import datetime
+import argparse
+import io
+import json
+import sdk
+from attachment_cache import AttachmentCache
+from client_state import ClientState
+import tls
+# PIL (и thumbnails, который его тянет), диалоги tkinter, ctypes, shutil и tempfile
+# импортируются там, где нужны: окно входа их не ждёт
+
+PROFILE_TIMEOUT_MS = 30000  # --profile-startup: столько ждём конца запуска, потом пишем что есть
 
 def load_font(font_path):
     if os.name == "nt":
+        import ctypes
         FR_PRIVATE  = 0x10
         FR_NOT_ENUM = 0x20
         path = os.path.abspath(font_path)
         ctypes.windll.gdi32.AddFontResourceExW(path, FR_PRIVATE, 0)
 
+def format_timestamp(timestamp, pattern="%H:%M"):
+    """Server timestamps are UTC ISO strings; show them in local time"""
+    try:
+        return datetime.fromisoformat(timestamp).astimezone().strftime(pattern)
+    except (TypeError, ValueError):
+        return timestamp or ''
+
 class ChatClient:
-    def __init__(self, host='localhost', port=5000):
-        self.host = host
-        self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, host='localhost', port=5000, compression_dictionary=None, tls_context=None,
+                 attachments=None, login=None, state=None, profile_startup=None):
+        """login is (username, password) to log in with while the window is built.
+
+        state is a ClientState with the contact lists cached by earlier runs.
+        profile_startup is a path: write the startup milestones there as JSON and quit.
+        """
+        self.milestones = {}  # {этап запуска: мс от старта}
+        self.profile_startup = profile_startup
+        self.state = state
+        # Сеть целиком в sdk: окно только отправляет запросы и рисует ответы
+        self.chat = sdk.AsyncChatClient(host, port, tls_context=tls_context,
+                                        compression_dictionary=compression_dictionary)
+        self.chat.resume = self.resume_requests
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='network', daemon=True).start()
         self.username = None
-        self.connected = False
         self.file_links = []
+        self.thumbnail_images = {}  # {thumbnail_path: PhotoImage}, держим ссылки, чтобы Tk их не удалил
+        self.thumbnail_slots = {}  # {thumbnail_path: [(x, y, anchor)]} - места, ждущие превью
+        self.contact_presence = {}  # {contact: online}
+        self.contacts_version = None  # Версия списка контактов, к которой применяются contacts_delta
+        self.history_contact = None  # Чья история сейчас приходит потоком
+        self.history_y = 20  # Где рисовать следующий кусок истории
+        self.history_count = 0
+        self.imports = []  # [[имена в ещё не отвеченных batch], добавлено, [не добавлены]] на каждый импорт
+        self.attachments = attachments  # AttachmentCache или None - тогда файл скачивается при каждом открытии
+        self.downloads = set()  # file_path, запрошенные у сервера и ещё не полученные
+        self.connecting = None  # Задача chat.connect(), которую ждут все, кому нужно соединение
+        self.chat_frame = None  # Окно чата строится после первой отрисовки окна входа
+        self.autologin = login is not None
+        self.root = tk.Tk()
+        self.mark('window')
+        # Соединение и вход идут в сетевом потоке, пока строится окно
+        self.run_async(self.start(self.chat.login_request(*login) if login else None))
         self.setup_gui()
+        self.mark('login_frame')
+        if login:
+            self.username_entry.insert(0, login[0])
+            cached = state.contacts(login[0]) if state else []
+            if cached:
+                # Список с прошлого запуска виден сразу; ответ сервера его заменит
+                self.username = login[0]
+                self.show_chat()
+                for contact in cached:
+                    self.contacts_listbox.insert(tk.END, contact)
+                self.mark('cached_contacts')
+        elif state and state.username:
+            self.username_entry.insert(0, state.username)
+        # Idle-колбэки идут по очереди: этот выполнится, когда окно уже нарисовано
+        self.root.after_idle(self.after_first_paint)
+        if profile_startup:
+            self.root.after(PROFILE_TIMEOUT_MS, self.finish_profile)
+        asyncio.run_coroutine_threadsafe(self.pump_events(), self.loop)
+        
+    def mark(self, milestone):
+        """Note when a startup milestone was reached, in ms since the module was loaded"""
+        if milestone in self.milestones:
+            return
+        self.milestones[milestone] = round((time.perf_counter() - STARTED) * 1000, 1)
+        if not self.profile_startup or 'first_paint' not in self.milestones:
+            return
+        if not self.autologin or {'contacts', 'login_failed'} & self.milestones.keys():
+            self.root.after(1, self.finish_profile)
+            
+    def finish_profile(self):
+        """--profile-startup: write the milestones and close the window"""
+        if self.profile_startup is None:
+            return
+        with open(self.profile_startup, 'w', encoding='utf-8') as f:
+            json.dump(self.milestones, f)
+        self.profile_startup = None
+        self.root.destroy()
+        
+    def after_first_paint(self):
+        """The login window is on screen: load the custom font and build the rest of the UI"""
+        self.mark('first_paint')
+        self.load_pixel_font()
+        self.build_chat_frame()
+        self.mark('gui')
         
     def setup_gui(self):
-        """Initialize the GUI"""
-        self.root = tk.Tk()
+        """Build what the first frame shows: styles, header and the login form"""
         self.root.title("Chat Application")
         self.root.geometry("1920x1080")
         self.root.resizable(False, False)  # Запрещаем изменение размера окна
         self.root.configure(bg="#18191c")
         
-        # Загружаем кастомный шрифт Jersey 10
-        font_path = os.path.join(os.path.dirname(__file__), "Jersey10-Regular.ttf")
-        load_font(font_path)
-        try:
-            self.pixel_font = tkFont.Font(family="Jersey 10", size=16)
-        except Exception as e:
-            messagebox.showwarning("Font Warning", f"Не удалось загрузить шрифт Jersey 10: {str(e)}\nИспользуется Courier.")
-            self.pixel_font = tkFont.Font(family="Courier", size=16)
+        # Пока файл шрифта Jersey 10 не загружен, виджеты рисуются Courier; см. load_pixel_font
+        self.pixel_font = tkFont.Font(family="Courier", size=16)
         
         # Configure styles with sharp edges and larger buttons
         style = ttk.Style()
@@ -78,7 +162,23 @@ class ChatClient:
         button_frame.grid(row=2, column=0, columnspan=2, pady=28)
         ttk.Button(button_frame, text="Login", command=self.login, width=20).pack(side=tk.LEFT, padx=16)
         ttk.Button(button_frame, text="Register", command=self.register, width=20).pack(side=tk.LEFT, padx=16)
-        # Main chat frame (initially hidden)
+        
+        self.root.columnconfigure(0, weight=1)
+        self.root.rowconfigure(0, weight=1)
+        
+    def load_pixel_font(self):
+        """Register Jersey 10 and switch the named font to it; every widget using it follows"""
+        font_path = os.path.join(os.path.dirname(__file__), "Jersey10-Regular.ttf")
+        load_font(font_path)
+        try:
+            self.pixel_font.configure(family="Jersey 10")
+        except Exception as e:
+            messagebox.showwarning("Font Warning", f"Не удалось загрузить шрифт Jersey 10: {str(e)}\nИспользуется Courier.")
+        
+    def build_chat_frame(self):
+        """Build the (hidden) chat window: contacts, message canvas and input"""
+        if self.chat_frame is not None:
+            return
         self.chat_frame = ttk.Frame(self.main_frame, padding="32")
         
         # Contacts list
@@ -91,6 +191,8 @@ class ChatClient:
         self.contacts_listbox.bind('<<ListboxSelect>>', self.on_contact_select)
         self.add_contact_btn = tk.Button(self.contacts_frame, text="Add Contact", command=self.add_contact, font=self.pixel_font, bg="#fff", fg="#18191c", bd=0, highlightthickness=2, highlightbackground="#000", activebackground="#eaeaea", activeforeground="#18191c")
         self.add_contact_btn.pack(side=tk.TOP, fill=tk.X, padx=16, pady=(0, 16))
+        self.import_contacts_btn = tk.Button(self.contacts_frame, text="Import Contacts", command=self.import_contacts, font=self.pixel_font, bg="#fff", fg="#18191c", bd=0, highlightthickness=2, highlightbackground="#000", activebackground="#eaeaea", activeforeground="#18191c")
+        self.import_contacts_btn.pack(side=tk.TOP, fill=tk.X, padx=16, pady=(0, 16))
         
         # Chat area (canvas + скроллинг)
         self.chat_canvas_frame = tk.Frame(self.chat_frame, bg="#18191c")
@@ -120,31 +222,87 @@ class ChatClient:
         self.send_file_btn.grid(row=0, column=2, padx=12)
         
         # Configure grid weights
-        self.root.columnconfigure(0, weight=1)
-        self.root.rowconfigure(0, weight=1)
         self.chat_frame.columnconfigure(1, weight=1)
         self.chat_frame.rowconfigure(0, weight=1)
         self.message_frame.columnconfigure(0, weight=1)
         
-    def connect(self):
-        """Connect to the server"""
+    def show_chat(self):
+        self.build_chat_frame()
+        self.login_frame.place_forget()
+        self.chat_frame.place(relx=0.5, rely=0.5, anchor='center')
+        
+    def show_login(self):
+        if self.chat_frame is not None:
+            self.chat_frame.place_forget()
+        self.login_frame.place(relx=0.5, rely=0.5, anchor='center')
+        
+    def save_contacts(self):
+        """Remember the contact list, so the next start can show it before the server answers"""
+        if self.state and self.username:
+            try:
+                self.state.save(self.username, self.contacts_listbox.get(0, tk.END))
+            except OSError as e:
+                print(f"Could not save client state: {str(e)}")
+        
+    def run_async(self, coro, on_done=None):
+        """Run a coroutine on the network thread; on_done gets its result in the Tk thread"""
+        def finished(future):
+            try:
+                result = future.result()
+            except sdk.ChatError as e:
+                # Ответ с ошибкой идёт туда же, куда раньше приходили все ответы
+                self.root.after(1, self.handle_message, e.response)
+            except Exception as e:
+                self.root.after(1, messagebox.showerror, "Error", str(e) or type(e).__name__)
+            else:
+                if on_done:
+                    self.root.after(1, on_done, result)
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(finished)
+        return future
+
+    def deliver(self, message):
+        """Pass a pushed message or a partial response from the network thread to handle_message"""
+        self.root.after(1, self.handle_message, message)
+
+    async def pump_events(self):
+        async for event in self.chat.events():
+            self.deliver(event)
+
+    async def ensure_connected(self):
+        # Пока sdk переподключается сам, запросы просто ждут его
+        if self.chat.connected or self.chat.reconnecting:
+            return
+        # Кнопка входа, нажатая во время подключения при старте, ждёт то же подключение
+        if self.connecting is None or self.connecting.done():
+            self.connecting = asyncio.ensure_future(self.chat.connect())
+        await asyncio.shield(self.connecting)
+
+    async def start(self, login):
+        """Runs while the window is built: connect, and log in if the password is known"""
         try:
-            self.socket.connect((self.host, self.port))
-            self.connected = True
-            # Start receiving thread
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            return True
-        except Exception as e:
-            messagebox.showerror("Connection Error", str(e))
-            return False
-            
+            await self.ensure_connected()
+        except (OSError, asyncio.TimeoutError) as e:
+            # Кнопка входа попробует подключиться ещё раз
+            print(f"Could not connect: {str(e)}")
+            if login:
+                self.mark('login_failed')
+                self.root.after(1, self.show_login)
+            return
+        self.mark('connected')
+        if login:
+            await self.open_session(login)
+
+    async def call(self, message):
+        await self.ensure_connected()
+        return await self.chat.request(message, self.deliver)
+
+    def request(self, message):
+        """Send a request; its response goes through handle_message like a pushed message"""
+        self.run_async(self.call(message), self.handle_message)
+
     def login(self):
         """Handle login"""
-        if not self.connected and not self.connect():
-            return
-            
         username = self.username_entry.get()
         password = self.password_entry.get()
         
@@ -152,30 +310,30 @@ class ChatClient:
             messagebox.showerror("Error", "Please enter both username and password")
             return
             
-        message = {
-            'action': 'login',
-            'username': username,
-            'password': password
-        }
+        print(f"Sending login request for user: {username}")
+        self.run_async(self.open_session(self.chat.login_request(username, password)))
         
-        try:
-            print(f"Sending login request for user: {username}")
-            # Отправляем данные
-            json_data = json.dumps(message, ensure_ascii=False).encode()
-            # Отправляем размер данных
-            size_data = len(json_data).to_bytes(4, byteorder='big')
-            self.socket.send(size_data)
-            # Отправляем данные
-            self.socket.send(json_data)
-        except Exception as e:
-            print(f"Error sending login request: {str(e)}")
-            messagebox.showerror("Error", f"Failed to send login request: {str(e)}")
+    async def open_session(self, login):
+        """Log in; with batch support, load the contact list in the same round trip"""
+        await self.ensure_connected()
+        if not self.chat.batch_limit:
+            self.deliver(await self.chat.request(login))
+            return
+        await self.chat.batch([login, {'action': 'contacts', 'contact_action': 'list'}], self.deliver)
+        
+    def resume_requests(self):
+        """Called by sdk after a reconnect: requests to send along with the repeated login"""
+        requests = [{'action': 'contacts', 'contact_action': 'list'}]
+        if self.history_contact:
+            # После переподключения сразу возвращаем открытый чат
+            self.root.after(1, self.clear_history)
+            requests += [{'action': 'contacts', 'contact_action': 'history',
+                          'contact_username': self.history_contact, 'stream': True},
+                         {'action': 'mark_read', 'contact_username': self.history_contact}]
+        return requests
         
     def register(self):
         """Handle registration"""
-        if not self.connected and not self.connect():
-            return
-            
         username = self.username_entry.get()
         password = self.password_entry.get()
         
@@ -183,16 +341,69 @@ class ChatClient:
             messagebox.showerror("Error", "Please enter both username and password")
             return
             
-        message = {
-            'action': 'register',
-            'username': username,
-            'password': password
-        }
+        self.request({'action': 'register', 'username': username, 'password': password})
         
-        self.socket.send(json.dumps(message, ensure_ascii=False).encode())
+    def import_contacts(self):
+        """Add every username from a text file (one per line or comma separated)"""
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(title="Import contacts", filetypes=[("Text files", "*.txt *.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                names = [name.strip() for name in f.read().replace(',', '\n').splitlines()]
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to read {path}: {str(e)}")
+            return
+        existing = set(self.contacts_listbox.get(0, tk.END))
+        names = [name for name in dict.fromkeys(names) if name and name != self.username and name not in existing]
+        if not names:
+            messagebox.showinfo("Import Contacts", "No new contacts in the file")
+            return
+        limit = self.chat.batch_limit
+        if not limit:
+            # Старый сервер: по запросу на контакт
+            for name in names:
+                self.request({'action': 'contacts', 'contact_action': 'add', 'contact_username': name})
+            return
+        chunks = [names[i:i + limit] for i in range(0, len(names), limit)]
+        self.imports.append([list(chunks), 0, []])
+        for chunk in chunks:
+            self.run_async(self.import_chunk(chunk), self.on_import_batch)
+            
+    async def import_chunk(self, names):
+        """Add up to batch_limit contacts in one batch; returns its per-request results"""
+        try:
+            _, results = await self.chat.batch([{'action': 'contacts', 'contact_action': 'add',
+                                                 'contact_username': name} for name in names], self.deliver)
+        except (sdk.ChatError, ConnectionError) as e:
+            print(f"Import batch failed: {str(e)}")
+            results = []
+        return results
+            
+    def on_import_batch(self, results):
+        """Count the results of one import batch; report once the whole import is done"""
+        if not self.imports:
+            return
+        state = self.imports[0]
+        names = state[0].pop(0)
+        results = results or [{'status': 'error'}] * len(names)
+        for name, result in zip(names, results):
+            if result.get('status') == 'success':
+                state[1] += 1
+            else:
+                state[2].append(name)
+        if state[0]:
+            return
+        self.imports.pop(0)
+        report = f"Added {state[1]} contacts"
+        if state[2]:
+            report += "\nNot added: " + ", ".join(state[2][:20])
+        messagebox.showinfo("Import Contacts", report)
         
     def add_contact(self):
         """Add a new contact"""
+        from tkinter import simpledialog
         contact = simpledialog.askstring("Add Contact", "Enter contact username:")
         if contact:
             message = {
@@ -200,16 +411,26 @@ class ChatClient:
                 'contact_action': 'add',
                 'contact_username': contact
             }
-            self.socket.send(json.dumps(message, ensure_ascii=False).encode())
+            self.request(message)
             
     def display_history(self, messages):
+        self.clear_history()
+        self.append_history(messages)
+
+    def clear_history(self):
         self.chat_canvas.delete("all")
         self.file_links = []
-        y = 20
-        for idx, msg in enumerate(messages):
+        self.thumbnail_slots = {}
+        self.history_y = 20
+        self.history_count = 0
+
+    def append_history(self, messages):
+        """Draw messages below what is already shown; history arrives in several chunks"""
+        y = self.history_y
+        for idx, msg in enumerate(messages, self.history_count):
             sender = msg.get('sender', '')
             content = msg.get('content', '')
-            timestamp = msg.get('timestamp', '')
+            timestamp = format_timestamp(msg.get('timestamp'), "%d.%m %H:%M")
             file_path = msg.get('file_path')
             is_self = sender == self.username
             color = '#18191c'
@@ -247,6 +468,9 @@ class ChatClient:
             
             bbox = self.chat_canvas.bbox(text_id)
             if bbox:
+                preview_height = self.reserve_thumbnail(msg, x, bbox[3] + 8, anchor)
+                if preview_height:
+                    bbox = (bbox[0], bbox[1], bbox[2], bbox[3] + preview_height + 8)
                 self.chat_canvas.create_rectangle(
                     bbox[0]-16, bbox[1]-8,
                     bbox[2]+16, bbox[3]+8,
@@ -256,6 +480,7 @@ class ChatClient:
                 )
                 self.chat_canvas.tag_lower("current")
                 self.chat_canvas.tag_raise(text_id)
+                self.chat_canvas.tag_raise('thumbnail')
                 
                 if file_path:
                     # Привязываем обработчик клика к тексту
@@ -265,35 +490,113 @@ class ChatClient:
                         lambda e, path=file_path: self.handle_file_click(path)
                     )
             y += (bbox[3] - bbox[1] + 40) if bbox else 60
+        self.history_y = y
+        self.history_count += len(messages)
         self.chat_canvas.config(scrollregion=self.chat_canvas.bbox("all"))
         self.chat_canvas.yview_moveto(1.0)
 
+    def reserve_thumbnail(self, message, x, top, anchor):
+        """Reserve room for an image preview under a message; returns its height"""
+        thumbnail_path = message.get('thumbnail_path')
+        image = message.get('image')
+        if not thumbnail_path or not image:
+            return 0
+        import thumbnails  # вместе с PIL - только когда в чате есть картинка
+        _, height = thumbnails.thumbnail_size(image['width'], image['height'])
+        image_anchor = 'ne' if anchor == 'e' else 'nw'
+        if thumbnail_path in self.thumbnail_images:
+            self.draw_thumbnail(thumbnail_path, x, top, image_anchor)
+        else:
+            slots = self.thumbnail_slots.setdefault(thumbnail_path, [])
+            if not slots:
+                self.request_thumbnail(thumbnail_path)
+            slots.append((x, top, image_anchor))
+        return height
+            
+    def request_thumbnail(self, thumbnail_path):
+        self.request({'action': 'thumbnail', 'thumbnail_path': thumbnail_path})
+            
+    def on_thumbnail(self, message):
+        """Decode a received thumbnail and draw it into every slot waiting for it"""
+        thumbnail_path = message.get('thumbnail_path')
+        slots = self.thumbnail_slots.pop(thumbnail_path, [])
+        if message.get('status') != 'success':
+            print(f"Thumbnail unavailable: {message.get('message')}")
+            return
+        try:
+            from PIL import Image, ImageTk
+            image = Image.open(io.BytesIO(base64.b64decode(message['data'])))
+            self.thumbnail_images[thumbnail_path] = ImageTk.PhotoImage(image)
+        except Exception as e:
+            print(f"Error decoding thumbnail: {str(e)}")
+            return
+        for x, top, anchor in slots:
+            self.draw_thumbnail(thumbnail_path, x, top, anchor)
+            
+    def draw_thumbnail(self, thumbnail_path, x, top, anchor):
+        self.chat_canvas.create_image(x, top, image=self.thumbnail_images[thumbnail_path], anchor=anchor,
+                                      tags=('thumbnail',))
+        self.chat_canvas.tag_raise('thumbnail')
+            
     def handle_file_click(self, file_path):
         """Handle click on file in chat"""
         try:
-            # Явно заменяем обратные слэши на прямые перед нормализацией
+            # Явно заменяем обратные слэши на прямые: так путь хранит сервер
             file_path = file_path.replace('\\', '/')
+            cached = self.attachments.get(file_path) if self.attachments else None
+            file_name = os.path.basename(file_path)
+            if cached:
+                self.show_file_dialog(cached, file_name)
+                return
             # Нормализуем путь для текущей ОС
             file_path_local = os.path.normpath(file_path)
-            
-            # Извлекаем имя файла из пути
-            file_name = os.path.basename(file_path_local)
-            
-            # Проверяем существование файла
-            if not os.path.exists(file_path_local):
-                # Попробуем найти файл в папке files, если путь не абсолютный
-                if not os.path.isabs(file_path_local):
-                     alternative_path = os.path.join('files', file_name)
-                     alternative_path = os.path.normpath(alternative_path)
-                     if os.path.exists(alternative_path):
-                         file_path_local = alternative_path
-                     else:
-                        messagebox.showerror("Error", f"File not found locally: {file_path_local}")
-                        return
-                else:
-                    messagebox.showerror("Error", f"File not found locally: {file_path_local}")
-                    return
-            
+            # Клиент, запущенный рядом с сервером, видит файл на диске
+            if os.path.exists(file_path_local):
+                self.show_file_dialog(file_path_local, file_name)
+                return
+            # Скачиваем при первом открытии; диалог откроется, когда файл придёт
+            if file_path not in self.downloads:
+                self.downloads.add(file_path)
+                self.request({'action': 'attachment', 'file_path': file_path})
+        except Exception as e:
+            messagebox.showerror("Error", f"Error handling file: {str(e)}")
+
+    def on_attachment(self, message):
+        """Store a downloaded attachment and offer to open or save it"""
+        file_path = message.get('file_path')
+        self.downloads.discard(file_path)
+        if message.get('status') != 'success':
+            messagebox.showerror("Error", f"Download failed: {message.get('message', 'Unknown error')}")
+            return
+        try:
+            data = base64.b64decode(message['data'])
+            if self.attachments:
+                local_path = self.attachments.put(file_path, data, message.get('sha256'))
+            else:
+                import tempfile
+                local_path = os.path.join(tempfile.gettempdir(), os.path.basename(file_path))
+                with open(local_path, 'wb') as f:
+                    f.write(data)
+        except ValueError as e:
+            messagebox.showerror("Error", f"Download is corrupted: {str(e)}")
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"Error storing file: {str(e)}")
+            return
+        self.show_file_dialog(local_path, os.path.basename(file_path))
+
+    def on_file_sent(self, message, data):
+        """Put a file we sent into the cache, so opening it later does not download it back"""
+        if self.attachments and message.get('file_path'):
+            try:
+                self.attachments.put(message['file_path'], data)
+            except Exception as e:
+                print(f"Error caching sent file: {str(e)}")
+        self.handle_message(message)
+
+    def show_file_dialog(self, file_path_local, file_name):
+        """Ask whether to open or save a local copy of an attachment"""
+        try:
             # Создаем диалог для выбора действия
             dialog = tk.Toplevel(self.root)
             dialog.title("File Action")
@@ -341,7 +644,7 @@ class ChatClient:
                 activebackground="#eaeaea",
                 width=12,
                 height=1,
-                command=lambda: [self.save_file(file_path_local), dialog.destroy()]
+                command=lambda: [self.save_file(file_path_local, file_name), dialog.destroy()]
             )
             save_button.pack(side=tk.LEFT, padx=12)
             
@@ -383,14 +686,16 @@ class ChatClient:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open file: {str(e)}")
 
-    def save_file(self, file_path):
+    def save_file(self, file_path, file_name=None):
         """Save file"""
+        import shutil
+        from tkinter import filedialog
         try:
             # Нормализуем путь для текущей ОС
             file_path = os.path.normpath(file_path)
             
-            # Получаем имя файла без пути
-            file_name = os.path.basename(file_path)
+            # В кэше файл назван по хэшу: предлагаем исходное имя
+            file_name = file_name or os.path.basename(file_path)
             
             # Запрашиваем путь для сохранения
             save_path = filedialog.asksaveasfilename(
@@ -410,20 +715,47 @@ class ChatClient:
         """Handle incoming messages"""
         print(f"Received message: {message}")
         
+        if message.get('action') == 'thumbnail':
+            # Ошибки превью не показываем всплывающим окном, просто оставляем место пустым
+            self.root.after(1, self.on_thumbnail, message)
+            return
+        
+        if message.get('action') in ('connected', 'disconnected'):
+            # Переподключается sdk сам; после входа он присылает контакты и открытый чат
+            print(f"Connection {message['action']}" + (f": {message['message']}" if message.get('message') else ""))
+            return
+        
+        if message.get('action') == 'attachment':
+            # Ответ на скачивание, в том числе отказ из-за перегрузки
+            self.root.after(1, self.on_attachment, message)
+            return
+        
+        if self.imports and message.get('action') == 'contacts' and message.get('status') == 'error':
+            # Ошибки импорта покажем одним списком, когда он закончится
+            return
+        
         # Обрабатываем ошибки сразу в основном потоке, т.к. это всплывающие окна
         if message.get('status') == 'error':
             error_msg = message.get('message', 'Unknown error')
             action = message.get('action', 'Unknown action')
+            if action == 'login':
+                # Вход при старте не удался: убираем список контактов из кэша и не перезаписываем его
+                self.mark('login_failed')
+                self.username = None
+                if self.chat_frame is not None:
+                    self.contacts_listbox.delete(0, tk.END)
+                self.show_login()
             self.root.after(1, messagebox.showerror, "Error", f"{action.capitalize()} failed: {error_msg}")
             return
         
         if message.get('status') == 'success' and message.get('action') in ('login', 'register'):
             print("Login/Register successful, switching to chat interface")
             self.username = message.get('username', self.username_entry.get())
-            self.login_frame.place_forget()
-            self.chat_frame.place(relx=0.5, rely=0.5, anchor='center')
-            # Загружаем контакты сразу после успешного входа
-            self.root.after(1, self.load_contacts)
+            self.show_chat()
+            self.mark('logged_in')
+            # Загружаем контакты сразу после успешного входа; через batch они уже идут следом
+            if not self.chat.batch_limit:
+                self.root.after(1, self.load_contacts)
             return
         
         if message.get('action') == 'history':
@@ -431,8 +763,21 @@ class ChatClient:
             self.root.after(1, self.display_history, message.get('messages', []))
             return
         
+        if message.get('action') == 'history_chunk':
+            # Длинная переписка приходит частями: рисуем каждую сразу, не дожидаясь конца
+            if message.get('contact') == self.history_contact:
+                self.root.after(1, self.append_history, message.get('messages', []))
+            return
+        
+        if message.get('action') == 'history_end':
+            print(f"History with {message.get('contact')}: {message.get('count')} messages")
+            return
+        
         # Обрабатываем входящие сообщения и файлы
         if message.get('action') == 'message' or (message.get('action') == 'file' and message.get('is_file')):
+            if message.get('redelivered'):
+                # Пропущенное за время отключения: оно уже есть в истории, которую клиент загружает после входа
+                return
             selected = self.contacts_listbox.curselection()
             if selected:
                 contact = self.contacts_listbox.get(selected[0])
@@ -442,6 +787,8 @@ class ChatClient:
                 # добавляем его напрямую в чат.
                 if contact == sender or (contact == receiver and sender != self.username): # Added check to not double-add own sent messages
                     self.root.after(1, self.add_message_to_display, message)
+                    # Чат открыт - сообщение сразу прочитано
+                    self.mark_read(contact)
                 # If the message is for a different contact, we don't add it to the current chat display.
                 # In a more complete application, you might add a notification/indicator for that contact.
             return
@@ -467,38 +814,77 @@ class ChatClient:
                     self.contacts_listbox.delete(0, tk.END)
                     for contact in message['contacts']:
                         self.contacts_listbox.insert(tk.END, contact)
+                    self.contacts_version = message.get('version')
+                    self.contact_presence = dict(message.get('presence', {}))
+                    self.root.after(1, self.refresh_presence)
+                    self.save_contacts()
+                    self.mark('contacts')
                     # Если есть контакты и ни один не выбран, выбираем первый и загружаем его историю
                     # Only load history if no contact is currently selected, to avoid clearing active chat
-                    if message['contacts'] and not self.contacts_listbox.curselection():
+                    if self.chat.batch_limit and self.history_contact in message['contacts']:
+                        # История этого чата пришла в том же batch, что и список
+                        self.contacts_listbox.selection_set(message['contacts'].index(self.history_contact))
+                    elif message['contacts'] and not self.contacts_listbox.curselection():
                          self.root.after(1, lambda c=message['contacts'][0]: self.contacts_listbox.selection_set(0) or self.request_history(c))
 
-            if message.get('message') == 'Contact added successfully':
+            # Новые серверы присылают contacts_delta; старые - только это подтверждение
+            if message.get('message') == 'Contact added successfully' and 'version' not in message:
                 self.root.after(1, self.load_contacts)
 
+        elif message.get('action') == 'contacts_delta':
+            self.root.after(1, self.apply_contacts_delta, message)
+
         elif message.get('action') == 'history':
              # При получении полной истории, очищаем текущий чат и отображаем историю
              self.root.after(1, self.display_history, message.get('messages', []))
 
+    def apply_contacts_delta(self, delta):
+        """Apply an incremental contact list update pushed by the server"""
+        version = delta.get('version')
+        if self.contacts_version is None or version <= self.contacts_version:
+            # Полный список ещё не пришёл (он уже учтёт это изменение) или дельта устарела
+            return
+        if version != self.contacts_version + 1:
+            # Пропустили обновление - перезапрашиваем список целиком
+            self.contacts_version = None
+            self.load_contacts()
+            return
+        self.contacts_version = version
+        names = list(self.contacts_listbox.get(0, tk.END))
+        for name in delta.get('removed', []):
+            if name in names:
+                self.contacts_listbox.delete(names.index(name))
+                names.remove(name)
+            self.contact_presence.pop(name, None)
+        for name in delta.get('added', []):
+            if name not in names:
+                self.contacts_listbox.insert(tk.END, name)
+                names.append(name)
+        self.contact_presence.update(delta.get('presence', {}))
+        self.refresh_presence()
+        self.save_contacts()
+        
+    def refresh_presence(self):
+        """Color online contacts in the list"""
+        for index, name in enumerate(self.contacts_listbox.get(0, tk.END)):
+            online = self.contact_presence.get(name, False)
+            self.contacts_listbox.itemconfig(index, fg='#00aa55' if online else '#18191c')
+            
     def request_history(self, contact):
         """Request chat history with a contact"""
         print(f"Requesting history for contact: {contact}")
         message = {
             'action': 'contacts',
             'contact_action': 'history',
-            'contact_username': contact
+            'contact_username': contact,
+            'stream': True
         }
-        try:
-            json_data = json.dumps(message, ensure_ascii=False).encode()
-            size_data = len(json_data).to_bytes(4, byteorder='big')
-            self.socket.send(size_data)
-            self.socket.send(json_data)
-        except Exception as e:
-            print(f"Error requesting history: {str(e)}")
-            messagebox.showerror("Error", f"Failed to load chat history: {str(e)}")
+        # Куски прежнего запроса (другой собеседник) больше не рисуем
+        self.history_contact = contact
+        self.clear_history()
+        self.request(message)
 
     def send_message(self):
-        if not self.connected:
-            return
         message = self.message_entry.get()
         if not message:
             return
@@ -507,24 +893,23 @@ class ChatClient:
             messagebox.showerror("Error", "Please select a contact")
             return
         receiver = self.contacts_listbox.get(selected[0])
-        data = {
-            'action': 'message',
-            'receiver': receiver,
-            'content': message
-        }
-        self.socket.send(json.dumps(data, ensure_ascii=False).encode())
+        self.run_async(self.chat.send_message(receiver, message),
+                       lambda ack: self.on_message_sent(receiver, message, ack))
         self.message_entry.delete(0, tk.END)
-        # После отправки сообщения обновляем историю
-        self.request_history(receiver)
+
+    def on_message_sent(self, receiver, content, ack):
+        """The server stored our message: show it without reloading the history"""
+        if receiver == self.history_contact:
+            self.add_message_to_display({'sender': self.username, 'content': content, 'id': ack.get('id'),
+                                         'timestamp': ack.get('timestamp')})
 
     def send_file(self):
-        if not self.connected:
-            return
         selected = self.contacts_listbox.curselection()
         if not selected:
             messagebox.showerror("Error", "Please select a contact")
             return
         receiver = self.contacts_listbox.get(selected[0])
+        from tkinter import filedialog
         file_path = filedialog.askopenfilename()
         if not file_path:
             return
@@ -549,124 +934,24 @@ class ChatClient:
                         break
                     file_data += chunk
 
-            # Encode file data
-            encoded_data = base64.b64encode(file_data).decode('utf-8')
+            # Отправляем данные (сжатыми, если сервер согласился на это в hello);
+            # подтверждение придёт в on_file_sent
+            self.run_async(self.chat.send_file(receiver, os.path.basename(file_path), file_data),
+                           lambda confirmation: self.on_file_sent(confirmation, file_data))
             
-            # Send file data
-            data = {
-                'action': 'file',
-                'receiver': receiver,
-                'file_name': os.path.basename(file_path),
-                'file_data': encoded_data
-            }
-            
-            try:
-                # Отправляем данные
-                json_data = json.dumps(data, ensure_ascii=False).encode()
-                size_data = len(json_data).to_bytes(4, byteorder='big')
-                self.socket.send(size_data)
-                self.socket.send(json_data)
-                
-                # Сразу запрашиваем обновление истории у отправителя, не дожидаясь подтверждения
-                self.root.after(100, self.request_history, receiver) # Небольшая задержка, чтобы сервер успел обработать
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send file: {str(e)}")
-                if not self.connected:
-                    self.connect()
+            # Сразу запрашиваем обновление истории у отправителя, не дожидаясь подтверждения
+            self.root.after(100, self.request_history, receiver) # Небольшая задержка, чтобы сервер успел обработать
                 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send file: {str(e)}")
-            if not self.connected:
-                self.connect()
         finally:
             # Восстанавливаем кнопку в основном потоке через after
             self.root.after(100, lambda: self.send_file_btn.config(text="Send File", state='normal'))
 
-    def receive_messages(self):
-        """Receive messages from server"""
-        buffer = b""
-        # Define a fixed buffer size for initial reads, though the message size dictates total read
-        # receive_buffer_size = 4096 # This was implicit before, making it explicit might help debugging
-        while self.connected:
-            try:
-                # Ensure we have at least 4 bytes in the buffer to read the size
-                while len(buffer) < 4:
-                    packet = self.socket.recv(8192) # Read in chunks
-                    if not packet:
-                        print("Connection closed by server during size read")
-                        self.connected = False
-                        break
-                    buffer += packet
-                if not self.connected: break
-
-                # Read the message size from the first 4 bytes of the buffer
-                size = int.from_bytes(buffer[:4], byteorder='big')
-                # Remove the size bytes from the buffer
-                buffer = buffer[4:]
-
-                # print(f"Received message size: {size}") # Keep this for debugging if needed
-
-                if size > 1024 * 1024 * 10:  # Increased limit to 10MB for larger files, was 1MB
-                    print(f"Invalid or excessively large message size: {size}. Discarding buffer.")
-                    buffer = b"" # Discard buffer on excessively large size
-                    continue # Go back to start of while self.connected loop
-
-                # Ensure we have the complete message data in the buffer
-                message_data = b""
-                while len(message_data) < size:
-                    # Read the remaining required bytes for the message
-                    bytes_to_read = size - len(message_data)
-                    packet = self.socket.recv(min(bytes_to_read, 8192)) # Read in chunks
-                    if not packet:
-                        print("Connection closed by server during message data read")
-                        self.connected = False
-                        break
-                    message_data += packet
-                if not self.connected: break # Check again if connection closed during data read
-
-                # We now have exactly 'size' bytes for the message data
-                try:
-                    message = json.loads(message_data.decode())
-                    # print(f"Processing message: {message}") # Keep for debugging
-                    self.handle_message(message)
-                    # Buffer is already updated by slicing after size read
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error: {str(e)}. Discarding incomplete message.")
-                    # On decode error, discard the current message data but keep the rest of the buffer
-                    # buffer remains as is after slicing, ready for next potential message size header.
-                except Exception as e:
-                    print(f"Error processing message: {str(e)}")
-                    # Similar to JSON decode error, keep remaining buffer
-
-            except socket.error as e:
-                print(f"Socket error: {str(e)}")
-                self.connected = False
-                # Attempt to reconnect only if the error wasn't due to clean disconnect
-                # This part might need more sophisticated reconnection logic
-                try:
-                     print("Attempting to reconnect...")
-                     self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                     self.socket.connect((self.host, self.port))
-                     self.connected = True
-                     print("Reconnection successful.")
-                     # After successful reconnection, need to re-authenticate
-                     # This is a limitation of current design - re-login is manual.
-                     # A better approach would be to send login details automatically.
-                except Exception as reconnect_e:
-                     print(f"Reconnection failed: {str(reconnect_e)}")
-                     break # Exit thread if reconnection fails
-            except Exception as e:
-                print(f"Error in receive_messages loop: {str(e)}")
-                self.connected = False # Assume critical error, close connection
-
-        # Clean up socket when thread exits
-        try:
-            self.socket.close()
-            print("Socket closed.")
-        except Exception as close_e:
-            print(f"Error closing socket: {str(close_e)}")
-
+    def mark_read(self, contact):
+        """Tell the server everything in this conversation has been seen"""
+        self.request({'action': 'mark_read', 'contact_username': contact})
+            
     def load_contacts(self):
         """Load contact list"""
         print("Loading contacts...")
@@ -674,14 +959,7 @@ class ChatClient:
             'action': 'contacts',
             'contact_action': 'list'
         }
-        try:
-            json_data = json.dumps(message, ensure_ascii=False).encode()
-            size_data = len(json_data).to_bytes(4, byteorder='big')
-            self.socket.send(size_data)
-            self.socket.send(json_data)
-        except Exception as e:
-            print(f"Error loading contacts: {str(e)}")
-            messagebox.showerror("Error", f"Failed to load contacts: {str(e)}")
+        self.request(message)
 
     def on_contact_select(self, event):
         selected = self.contacts_listbox.curselection()
@@ -689,6 +967,7 @@ class ChatClient:
             return
         contact = self.contacts_listbox.get(selected[0])
         self.request_history(contact)
+        self.mark_read(contact)
         
     def _on_mousewheel(self, event):
         # Поддержка прокрутки для Windows и Mac
@@ -706,6 +985,10 @@ class ChatClient:
     def run(self):
         """Start the client"""
         self.root.mainloop()
+        try:
+            asyncio.run_coroutine_threadsafe(self.chat.close(), self.loop).result(5)
+        except Exception as e:
+            print(f"Error closing connection: {str(e)}")
 
     def update_chat_history(self, username, message, is_file=False, file_path=None):
         """Update chat history with new message"""
@@ -730,13 +1013,7 @@ class ChatClient:
         anchor = 'e' if is_self else 'w'
         box_width = self.chat_canvas.winfo_width() - 80 # Adjust box width based on canvas size
 
-        # Format the timestamp
-        try:
-            # Assuming timestamp is in ISO format from server
-            dt_object = datetime.fromisoformat(timestamp)
-            formatted_timestamp = dt_object.strftime("%H:%M")
-        except ValueError:
-            formatted_timestamp = timestamp # Use original if formatting fails
+        formatted_timestamp = format_timestamp(timestamp)
 
         # Формируем текст сообщения
         if file_path:
@@ -762,6 +1039,9 @@ class ChatClient:
 
         bbox = self.chat_canvas.bbox(text_id)
         if bbox:
+            preview_height = self.reserve_thumbnail(message, x, bbox[3] + 8, anchor)
+            if preview_height:
+                bbox = (bbox[0], bbox[1], bbox[2], bbox[3] + preview_height + 8)
             rect_id = self.chat_canvas.create_rectangle(
                 bbox[0]-16, bbox[1]-8,
                 bbox[2]+16, bbox[3]+8,
@@ -770,6 +1050,7 @@ class ChatClient:
                 width=2
             )
             self.chat_canvas.tag_lower(rect_id, text_id) # Draw rectangle behind text
+            self.chat_canvas.tag_raise('thumbnail')
 
             if file_path:
                  # Bind click handler to the text for files
@@ -785,5 +1066,24 @@ class ChatClient:
         self.chat_canvas.yview_moveto(1.0)
 
 if __name__ == '__main__':
-    client = ChatClient()
+    parser = argparse.ArgumentParser(description='Chat client')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--tls', action='store_true', help='connect over TLS')
+    parser.add_argument('--tls-ca', help='CA bundle or self-signed server certificate to trust')
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.chat-client', 'attachments'),
+                        help='where downloaded attachments are kept')
+    parser.add_argument('--cache-mb', type=int, default=256, help='disk budget of the attachment cache (0: no cache)')
+    parser.add_argument('--username', help='log in as this user at start; the password is read from CHAT_PASSWORD')
+    parser.add_argument('--state', default=os.path.join(os.path.expanduser('~'), '.chat-client', 'state.json'),
+                        help='where the last user and cached contact lists are kept')
+    parser.add_argument('--profile-startup', metavar='PATH',
+                        help='write startup milestones (ms) to PATH as JSON and quit once started')
+    args = parser.parse_args()
+    tls_context = tls.client_context(args.tls_ca) if args.tls or args.tls_ca else None
+    attachments = AttachmentCache(args.cache_dir, args.cache_mb * 2**20) if args.cache_mb else None
+    password = os.environ.get('CHAT_PASSWORD')
+    login = (args.username, password) if args.username and password else None
+    client = ChatClient(host=args.host, port=args.port, tls_context=tls_context, attachments=attachments,
+                        login=login, state=ClientState(args.state), profile_startup=args.profile_startup)
     client.run() 
\ No newline at end of file
@@ -0,0 +1,39 @@
+"""What the GUI client remembers between runs.
+
+The last user who logged in and each user's contact list, kept in one
+small JSON file. On the next start the client shows the cached list at
+once, while the real login is still on the wire; the server's list
+replaces it when it arrives.
+"""
+import json
+import os
+
+
+class ClientState:
+    def __init__(self, path):
+        self.path = path
+        self.data = {}  # {'username': последний вошедший, 'contacts': {username: [контакты]}}
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            pass  # первый запуск или файл испорчен: начинаем с пустого состояния
+
+    @property
+    def username(self):
+        return self.data.get('username')
+
+    def contacts(self, username):
+        return list(self.data.get('contacts', {}).get(username, []))
+
+    def save(self, username, contacts):
+        self.data['username'] = username
+        self.data.setdefault('contacts', {})[username] = list(contacts)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Пишем во временный файл и подменяем: после сбоя остаётся старый или новый
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(temporary, self.path)
@@ -0,0 +1,264 @@
+"""Per-frame compression for the chat protocol.
+
+A compressed frame sets the top bit of the 4-byte length prefix; the
+payload then starts with one codec byte followed by the compressed JSON.
+Uncompressed frames are unchanged, so peers that never negotiated
+compression keep working. zstd is used when the optional `zstandard`
+package is installed, zlib otherwise.
+
+Train a shared dictionary from an existing database (or synthetic
+frames when no database is given):
+
+    python compression.py train --output chat.dict --db chat.db
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import sqlite3
+from datetime import datetime, timezone
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен
+    zstandard = None
+
+COMPRESSED_FLAG = 0x80000000
+DICT_FLAG = 0x80
+
+CODEC_IDS = {'zlib': 1, 'zstd': 2}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+DEFAULT_THRESHOLD = 1024
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3}
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+_zstd_decompressors = {}
+
+
+def available_codecs():
+    """Codec names supported by this process, best first"""
+    return ['zstd', 'zlib'] if zstandard else ['zlib']
+
+
+def dictionary_id(dictionary):
+    return zlib.crc32(dictionary) if dictionary else None
+
+
+def load_dictionary(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FrameCodec:
+    """Compresses outgoing frame payloads for one negotiated connection"""
+
+    def __init__(self, name='zlib', threshold=DEFAULT_THRESHOLD, level=None, dictionary=None):
+        if name not in available_codecs():
+            raise ValueError(f'Unsupported codec: {name}')
+        self.name = name
+        self.threshold = threshold
+        self.level = DEFAULT_LEVELS[name] if level is None else level
+        self.dictionary = dictionary
+        self._zstd_compressor = None
+        if name == 'zstd':
+            zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._zstd_compressor = zstandard.ZstdCompressor(level=self.level, dict_data=zdict)
+
+    def compress(self, data):
+        if self.name == 'zstd':
+            return self._zstd_compressor.compress(data)
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def encode(self, data):
+        """Return a complete wire frame for the JSON payload `data`"""
+        if len(data) >= self.threshold:
+            body = self.compress(data)
+            # Сжимаем только если это действительно выгодно
+            if len(body) + 1 < len(data):
+                codec = CODEC_IDS[self.name] | (DICT_FLAG if self.dictionary else 0)
+                body = bytes([codec]) + body
+                return (len(body) | COMPRESSED_FLAG).to_bytes(4, byteorder='big') + body
+        return len(data).to_bytes(4, byteorder='big') + data
+
+
+class DecompressedTooLarge(ValueError):
+    """A compressed frame expands beyond the size the caller allows"""
+
+
+def decompress(body, dictionary=None, max_size=None):
+    """Decode the payload of a frame that had COMPRESSED_FLAG set.
+
+    With max_size set, stops and raises DecompressedTooLarge as soon as the
+    output would exceed it, so a small frame cannot expand into gigabytes.
+    """
+    codec = body[0]
+    name = CODEC_NAMES.get(codec & ~DICT_FLAG)
+    if name is None:
+        raise ValueError(f'Unknown codec id: {codec}')
+    if codec & DICT_FLAG and not dictionary:
+        raise ValueError('Frame was compressed with a dictionary we do not have')
+    data = memoryview(body)[1:]
+    if name == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd frame received but zstandard is not installed')
+        key = dictionary_id(dictionary) if codec & DICT_FLAG else None
+        decompressor = _zstd_decompressors.get(key)
+        if decompressor is None:
+            # Загрузка словаря дорогая, поэтому декомпрессоры переиспользуем
+            zdict = zstandard.ZstdCompressionDict(dictionary) if key is not None else None
+            decompressor = _zstd_decompressors[key] = zstandard.ZstdDecompressor(dict_data=zdict)
+        if max_size is None:
+            return decompressor.decompress(data)
+        # Размер из заголовка zstd не доверяем: читаем потоком не больше лимита
+        with decompressor.stream_reader(data) as stream:
+            result = stream.read(max_size + 1)
+        if len(result) > max_size:
+            raise DecompressedTooLarge(f'Decompressed frame exceeds {max_size} bytes')
+        return result
+    if codec & DICT_FLAG:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj()
+    if max_size is None:
+        return decompressor.decompress(data) + decompressor.flush()
+    result = decompressor.decompress(data, max_size + 1)
+    if len(result) > max_size:
+        raise DecompressedTooLarge(f'Decompressed frame exceeds {max_size} bytes')
+    return result + decompressor.flush()
+
+
+def negotiate(offer, threshold=DEFAULT_THRESHOLD, dictionary=None):
+    """Pick a codec from a client's `hello` offer; returns (codec, reply)"""
+    offered = offer.get('compression') or []
+    chosen = next((name for name in offered if name in available_codecs()), None)
+    use_dictionary = bool(dictionary) and offer.get('dictionary_id') == dictionary_id(dictionary)
+    reply = {
+        'action': 'hello',
+        'status': 'success',
+        'compression': chosen,
+        'threshold': threshold,
+        'dictionary_id': dictionary_id(dictionary) if chosen and use_dictionary else None,
+    }
+    if not chosen:
+        return None, reply
+    return FrameCodec(chosen, threshold, dictionary=dictionary if use_dictionary else None), reply
+
+
+def hello(dictionary=None, codecs=None):
+    """Build the `hello` request a client sends right after connecting"""
+    return {
+        'action': 'hello',
+        'compression': codecs or available_codecs(),
+        'dictionary_id': dictionary_id(dictionary),
+    }
+
+
+TOKEN_PATTERN = re.compile(rb'"[A-Za-z_]{1,32}": ?(?:"[^"\\]{0,48}"|-?\d+|true|false|null)?')
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    """Build a shared dictionary from typical frames"""
+    samples = [s for s in samples if s]
+    if zstandard and len(samples) >= 8:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass
+    # zlib: самые частые фрагменты идут в конец словаря, там они дешевле всего
+    counts = Counter()
+    for sample in samples:
+        counts.update(TOKEN_PATTERN.findall(sample))
+    chunks = []
+    total = 0
+    for token, _ in counts.most_common():
+        if total + len(token) > size:
+            break
+        chunks.append(token)
+        total += len(token)
+    return b''.join(reversed(chunks))
+
+
+def synthetic_frames(count=500, seed=7):
+    """Frames shaped like real traffic, for training and benchmarks"""
+    rng = random.Random(seed)
+    words = ['hello', 'привет', 'ok', 'see you', 'when', 'tomorrow', 'file', 'sent', 'thanks', 'lol',
+             'meeting', 'at', 'the', 'server', 'is', 'down', 'again', 'как дела', 'норм']
+    users = [f'user{i}' for i in range(50)]
+    frames = []
+    for _ in range(count):
+        kind = rng.random()
+        a, b = rng.sample(users, 2)
+        if kind < 0.5:
+            message = {'action': 'message', 'sender': a, 'receiver': b,
+                       'content': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 12))),
+                       'timestamp': f'2024-05-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:'
+                                    f'{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}.{rng.randint(0, 999999):06d}'}
+        elif kind < 0.8:
+            message = {'status': 'success', 'action': 'history', 'messages': [
+                {'sender': rng.choice([a, b]), 'content': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 12))),
+                 'file_path': None, 'timestamp': f'2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:'
+                                                  f'{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}'}
+                for _ in range(rng.randint(1, 20))]}
+        else:
+            message = {'status': 'success', 'action': 'contacts', 'contacts': rng.sample(users, rng.randint(1, 15))}
+        frames.append(json.dumps(message, ensure_ascii=False).encode())
+    return frames
+
+
+def frames_from_database(path, shard_dir='shards', limit=5000):
+    """History-like frames built from a chat.db and its message shards"""
+    conn = sqlite3.connect(path)
+    try:
+        names = dict(conn.execute('SELECT id, username FROM users').fetchall())
+    finally:
+        conn.close()
+    rows = []
+    for shard in sorted(glob.glob(os.path.join(shard_dir, 'messages-*.db'))):
+        conn = sqlite3.connect(shard)
+        try:
+            rows.extend((names.get(r[0]),) + r[1:] for r in conn.execute('''
+                SELECT sender_id, content, file_path, sent_at, id
+                FROM messages ORDER BY id DESC LIMIT ?
+            ''', (limit,)))
+        finally:
+            conn.close()
+    rows = rows[:limit]
+    frames = []
+    for i in range(0, len(rows), 20):
+        # В базе время хранится в миллисекундах, а по сети идёт строкой ISO - обучаемся на сетевом виде
+        messages = [{'id': r[4], 'sender': r[0], 'content': r[1], 'file_path': r[2],
+                     'timestamp': datetime.fromtimestamp(r[3] / 1000, timezone.utc).isoformat(timespec='milliseconds')
+                     if isinstance(r[3], int) else r[3]} for r in rows[i:i + 20]]
+        frames.append(json.dumps({'status': 'success', 'action': 'history', 'messages': messages},
+                                 ensure_ascii=False).encode())
+    return frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat protocol compression utilities')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train = subparsers.add_parser('train', help='train a shared compression dictionary')
+    train.add_argument('--output', required=True)
+    train.add_argument('--db', help='chat.db to sample frames from (default: synthetic frames)')
+    train.add_argument('--shard-dir', default='shards', help='message shards that belong to --db')
+    train.add_argument('--size', type=int, default=MAX_DICTIONARY_SIZE)
+    args = parser.parse_args(argv)
+
+    samples = frames_from_database(args.db, args.shard_dir) if args.db else synthetic_frames()
+    dictionary = train_dictionary(samples, args.size)
+    with open(args.output, 'wb') as f:
+        f.write(dictionary)
+    print(f'Wrote {len(dictionary)} byte dictionary (id {dictionary_id(dictionary)}) to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
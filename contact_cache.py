@@ -0,0 +1,108 @@
+import threading
+
+
+class ContactCache:
+    """In-memory contact graph for logged-in users, with presence.
+
+    A user's contact list is loaded from the database when their first
+    session logs in and dropped when their last session goes away. A
+    reverse index (who has this user as a contact) tells which sessions
+    care about a presence change. Every change sent to a user bumps that
+    user's version, so a client that misses a delta can notice the gap and
+    ask for the full list again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contacts = {}  # {username: set(contact usernames)}
+        self.watchers = {}  # {username: set(loaded users that have username as a contact)}
+        self.sessions = {}  # {username: number of live sessions}
+        self.versions = {}  # {username: version of the contact list sent to that user}
+
+    def load(self, username, loader):
+        """Make sure username's contacts are cached; loader() reads them from the database"""
+        with self.lock:
+            if username in self.contacts:
+                return
+        contacts = set(loader())
+        with self.lock:
+            if username in self.contacts:
+                return
+            self.contacts[username] = contacts
+            self.versions.setdefault(username, 0)
+            for contact in contacts:
+                self.watchers.setdefault(contact, set()).add(username)
+
+    def _unload(self, username):
+        for contact in self.contacts.pop(username, ()):
+            watchers = self.watchers.get(contact)
+            if watchers is not None:
+                watchers.discard(username)
+                if not watchers:
+                    del self.watchers[contact]
+
+    def is_online(self, username):
+        return self.sessions.get(username, 0) > 0
+
+    def snapshot(self, username):
+        """Return (contacts, presence, version) for a full list response"""
+        with self.lock:
+            contacts = sorted(self.contacts.get(username, ()))
+            presence = {contact: self.is_online(contact) for contact in contacts}
+            return contacts, presence, self.versions.get(username, 0)
+
+    def _bump(self, username, added=(), removed=(), presence=None):
+        version = self.versions.get(username, 0) + 1
+        self.versions[username] = version
+        return {
+            'action': 'contacts_delta',
+            'version': version,
+            'added': list(added),
+            'removed': list(removed),
+            'presence': presence or {},
+        }
+
+    def session_opened(self, username):
+        """Register a login; returns {watcher: delta} when the user just came online"""
+        with self.lock:
+            self.sessions[username] = self.sessions.get(username, 0) + 1
+            if self.sessions[username] != 1:
+                return {}
+            return {watcher: self._bump(watcher, presence={username: True})
+                    for watcher in self.watchers.get(username, ())}
+
+    def session_closed(self, username):
+        """Register a disconnect; returns {watcher: delta} when the user just went offline"""
+        with self.lock:
+            count = self.sessions.get(username, 0) - 1
+            if count > 0:
+                self.sessions[username] = count
+                return {}
+            self.sessions.pop(username, None)
+            self._unload(username)
+            self.versions.pop(username, None)
+            return {watcher: self._bump(watcher, presence={username: False})
+                    for watcher in self.watchers.get(username, ())}
+
+    def add(self, username, contact):
+        """Record a new contact; returns the delta for username, or None if nothing changed"""
+        with self.lock:
+            contacts = self.contacts.get(username)
+            if contacts is None or contact in contacts:
+                return None
+            contacts.add(contact)
+            self.watchers.setdefault(contact, set()).add(username)
+            return self._bump(username, added=[contact], presence={contact: self.is_online(contact)})
+
+    def remove(self, username, contact):
+        with self.lock:
+            contacts = self.contacts.get(username)
+            if contacts is None or contact not in contacts:
+                return None
+            contacts.discard(contact)
+            watchers = self.watchers.get(contact)
+            if watchers is not None:
+                watchers.discard(username)
+                if not watchers:
+                    del self.watchers[contact]
+            return self._bump(username, removed=[contact])
@@ -0,0 +1,86 @@
+"""Graceful restart: hand the listening socket to a new server process.
+
+The old process starts its successor with the listening socket and the
+read end of a pipe as inherited file descriptors. The successor loads
+everything that does not touch the data files and then blocks on the
+pipe. The old process stops accepting, tells every session when to come
+back, drains, closes its storage and exits. The pipe reaches EOF and the
+successor opens the storage and starts accepting. The listening socket
+never closes, so connections made in between wait in the kernel backlog
+instead of being refused. POSIX only.
+
+    kill -HUP <server pid>
+"""
+import os
+import random
+import socket
+import subprocess
+import sys
+
+LISTEN_BACKLOG = 128  # Во время перезапуска переподключения копятся в очереди ядра
+HANDOFF_ARGS = ('--listen-fd', '--handoff-fd')
+
+
+def listening_socket(host, port, fd=None):
+    """Bind a new listening socket, or adopt the one inherited from the previous process"""
+    if fd is not None:
+        sock = socket.socket(fileno=fd)
+        sock.listen(LISTEN_BACKLOG)
+        return sock
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+def successor_argv(argv):
+    """Command line of the next process: the current one without previous handoff arguments"""
+    cleaned = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in HANDOFF_ARGS:
+            skip = True
+        elif not arg.startswith(tuple(name + '=' for name in HANDOFF_ARGS)):
+            cleaned.append(arg)
+    return cleaned
+
+
+def spawn_successor(server_socket, script, argv):
+    """Start the next server process; returns (process, release_fd).
+
+    The successor waits until release_fd is closed, so the caller closes
+    it once its storage is flushed and closed.
+    """
+    listen_fd = server_socket.fileno()
+    ready_read, release_fd = os.pipe()
+    os.set_inheritable(listen_fd, True)
+    os.set_inheritable(ready_read, True)
+    command = [sys.executable, script] + successor_argv(argv) + [
+        '--listen-fd', str(listen_fd), '--handoff-fd', str(ready_read)]
+    try:
+        # Своя сессия: сигналы терминала старому процессу не задевают нового
+        process = subprocess.Popen(command, pass_fds=(listen_fd, ready_read), start_new_session=True)
+    except Exception:
+        os.close(release_fd)
+        raise
+    finally:
+        os.close(ready_read)
+    return process, release_fd
+
+
+def wait_for_predecessor(fd):
+    """Block until the previous process has released its data files (or died)"""
+    try:
+        while os.read(fd, 1):
+            pass
+    finally:
+        os.close(fd)
+
+
+def reconnect_delay(spread, minimum=0.5):
+    """Seconds a client should wait before reconnecting; spread out so logins do not arrive at once"""
+    return round(random.uniform(minimum, max(minimum, spread)), 2)
@@ -0,0 +1,104 @@
+import math
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+
+class TimerWheel:
+    """Hashed timing wheel: O(1) schedule/cancel, expiry checked per tick.
+
+    Each key has at most one pending timer; scheduling a key again moves it.
+    Delays longer than one revolution are kept in their slot with a count of
+    remaining rounds.
+    """
+
+    def __init__(self, tick=1.0, slots=64, clock=time.monotonic):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.position = 0
+        self.last_tick = clock()
+        self.locations = {}  # {key: slot index}
+
+    def schedule(self, key, delay):
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            self._remove(key)
+            index = (self.position + ticks) % len(self.slots)
+            # rounds: сколько полных оборотов колеса ждать до срабатывания
+            self.slots[index][key] = (ticks - 1) // len(self.slots)
+            self.locations[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        index = self.locations.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def advance(self):
+        """Move the wheel up to now and return the keys whose timers fired"""
+        expired = []
+        now = self.clock()
+        with self.lock:
+            while now - self.last_tick >= self.tick:
+                self.last_tick += self.tick
+                self.position = (self.position + 1) % len(self.slots)
+                slot = self.slots[self.position]
+                for key, rounds in list(slot.items()):
+                    if rounds:
+                        slot[key] = rounds - 1
+                    else:
+                        del slot[key]
+                        del self.locations[key]
+                        expired.append(key)
+        return expired
+
+
+def set_keepalive(sock, idle=60, interval=10, count=5):
+    """Enable TCP keepalive so the OS notices half-open peers"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+    elif sys.platform == 'darwin':
+        # На macOS TCP_KEEPALIVE (0x10) задаёт то же, что TCP_KEEPIDLE в Linux
+        sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPALIVE', 0x10), int(idle))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(interval))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(count))
+    if sys.platform == 'win32' and hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle * 1000), int(interval * 1000)))
+
+
+def set_send_timeout(sock, seconds):
+    """Make blocking sends give up instead of hanging on a peer that stopped reading.
+
+    Unlike settimeout() this only affects writes, so the connection's reader
+    thread can keep blocking in recv().
+    """
+    if sys.platform == 'win32':
+        value = struct.pack('L', int(seconds * 1000))
+    else:
+        whole = int(seconds)
+        value = struct.pack('ll', whole, int((seconds - whole) * 1_000_000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+
+def can_send(sock):
+    """True if a small write to sock would not block right now"""
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(0))
+    # На Windows нет poll; select там не ограничен FD_SETSIZE по номерам сокетов
+    return bool(select.select([], [sock], [], 0)[1])
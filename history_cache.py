@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+
+
+class HistoryCache:
+    """LRU cache of ready-to-send history frames, bounded by total bytes.
+
+    Entries are keyed by (user, contact, before, limit, codec), so a hit is
+    written to the socket as is: no storage read, no JSON encoding, no
+    compression. Every new message in a conversation drops all of its
+    pages. A read that started before such an insert gets a ticket that the
+    insert marks stale, so its result is sent but never cached.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        # Одна огромная история (без limit) не должна вытеснить весь кэш
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 16
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: frame bytes}, от давно использованных к недавним
+        self.by_conversation = {}  # {conversation: set(keys)}
+        self.tickets = {}  # {conversation: set(tickets)} - чтения, идущие прямо сейчас
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def conversation(user_a, user_b):
+        return tuple(sorted((user_a, user_b)))
+
+    def get(self, key):
+        with self.lock:
+            frame = self.entries.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def reserve(self, conversation):
+        """Call before reading from storage; pass the ticket to put() or release()"""
+        ticket = (conversation, object())
+        with self.lock:
+            self.tickets.setdefault(conversation, set()).add(ticket[1])
+        return ticket
+
+    def put(self, key, ticket, frame):
+        """Cache frame unless the conversation changed since reserve(); returns whether it was kept"""
+        with self.lock:
+            if not self._take(ticket) or len(frame) > self.max_entry_bytes:
+                return False
+            self._remove(key)
+            self.entries[key] = frame
+            self.by_conversation.setdefault(ticket[0], set()).add(key)
+            self.bytes += len(frame)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+            return True
+
+    def release(self, ticket):
+        """Forget a ticket whose read failed"""
+        with self.lock:
+            self._take(ticket)
+
+    def invalidate(self, user_a, user_b):
+        """A message was stored in this conversation: drop its pages and spoil running reads"""
+        conversation = self.conversation(user_a, user_b)
+        with self.lock:
+            # Билеты идущих чтений пропадают: put() их не найдёт и ничего не закэширует
+            self.tickets.pop(conversation, None)
+            keys = self.by_conversation.pop(conversation, ())
+            for key in keys:
+                self.bytes -= len(self.entries.pop(key))
+            if keys:
+                self.invalidations += 1
+
+    def _take(self, ticket):
+        conversation, token = ticket
+        pending = self.tickets.get(conversation)
+        if pending is None or token not in pending:
+            return False
+        pending.discard(token)
+        if not pending:
+            del self.tickets[conversation]
+        return True
+
+    def _remove(self, key):
+        frame = self.entries.pop(key, None)
+        if frame is None:
+            return
+        self.bytes -= len(frame)
+        conversation = self.conversation(key[0], key[1])
+        keys = self.by_conversation.get(conversation)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_conversation[conversation]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
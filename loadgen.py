@@ -0,0 +1,616 @@
+"""Headless load generator for ChatServer.
+
+Simulates many users speaking the real wire protocol (register, login,
+contacts, chat, history, file transfer) and writes latency percentiles,
+throughput and server resource usage as JSON so runs can be compared
+across commits:
+
+    python loadgen.py run --scenario chat --output before.json
+    python loadgen.py compare before.json after.json
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import queue
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import compression
+import tls
+from protocol import FrameReader, encode_frame
+
+SEND_STAMP = re.compile(r'lg (\d+)')
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# Готовые профили нагрузки; любой параметр можно переопределить флагом
+SCENARIOS = {
+    'smoke': {'users': 20, 'contacts': 3, 'duration': 10, 'message_rate': 1.0,
+              'history_rate': 0.2, 'file_rate': 0.05, 'file_size': 16 * 1024, 'inbox_rate': 0.1},
+    'chat': {'users': 500, 'contacts': 10, 'duration': 60, 'message_rate': 0.5,
+             'history_rate': 0.05, 'file_rate': 0.0, 'file_size': 0, 'inbox_rate': 0.05},
+    'history': {'users': 200, 'contacts': 5, 'duration': 60, 'message_rate': 0.2,
+                'history_rate': 1.0, 'file_rate': 0.0, 'file_size': 0, 'inbox_rate': 0.0},
+    'files': {'users': 100, 'contacts': 5, 'duration': 60, 'message_rate': 0.1,
+              'history_rate': 0.05, 'file_rate': 0.2, 'file_size': 512 * 1024, 'inbox_rate': 0.0},
+}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+
+class Stats:
+    """Thread-safe latency and error collector keyed by action"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, action, latency_ms):
+        with self.lock:
+            self.latencies.setdefault(action, []).append(latency_ms)
+
+    def error(self, action, reason):
+        with self.lock:
+            bucket = self.errors.setdefault(action, {})
+            bucket[reason] = bucket.get(reason, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return ({k: list(v) for k, v in self.latencies.items()},
+                    {k: dict(v) for k, v in self.errors.items()})
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.errors = {}
+
+
+def summarize(latencies, errors, elapsed):
+    actions = {}
+    for action in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(action, []))
+        actions[action] = {
+            'count': len(values),
+            'errors': sum(errors.get(action, {}).values()),
+            'error_reasons': errors.get(action, {}),
+            'throughput_per_s': len(values) / elapsed if elapsed > 0 else None,
+            'mean_ms': sum(values) / len(values) if values else None,
+            'p50_ms': percentile(values, 0.50),
+            'p99_ms': percentile(values, 0.99),
+            'p999_ms': percentile(values, 0.999),
+            'max_ms': values[-1] if values else None,
+        }
+    return actions
+
+
+class ProcessSampler:
+    """Samples RSS, CPU time, threads and open fds of a process from /proc"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def available(self):
+        return os.path.exists(f'/proc/{self.pid}/stat')
+
+    def read(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / self.clock_ticks
+            rss_kb = threads = None
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss_kb = int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        threads = int(line.split()[1])
+            fds = len(os.listdir(f'/proc/{self.pid}/fd'))
+            return {'t': time.monotonic(), 'cpu_s': cpu, 'rss_kb': rss_kb, 'threads': threads, 'fds': fds}
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def start(self):
+        if self.available():
+            self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            sample = self.read()
+            if sample:
+                self.samples.append(sample)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def summary(self, since=None):
+        samples = [s for s in self.samples if since is None or s['t'] >= since]
+        if len(samples) < 2:
+            return None
+        elapsed = samples[-1]['t'] - samples[0]['t']
+        cpu = samples[-1]['cpu_s'] - samples[0]['cpu_s']
+        rss = [s['rss_kb'] for s in samples if s['rss_kb'] is not None]
+        return {
+            'cpu_seconds': cpu,
+            'cpu_percent': 100.0 * cpu / elapsed if elapsed > 0 else None,
+            'rss_mb_peak': max(rss) / 1024 if rss else None,
+            'rss_mb_mean': sum(rss) / len(rss) / 1024 if rss else None,
+            'rss_mb_final': rss[-1] / 1024 if rss else None,
+            'threads_peak': max(s['threads'] or 0 for s in samples),
+            'fds_peak': max(s['fds'] for s in samples),
+        }
+
+
+class LoadClient:
+    """One simulated user: a socket, a reader thread and a response queue"""
+
+    def __init__(self, host, port, username, stats, timeout, codecs=None, dictionary=None, tls_context=None):
+        self.username = username
+        self.password = f'pw-{username}'
+        self.stats = stats
+        self.timeout = timeout
+        self.contacts = []
+        self.send_lock = threading.Lock()
+        self.responses = queue.Queue()
+        self.dictionary = dictionary
+        self.codec = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if tls_context:
+            self.sock = tls_context.wrap_socket(self.sock, server_hostname=host)
+        self.sock.settimeout(None)
+        self.reader = threading.Thread(target=self._receive, daemon=True)
+        self.reader.start()
+        if codecs:
+            self.negotiate(codecs)
+
+    def _receive(self):
+        reader = FrameReader(self.dictionary)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+                reader.feed(data)
+                for message in reader.frames():
+                    self._dispatch(message)
+        except (OSError, ValueError):
+            pass
+        self.responses.put(None)
+
+    def _dispatch(self, message):
+        if message.get('action') == 'ping':
+            try:
+                self.send({'action': 'pong'})
+            except OSError:
+                pass
+            return
+        if message.get('action') == 'message' and 'sender' in message:
+            # Входящее сообщение: в content зашито время отправки
+            match = SEND_STAMP.search(message.get('content') or '')
+            if match:
+                latency_ms = (time.perf_counter_ns() - int(match.group(1))) / 1e6
+                kind = 'file_delivery' if message.get('is_file') else 'message_delivery'
+                self.stats.record(kind, latency_ms)
+            return
+        self.responses.put(message)
+
+    def send(self, message, framed=True):
+        data = encode_frame(message, self.codec) if framed else json.dumps(message, ensure_ascii=False).encode()
+        with self.send_lock:
+            self.sock.sendall(data)
+            self.bytes_sent += len(data)
+
+    def request(self, name, message, expect):
+        """Send a request and time it until the matching response arrives"""
+        started = time.perf_counter()
+        try:
+            self.send(message)
+        except OSError as e:
+            self.stats.error(name, type(e).__name__)
+            return None
+        deadline = started + self.timeout
+        while True:
+            try:
+                response = self.responses.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                self.stats.error(name, 'timeout')
+                return None
+            if response is None:
+                self.stats.error(name, 'disconnected')
+                return None
+            if response.get('action') != expect:
+                continue
+            latency_ms = (time.perf_counter() - started) * 1000
+            if response.get('status') == 'error':
+                self.stats.error(name, response.get('message', 'error'))
+            else:
+                self.stats.record(name, latency_ms)
+            return response
+
+    def negotiate(self, codecs):
+        response = self.request('hello', compression.hello(self.dictionary, codecs), 'hello')
+        if response and response.get('compression'):
+            use_dictionary = response.get('dictionary_id') is not None
+            self.codec = compression.FrameCodec(response['compression'], response['threshold'],
+                                                dictionary=self.dictionary if use_dictionary else None)
+
+    def register(self):
+        return self.retrying('register', {'action': 'register', 'username': self.username,
+                                          'password': self.password}, 'register')
+
+    def login(self):
+        return self.retrying('login', {'action': 'login', 'username': self.username,
+                                       'password': self.password}, 'login')
+
+    def retrying(self, name, message, expect, attempts=10):
+        """Like request(), but wait and repeat while the server answers with retry_after"""
+        for _ in range(attempts):
+            response = self.request(name, message, expect)
+            if not response or not response.get('retry_after'):
+                return response
+            time.sleep(response['retry_after'] * random.uniform(1.0, 1.5))
+        return response
+
+    def add_contact(self, contact):
+        response = self.request('contacts_add', {'action': 'contacts', 'contact_action': 'add',
+                                                 'contact_username': contact}, 'contacts')
+        if response and response.get('status') == 'success':
+            self.contacts.append(contact)
+
+    def list_contacts(self):
+        return self.request('contacts_list', {'action': 'contacts', 'contact_action': 'list'}, 'contacts')
+
+    def history(self, contact):
+        # Как GUI: вся переписка потоком, время - до маркера конца
+        response = self.request('history', {'action': 'contacts', 'contact_action': 'history',
+                                            'contact_username': contact, 'stream': True}, 'history_end')
+        # Как и GUI: открыли чат - отметили прочитанным
+        self.request('mark_read', {'action': 'mark_read', 'contact_username': contact}, 'mark_read')
+        return response
+
+    def inbox(self):
+        return self.request('conversations', {'action': 'conversations', 'limit': 50}, 'conversations')
+
+    def message(self, contact, size):
+        started = time.perf_counter_ns()
+        content = f'lg {started} ' + 'x' * max(0, size)
+        try:
+            # Сервер не подтверждает сообщения: здесь только стоимость отправки,
+            # сквозная задержка считается у получателя (message_delivery)
+            self.send({'action': 'message', 'receiver': contact, 'content': content})
+            self.stats.record('message_send', (time.perf_counter_ns() - started) / 1e6)
+        except OSError as e:
+            self.stats.error('message_send', type(e).__name__)
+
+    def file(self, contact, payload):
+        return self.request('file', {'action': 'file', 'receiver': contact,
+                                     'file_name': f'lg {time.perf_counter_ns()} load.bin',
+                                     'file_data': payload}, 'file')
+
+    def close(self):
+        try:
+            # shutdown будит поток чтения и сразу отправляет FIN; close() при висящем recv() этого не делает
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def run_parallel(clients, func, workers):
+    """Run func(client) for every client with a bounded number of threads"""
+    pending = queue.Queue()
+    for client in clients:
+        pending.put(client)
+
+    def worker():
+        while True:
+            try:
+                client = pending.get_nowait()
+            except queue.Empty:
+                return
+            func(client)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(workers, len(clients)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def user_loop(client, args, deadline, file_payload):
+    rates = [('message', args.message_rate), ('history', args.history_rate), ('file', args.file_rate),
+             ('inbox', args.inbox_rate)]
+    rates = [(name, rate) for name, rate in rates if rate > 0]
+    total = sum(rate for _, rate in rates)
+    if not total or not client.contacts:
+        return
+    rng = random.Random(client.username)
+    while True:
+        # Пуассоновский поток запросов с суммарной интенсивностью total
+        wait = rng.expovariate(total)
+        if time.monotonic() + wait >= deadline:
+            return
+        time.sleep(wait)
+        pick = rng.uniform(0, total)
+        for name, rate in rates:
+            pick -= rate
+            if pick <= 0:
+                break
+        contact = rng.choice(client.contacts)
+        if name == 'message':
+            client.message(contact, args.message_size)
+        elif name == 'history':
+            client.history(contact)
+        elif name == 'inbox':
+            client.inbox()
+        else:
+            client.file(contact, file_payload)
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(SERVER_SCRIPT),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def log(message):
+    print(f'[loadgen] {message}', file=sys.stderr, flush=True)
+
+
+def run(args):
+    stats = Stats()
+    server_process = None
+    workdir = None
+    host, port = args.host, args.port
+    tls_context = None
+    if args.spawn:
+        # Свежий сервер в пустом каталоге: своя chat.db, files/ и server.log
+        workdir = tempfile.mkdtemp(prefix='chat-loadgen-')
+        port = port or free_port()
+        server_args = list(args.server_arg)
+        if args.tls:
+            cert, key = tls.generate_test_certificate(os.path.join(workdir, 'server.crt'),
+                                                      os.path.join(workdir, 'server.key'))
+            server_args += ['--tls-cert', cert, '--tls-key', key]
+            tls_context = tls.client_context(cafile=cert)
+        server_process = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, '--host', host, '--port', str(port)] + server_args,
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not wait_for_port(host, port, 30):
+            server_process.kill()
+            raise SystemExit('server did not start listening')
+        log(f'spawned server pid={server_process.pid} port={port} in {workdir}')
+    elif args.tls:
+        tls_context = tls.client_context(cafile=args.tls_ca)
+    server_pid = server_process.pid if server_process else args.server_pid
+    sampler = ProcessSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+
+    codecs = {'off': None, 'auto': compression.available_codecs()}.get(args.compression, [args.compression])
+    dictionary = compression.load_dictionary(args.compression_dict) if args.compression_dict else None
+    run_id = f'{os.getpid()}-{int(time.time())}'
+    clients = []
+    phases = {}
+    try:
+        started = time.monotonic()
+        for i in range(args.users):
+            clients.append(LoadClient(host, port, f'lg{run_id}u{i}', stats, args.timeout, codecs, dictionary,
+                                      tls_context))
+        phases['connect_s'] = time.monotonic() - started
+
+        for phase, func in (('register', LoadClient.register), ('login', LoadClient.login)):
+            started = time.monotonic()
+            run_parallel(clients, func, args.setup_concurrency)
+            phases[f'{phase}_s'] = time.monotonic() - started
+            log(f'{phase}: {len(clients)} users in {phases[phase + "_s"]:.1f}s')
+
+        started = time.monotonic()
+        rng = random.Random(args.seed)
+        names = [c.username for c in clients]
+
+        def add_contacts(client):
+            peers = rng.sample([n for n in names if n != client.username], min(args.contacts, len(names) - 1))
+            for peer in peers:
+                client.add_contact(peer)
+            client.list_contacts()
+
+        run_parallel(clients, add_contacts, args.setup_concurrency)
+        phases['contacts_s'] = time.monotonic() - started
+
+        file_payload = base64.b64encode(os.urandom(args.file_size)).decode() if args.file_rate > 0 else ''
+        setup_latencies, setup_errors = stats.snapshot()
+        stats.reset()
+        log(f'steady state for {args.duration}s')
+        bytes_before = sum(c.bytes_sent for c in clients), sum(c.bytes_received for c in clients)
+        steady_started = time.monotonic()
+        deadline = steady_started + args.duration
+        threads = [threading.Thread(target=user_loop, args=(c, args, deadline, file_payload), daemon=True)
+                   for c in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Даём доставкам, которые ещё в пути, дойти до получателей
+        time.sleep(min(2.0, args.timeout))
+        steady_elapsed = time.monotonic() - steady_started
+        latencies, errors = stats.snapshot()
+        wire = {'bytes_sent': sum(c.bytes_sent for c in clients) - bytes_before[0],
+                'bytes_received': sum(c.bytes_received for c in clients) - bytes_before[1]}
+        # Счётчики самого сервера (кэш истории и т.п.); отвечает только на loopback
+        metrics = clients[0].request('server_stats', {'action': 'stats'}, 'stats') if clients else None
+    finally:
+        for client in clients:
+            client.close()
+        if sampler:
+            sampler.stop()
+        if server_process:
+            server_process.terminate()
+            try:
+                server_process.wait(10)
+            except subprocess.TimeoutExpired:
+                server_process.kill()
+
+    steady = summarize(latencies, errors, args.duration)
+    total_ops = sum(v['count'] for k, v in steady.items() if not k.endswith('_delivery'))
+    return {
+        'meta': {
+            'tool': 'loadgen',
+            'started_at': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {k: v for k, v in vars(args).items() if k != 'func'},
+        },
+        'setup': {'phases_s': phases, 'actions': summarize(setup_latencies, setup_errors, sum(phases.values()))},
+        'steady': {
+            'duration_s': steady_elapsed,
+            'total_ops': total_ops,
+            'throughput_ops_s': total_ops / args.duration if args.duration else None,
+            'wire': wire,
+            'actions': steady,
+        },
+        'server': {
+            'pid': server_pid,
+            'whole_run': sampler.summary() if sampler else None,
+            'steady': sampler.summary(since=steady_started) if sampler else None,
+            'metrics': {k: v for k, v in metrics.items() if k not in ('status', 'action')}
+            if metrics and metrics.get('status') == 'success' else None,
+        },
+    }
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = []
+    base_actions = base['steady']['actions']
+    new_actions = new['steady']['actions']
+    for action in sorted(set(base_actions) | set(new_actions)):
+        for metric in ('p50_ms', 'p99_ms', 'p999_ms', 'throughput_per_s'):
+            old = base_actions.get(action, {}).get(metric)
+            cur = new_actions.get(action, {}).get(metric)
+            change = (cur - old) / old * 100 if old and cur is not None else None
+            rows.append({'action': action, 'metric': metric, 'base': old, 'new': cur, 'change_pct': change})
+    for section in ('steady', 'whole_run'):
+        old = (base.get('server') or {}).get(section) or {}
+        cur = (new.get('server') or {}).get(section) or {}
+        for metric in ('cpu_percent', 'rss_mb_peak', 'threads_peak', 'fds_peak'):
+            if metric in old or metric in cur:
+                o, c = old.get(metric), cur.get(metric)
+                change = (c - o) / o * 100 if o and c is not None else None
+                rows.append({'action': f'server.{section}', 'metric': metric, 'base': o, 'new': c,
+                             'change_pct': change})
+    result = {'base': base['meta'].get('git_revision'), 'new': new['meta'].get('git_revision'), 'rows': rows}
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic load generator for the chat server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run a load scenario and print JSON results')
+    run_parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='smoke')
+    run_parser.add_argument('--host', default='127.0.0.1')
+    run_parser.add_argument('--port', type=int, default=0, help='server port (default: random when spawning)')
+    run_parser.add_argument('--no-spawn', dest='spawn', action='store_false',
+                            help='use an already running server instead of spawning one')
+    run_parser.add_argument('--server-pid', type=int, help='pid to sample when not spawning the server')
+    run_parser.add_argument('--server-arg', action='append', default=[],
+                            help='extra argument passed to the spawned server.py (repeatable)')
+    run_parser.add_argument('--users', type=int)
+    run_parser.add_argument('--contacts', type=int, help='contacts added per user')
+    run_parser.add_argument('--duration', type=float, help='steady-state seconds')
+    run_parser.add_argument('--message-rate', type=float, help='messages per second per user')
+    run_parser.add_argument('--history-rate', type=float, help='history requests per second per user')
+    run_parser.add_argument('--file-rate', type=float, help='file transfers per second per user')
+    run_parser.add_argument('--file-size', type=int, help='file payload size in bytes')
+    run_parser.add_argument('--inbox-rate', type=float, help='conversation list requests per second per user')
+    run_parser.add_argument('--message-size', type=int, default=64, help='chat message padding in bytes')
+    run_parser.add_argument('--compression', choices=['off', 'auto', 'zlib', 'zstd'], default='off',
+                            help='negotiate frame compression on every connection')
+    run_parser.add_argument('--compression-dict', help='shared dictionary (pass the same file to the server)')
+    run_parser.add_argument('--tls', action='store_true',
+                            help='connect over TLS (a test certificate is generated when spawning)')
+    run_parser.add_argument('--tls-ca', help='CA file for --tls against an already running server')
+    run_parser.add_argument('--setup-concurrency', type=int, default=32)
+    run_parser.add_argument('--timeout', type=float, default=30.0)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='write JSON here instead of stdout')
+
+    compare_parser = subparsers.add_parser('compare', help='diff two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        compare(args)
+        return
+    for key, value in SCENARIOS[args.scenario].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        log(f'results written to {args.output}')
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+"""Offline analysis of chat traffic in a packet capture.
+
+Reads a pcap or pcapng file (tcpdump, Wireshark) one packet at a time,
+reassembles the TCP streams to and from the chat port and decodes the
+frames in them: length-prefixed, compressed and bare JSON alike. Reports
+packet and protocol totals, top talkers, frame counts and bytes per
+action, and request -> response latency percentiles per request type.
+Memory depends on the number of open connections, not on the size of the
+capture.
+
+    tcpdump -i any -w chat.pcap tcp port 5000
+    python pcap_analyzer.py chat.pcap [--port 5000] [--json report.json]
+
+The Markdown output fills the sections of wireshark_analysis.md. TLS
+connections cannot be decoded and are only counted.
+"""
+import argparse
+import json
+import random
+import struct
+import sys
+from collections import Counter, defaultdict, deque
+
+import compression
+from protocol import FrameLimits, FrameReader, FrameTooLarge
+from traffic import expectation
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+LINK_NULL, LINK_ETHERNET, LINK_RAW, LINK_LOOP = 0, 1, 101, 108
+LINK_SLL, LINK_IPV4, LINK_IPV6, LINK_SLL2 = 113, 228, 229, 276
+ETHERTYPES = {0x0800: 'IPv4', 0x86DD: 'IPv6', 0x0806: 'ARP'}
+IP_PROTOCOLS = {1: 'ICMP', 6: 'TCP', 17: 'UDP', 58: 'ICMPv6'}
+IPV6_EXTENSIONS = {0, 43, 44, 60}
+SEQ_MOD = 2 ** 32
+MAX_OUT_OF_ORDER = 4 * 1024 * 1024  # Больше не ждём пропавший сегмент: дыра, ищем следующий кадр
+MAX_FRAME = 64 * 1024 * 1024  # Кадры крупнее пропускаются, не попадая в память
+SAMPLES = 100000  # Задержек на тип запроса храним не больше, дальше - случайная выборка
+RESYNC = b'{"action"'
+
+
+class Percentiles:
+    """Count, mean and max exactly; percentiles from a bounded random sample"""
+
+    def __init__(self, size=SAMPLES):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self.rng = random.Random(1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            slot = self.rng.randrange(self.count)
+            if slot < self.size:
+                self.samples[slot] = value
+
+    def summary(self):
+        values = sorted(self.samples)
+
+        def rank(fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count else None,
+                'p50_ms': rank(0.5), 'p90_ms': rank(0.9), 'p99_ms': rank(0.99), 'max_ms': self.max or None}
+
+
+def read_packets(f):
+    """Yield (timestamp, link type, packet bytes) from a pcap or pcapng stream"""
+    magic = f.read(4)
+    if magic in PCAP_MAGIC:
+        order, resolution = PCAP_MAGIC[magic]
+        header = f.read(20)
+        linktype = struct.unpack(order + 'I', header[16:20])[0] & 0xFFFF
+        record = struct.Struct(order + 'IIII')
+        while True:
+            head = f.read(16)
+            if len(head) < 16:
+                return
+            seconds, fraction, captured, _ = record.unpack(head)
+            data = f.read(captured)
+            if len(data) < captured:
+                return  # файл оборван на середине пакета
+            yield seconds + fraction * resolution, linktype, data
+    elif magic == PCAPNG_MAGIC:
+        yield from _read_pcapng(f, magic)
+    else:
+        raise ValueError('not a pcap or pcapng file')
+
+
+def _read_pcapng(f, magic):
+    order = '<'
+    interfaces = []  # [(link type, секунд в единице времени)]
+    head = magic + f.read(4)
+    while len(head) == 8:
+        block_type = struct.unpack(order + 'I', head[:4])[0]
+        if block_type == 0x0A0D0D0A:
+            # Section Header: порядок байт задаёт byte-order magic
+            order = '<' if f.read(4) == b'\x4d\x3c\x2b\x1a' else '>'
+            length = struct.unpack(order + 'I', head[4:])[0]
+            f.read(length - 12)
+            interfaces = []
+        else:
+            length = struct.unpack(order + 'I', head[4:])[0]
+            body = f.read(length - 8)
+            if len(body) < length - 8:
+                return
+            if block_type == 1:
+                interfaces.append((struct.unpack(order + 'H', body[:2])[0], _tsresol(body[8:-4], order)))
+            elif block_type == 6:
+                interface, high, low, captured = struct.unpack(order + 'IIII', body[:16])
+                linktype, resolution = interfaces[interface]
+                yield ((high << 32) | low) * resolution, linktype, body[20:20 + captured]
+            elif block_type == 3 and interfaces:
+                # Simple Packet Block: без времени
+                linktype, _ = interfaces[0]
+                captured = min(struct.unpack(order + 'I', body[:4])[0], len(body) - 8)
+                yield None, linktype, body[4:4 + captured]
+        head = f.read(8)
+
+
+def _tsresol(options, order):
+    """if_tsresol from an Interface Description Block; microseconds when absent"""
+    position = 0
+    while position + 4 <= len(options):
+        code, length = struct.unpack(order + 'HH', options[position:position + 4])
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = options[position + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        position += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def network_layer(linktype, data):
+    """(network protocol name, IP packet bytes or None)"""
+    if linktype == LINK_ETHERNET:
+        ethertype, offset = struct.unpack('!H', data[12:14])[0], 14
+        while ethertype in (0x8100, 0x88A8) and len(data) >= offset + 4:  # VLAN-теги
+            ethertype, offset = struct.unpack('!H', data[offset + 2:offset + 4])[0], offset + 4
+        return ETHERTYPES.get(ethertype, f'ethertype 0x{ethertype:04x}'), data[offset:]
+    if linktype == LINK_SLL:
+        ethertype = struct.unpack('!H', data[14:16])[0]
+        return ETHERTYPES.get(ethertype, f'ethertype 0x{ethertype:04x}'), data[16:]
+    if linktype == LINK_SLL2:
+        ethertype = struct.unpack('!H', data[:2])[0]
+        return ETHERTYPES.get(ethertype, f'ethertype 0x{ethertype:04x}'), data[20:]
+    if linktype in (LINK_NULL, LINK_LOOP):
+        data = data[4:]
+    elif linktype not in (LINK_RAW, LINK_IPV4, LINK_IPV6):
+        return f'link type {linktype}', None
+    version = data[0] >> 4 if data else 0
+    return {4: 'IPv4', 6: 'IPv6'}.get(version, 'unknown'), data
+
+
+def transport_layer(name, packet):
+    """(source, destination, IP protocol number, transport payload) or None"""
+    if name == 'IPv4' and len(packet) >= 20:
+        header = (packet[0] & 0x0F) * 4
+        total, fragment, protocol = struct.unpack('!H2xHxB', packet[2:10])
+        if fragment & 0x3FFF:
+            return None  # фрагменты IP не собираем
+        return (socket_address(packet[12:16]), socket_address(packet[16:20]), protocol,
+                packet[header:total] if total else packet[header:])
+    if name == 'IPv6' and len(packet) >= 40:
+        length, protocol = struct.unpack('!HB', packet[4:7])
+        payload = packet[40:40 + length]
+        while protocol in IPV6_EXTENSIONS and len(payload) >= 8:
+            if protocol == 44:
+                return None
+            protocol, size = payload[0], (payload[1] + 1) * 8
+            payload = payload[size:]
+        return socket_address(packet[8:24]), socket_address(packet[24:40]), protocol, payload
+    return None
+
+
+def socket_address(raw):
+    if len(raw) == 4:
+        return '.'.join(str(b) for b in raw)
+    groups = struct.unpack('!8H', raw)
+    return ':'.join(f'{g:x}' for g in groups)
+
+
+class Direction:
+    """One side of a TCP connection: reassembly and frame decoding"""
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.next_seq = None
+        self.out_of_order = {}  # {seq: bytes}
+        self.waiting = 0
+        self.reader = self._reader()
+        self.synced = True
+        self.tail = b''  # последние байты при поиске начала кадра
+        self.gaps = 0
+        self.undecoded = 0
+
+    def _reader(self):
+        return FrameReader(self.dictionary, FrameLimits(MAX_FRAME, {}))
+
+    def segment(self, seq, data, syn):
+        """Take a TCP segment; returns the newly contiguous bytes"""
+        if syn:
+            self.next_seq = (seq + 1) % SEQ_MOD
+            return []
+        if not data:
+            return []
+        if self.next_seq is None:
+            # Захват начался посреди соединения: граница кадра неизвестна
+            self.next_seq = seq
+            self.synced = False
+        offset = (seq - self.next_seq) % SEQ_MOD
+        if offset >= SEQ_MOD // 2:
+            overlap = SEQ_MOD - offset  # повтор уже полученного
+            if overlap >= len(data):
+                return []
+            data, seq = data[overlap:], self.next_seq
+        elif offset:
+            if seq not in self.out_of_order:
+                self.out_of_order[seq] = data
+                self.waiting += len(data)
+            if self.waiting <= MAX_OUT_OF_ORDER:
+                return []
+            # Пропавший сегмент так и не пришёл (его нет в захвате): перескакиваем дыру
+            seq = min(self.out_of_order, key=lambda s: (s - self.next_seq) % SEQ_MOD)
+            data = self.out_of_order.pop(seq)
+            self.waiting -= len(data)
+            self.gaps += 1
+            self.desync()
+        chunks = [data]
+        self.next_seq = (seq + len(data)) % SEQ_MOD
+        while self.next_seq in self.out_of_order:
+            data = self.out_of_order.pop(self.next_seq)
+            self.waiting -= len(data)
+            chunks.append(data)
+            self.next_seq = (self.next_seq + len(data)) % SEQ_MOD
+        return chunks
+
+    def desync(self):
+        self.reader.close()
+        self.reader = self._reader()
+        self.synced = False
+        self.tail = b''
+
+    def frames(self, chunks):
+        """Yield (message, wire size) for every frame completed by these bytes"""
+        for data in chunks:
+            if not self.synced:
+                data = self._resync(data)
+                if data is None:
+                    continue
+            try:
+                self.reader.feed(data)
+                while True:
+                    try:
+                        for message in self.reader.frames():
+                            yield message, self.reader.frame_size
+                        break
+                    except FrameTooLarge as e:
+                        if e.fatal:
+                            raise
+                        yield {'action': e.action or 'unknown', 'oversize': True}, e.size
+            except Exception:
+                # Мусор, TLS, битый JSON или сжатие без словаря: ищем следующий кадр
+                self.undecoded += len(data)
+                self.desync()
+
+    def _resync(self, data):
+        """Bytes from the next likely frame start, or None if there is none yet"""
+        data = self.tail + bytes(data)
+        found = data.find(RESYNC)
+        if found < 0:
+            self.undecoded += max(0, len(data) - len(RESYNC))
+            self.tail = data[-len(RESYNC):]
+            return None
+        start = found
+        if found >= 4:
+            size = int.from_bytes(data[found - 4:found], 'big') & ~compression.COMPRESSED_FLAG
+            if 0 < size <= MAX_FRAME:
+                start = found - 4  # перед JSON похожий префикс длины
+        self.undecoded += start
+        self.synced = True
+        self.tail = b''
+        return data[start:]
+
+
+class Connection:
+    def __init__(self, client, server, dictionary):
+        self.client = client
+        self.server = server
+        self.requests = Direction(dictionary)
+        self.responses = Direction(dictionary)
+        self.pending = deque()  # [(название, ожидаемые действия ответа, время)]
+        self.fins = 0
+
+
+class Analyzer:
+    def __init__(self, ports, dictionary=None):
+        self.ports = set(ports)
+        self.dictionary = dictionary
+        self.connections = {}  # {(client, server): Connection}
+        self.packets = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.network = Counter()
+        self.transport = Counter()
+        self.talkers = Counter()  # {ip: байт отправлено и получено}
+        self.conversations = Counter()  # {(ip, ip): байт}
+        self.chat_clients = Counter()  # {ip: кадров чата}
+        self.frames = defaultdict(Counter)  # {направление: {action: кадров}}
+        self.frame_bytes = defaultdict(Counter)  # {направление: {action: байт}}
+        self.latency = defaultdict(Percentiles)
+        self.unanswered = Counter()
+        self.connections_seen = 0
+        self.gaps = 0
+        self.undecoded = 0
+
+    def add(self, timestamp, linktype, data):
+        self.packets += 1
+        self.bytes += len(data)
+        if timestamp is not None:
+            self.first = timestamp if self.first is None else min(self.first, timestamp)
+            self.last = timestamp if self.last is None else max(self.last, timestamp)
+        try:
+            name, packet = network_layer(linktype, data)
+        except (struct.error, IndexError):
+            self.network['malformed'] += 1
+            return
+        self.network[name] += 1
+        if packet is None:
+            return
+        try:
+            parsed = transport_layer(name, packet)
+        except (struct.error, IndexError):
+            parsed = None
+        if parsed is None:
+            return
+        source, destination, protocol, payload = parsed
+        self.transport[IP_PROTOCOLS.get(protocol, f'IP protocol {protocol}')] += 1
+        self.talkers[source] += len(packet)
+        self.talkers[destination] += len(packet)
+        self.conversations[tuple(sorted((source, destination)))] += len(packet)
+        if protocol == 6 and len(payload) >= 20:
+            self._tcp(timestamp, source, destination, payload)
+
+    def _tcp(self, timestamp, source, destination, segment):
+        source_port, destination_port, seq = struct.unpack('!HHI', segment[:8])
+        offset = (segment[12] >> 4) * 4
+        flags = segment[13]
+        if destination_port in self.ports:
+            key, to_server = ((source, source_port), (destination, destination_port)), True
+        elif source_port in self.ports:
+            key, to_server = ((destination, destination_port), (source, source_port)), False
+        else:
+            return
+        connection = self.connections.get(key)
+        if connection is None:
+            if flags & 0x04:  # RST неизвестного соединения
+                return
+            connection = self.connections[key] = Connection(key[0], key[1], self.dictionary)
+            self.connections_seen += 1
+        direction = connection.requests if to_server else connection.responses
+        chunks = direction.segment(seq, segment[offset:], bool(flags & 0x02))
+        for message, size in direction.frames(chunks):
+            self._frame(connection, to_server, message, size, timestamp)
+        if flags & 0x04:
+            self._close(key)
+        elif flags & 0x01:
+            connection.fins += 1
+            if connection.fins == 2:
+                self._close(key)
+
+    def _frame(self, connection, to_server, message, size, timestamp):
+        if not isinstance(message, dict):
+            message = {}
+        action = message.get('action') or 'unknown'
+        side = 'client->server' if to_server else 'server->client'
+        if to_server:
+            self.chat_clients[connection.client[0]] += 1
+            name = action
+            expected = expectation(message) if not message.get('oversize') else None
+            if expected:
+                name = expected[0]
+                if timestamp is not None:
+                    connection.pending.append((expected[0], expected[1], timestamp))
+        else:
+            name = action
+            if action == 'message' and 'sender' in message:
+                name = 'message (forwarded)'
+            elif timestamp is not None:
+                for index, (request, answers, sent) in enumerate(connection.pending):
+                    if action in answers:
+                        del connection.pending[index]
+                        self.latency[request].add((timestamp - sent) * 1000)
+                        break
+        self.frames[side][name] += 1
+        self.frame_bytes[side][name] += size
+
+    def _close(self, key):
+        connection = self.connections.pop(key)
+        for request, _, _ in connection.pending:
+            self.unanswered[request] += 1
+        for direction in (connection.requests, connection.responses):
+            self.gaps += direction.gaps
+            self.undecoded += direction.undecoded
+            direction.reader.close()
+
+    def report(self, top=10):
+        for key in list(self.connections):
+            self._close(key)
+        return {
+            'capture': {
+                'packets': self.packets,
+                'bytes': self.bytes,
+                'start': self.first,
+                'seconds': (self.last - self.first) if self.first is not None else None,
+                'chat_connections': self.connections_seen,
+                'reassembly_gaps': self.gaps,
+                'undecoded_bytes': self.undecoded,
+            },
+            'protocols': {'network': dict(self.network.most_common()),
+                          'transport': dict(self.transport.most_common())},
+            'top_talkers': [{'address': address, 'bytes': count} for address, count in self.talkers.most_common(top)],
+            'top_conversations': [{'between': list(pair), 'bytes': count}
+                                  for pair, count in self.conversations.most_common(top)],
+            'top_chat_clients': [{'address': address, 'frames': count}
+                                 for address, count in self.chat_clients.most_common(top)],
+            'frames': {side: {action: {'frames': count, 'bytes': self.frame_bytes[side][action]}
+                              for action, count in counts.most_common()}
+                       for side, counts in self.frames.items()},
+            'latency': {name: dict(self.latency[name].summary(), unanswered=self.unanswered.get(name, 0))
+                        for name in sorted(set(self.latency) | set(self.unanswered))},
+        }
+
+
+def markdown(report, path):
+    """The report as the sections of wireshark_analysis.md"""
+    capture = report['capture']
+    lines = ['### Traffic Summary', '',
+             f"Capture `{path}`: {capture['packets']} packets, {capture['bytes']} bytes"
+             + (f" over {capture['seconds']:.1f} s" if capture['seconds'] is not None else '') + '.',
+             f"{capture['chat_connections']} chat connections; {capture['reassembly_gaps']} reassembly gaps, "
+             f"{capture['undecoded_bytes']} bytes that did not decode as chat frames.", '',
+             '### Protocol Distribution', '', '| Layer | Protocol | Packets |', '|---|---|---|']
+    for layer in ('network', 'transport'):
+        for name, count in report['protocols'][layer].items():
+            lines.append(f'| {layer} | {name} | {count} |')
+    lines += ['', '### Top Talkers', '', '| Address | Bytes |', '|---|---|']
+    lines += [f"| {row['address']} | {row['bytes']} |" for row in report['top_talkers']]
+    lines += ['', '| Chat client | Frames sent |', '|---|---|']
+    lines += [f"| {row['address']} | {row['frames']} |" for row in report['top_chat_clients']]
+    lines += ['', '### Chat Frames', '', '| Direction | Action | Frames | Bytes |', '|---|---|---|---|']
+    for side, actions in report['frames'].items():
+        for action, row in actions.items():
+            lines.append(f"| {side} | {action} | {row['frames']} | {row['bytes']} |")
+    lines += ['', '### Request Latency', '',
+              '| Request | Count | p50 ms | p90 ms | p99 ms | Max ms | Unanswered |', '|---|---|---|---|---|---|---|']
+    for name, row in report['latency'].items():
+        cells = [f'{row[key]:.2f}' if row[key] is not None else '-' for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')]
+        lines.append(f"| {name} | {row['count']} | {' | '.join(cells)} | {row['unanswered']} |")
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('capture', help='pcap or pcapng file ("-" for stdin)')
+    parser.add_argument('--port', type=int, action='append', help='chat server port (default 5000, repeatable)')
+    parser.add_argument('--compression-dict', help='shared dictionary, if the server uses one')
+    parser.add_argument('--top', type=int, default=10, help='rows in the top talker tables')
+    parser.add_argument('--json', help='also write the full report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    dictionary = compression.load_dictionary(args.compression_dict) if args.compression_dict else None
+    analyzer = Analyzer(args.port or [5000], dictionary)
+    stream = sys.stdin.buffer if args.capture == '-' else open(args.capture, 'rb', buffering=1024 * 1024)
+    try:
+        for timestamp, linktype, data in read_packets(stream):
+            analyzer.add(timestamp, linktype, data)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    report = analyzer.report(args.top)
+    sys.stdout.write(markdown(report, args.capture))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""On-demand profiling of a running server.
+
+While a profiling window is open, the thread that opened it samples the
+stacks of all other threads every few milliseconds and counts them in
+collapsed-stack form ("frame;frame;frame count"). flamegraph.pl, speedscope and similar
+tools read this directly. The root of each stack is the action the thread
+was handling. A random share of process_message calls also runs under
+cProfile, and the results are added up per action.
+
+Overhead is measured while the window is open. Sampling backs off when
+its own time goes over `max_overhead` of wall time. cProfile is switched
+off for the rest of the window once the extra time of the profiled calls
+goes over the same share. When no window is open, the cost is one
+attribute check per request.
+
+    python profiler.py --port 5000 --seconds 10
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from protocol import FrameReader, encode_frame
+
+DEFAULT_INTERVAL = 0.005
+MAX_INTERVAL = 0.1
+MAX_SECONDS = 300
+
+
+def frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Profiler:
+    """Stack sampler plus per-action cProfile, active only inside run()"""
+
+    def __init__(self, directory='profiles', interval=DEFAULT_INTERVAL, max_overhead=0.02, profile_fraction=0.2):
+        self.directory = directory
+        self.interval = interval
+        self.max_overhead = max_overhead  # Доля времени, которую может съесть профилирование
+        self.profile_fraction = profile_fraction
+        self.active = False
+        self.run_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.current = {}  # {thread id: action}, что поток обрабатывает прямо сейчас
+        self._reset()
+
+    def _reset(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.calls = defaultdict(lambda: [0, 0.0, 0, 0.0])  # {action: [calls, s, profiled calls, profiled s]}
+        self.profiles = {}  # {action: pstats.Stats}
+        self.profiling = self.profile_fraction > 0
+        self.started = time.perf_counter()
+
+    def call(self, action, func, *args):
+        """Run a request handler, recording it if a profiling window is open"""
+        if not self.active:
+            return func(*args)
+        thread_id = threading.get_ident()
+        self.current[thread_id] = action
+        profile = None
+        if self.profiling and random.random() < self.profile_fraction:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+: одновременно может работать только один cProfile
+                profile = None
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+            self.current.pop(thread_id, None)
+            self._record(action, elapsed, profile)
+
+    def _record(self, action, elapsed, profile):
+        with self.lock:
+            totals = self.calls[action]
+            if profile is None:
+                totals[0] += 1
+                totals[1] += elapsed
+                return
+            totals[2] += 1
+            totals[3] += elapsed
+            stats = self.profiles.get(action)
+            if stats is None:
+                self.profiles[action] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            if self.profiling and self._profile_overhead() > self.max_overhead:
+                self.profiling = False
+
+    def _profile_overhead(self):
+        """Extra time of profiled calls over plain ones, as a share of the window so far"""
+        extra = 0.0
+        for calls, seconds, profiled, profiled_seconds in self.calls.values():
+            if calls and profiled:
+                extra += max(0.0, profiled_seconds - profiled * seconds / calls)
+        return extra / max(time.perf_counter() - self.started, 1e-9)
+
+    def run(self, seconds):
+        """Profile for `seconds`, write the results and return a summary; one window at a time"""
+        if not self.run_lock.acquire(blocking=False):
+            raise RuntimeError('Profiler is already running')
+        try:
+            self._reset()
+            self.active = True
+            try:
+                # Сэмплирует вызывающий поток; сам он в профиль не попадает
+                interval, sampler_seconds, elapsed = self._sample(min(seconds, MAX_SECONDS), threading.get_ident())
+            finally:
+                self.active = False
+                self.current.clear()
+            with self.lock:
+                return self._write(interval, sampler_seconds, elapsed)
+        finally:
+            self.run_lock.release()
+
+    def _sample(self, seconds, exclude):
+        interval = self.interval
+        busy = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            self._take_sample(exclude)
+            took = time.perf_counter() - now
+            busy += took
+            # Пока сэмплер держит GIL, обработчики стоят: держим его долю ниже потолка
+            if busy / (time.perf_counter() - started) > self.max_overhead and interval < MAX_INTERVAL:
+                interval = min(interval * 2, MAX_INTERVAL)
+            time.sleep(max(0.0, min(interval - took, deadline - time.perf_counter())))
+        return interval, busy, time.perf_counter() - started
+
+    def _take_sample(self, exclude):
+        current = self.current
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == exclude:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            action = current.get(thread_id)
+            labels.append(f'action={action}' if action else 'no request')
+            self.stacks[';'.join(reversed(labels))] += 1
+        self.samples += 1
+
+    def _write(self, interval, sampler_seconds, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, 'profile-' + time.strftime('%Y%m%d-%H%M%S'))
+        folded = base + '.folded'
+        with open(folded, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        per_action = {}
+        report = io.StringIO()
+        for action, (calls, seconds, profiled, profiled_seconds) in sorted(self.calls.items(), key=str):
+            per_action[action] = {
+                'calls': calls + profiled,
+                'mean_ms': seconds / calls * 1000 if calls else None,
+                'profiled': profiled,
+                'profiled_mean_ms': profiled_seconds / profiled * 1000 if profiled else None,
+            }
+            stats = self.profiles.get(action)
+            if stats is not None:
+                report.write(f'=== {action}: {profiled} profiled calls of {calls + profiled}\n')
+                stats.stream = report
+                stats.sort_stats('cumulative').print_stats(30)
+        actions = base + '.actions.txt'
+        with open(actions, 'w') as f:
+            f.write(report.getvalue())
+        # Самые горячие функции по собственным сэмплам (лист стека)
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return {
+            'seconds': round(elapsed, 3),
+            'samples': self.samples,
+            'interval_ms': interval * 1000,
+            'sampler_overhead': sampler_seconds / elapsed if elapsed else 0.0,
+            'cprofile_overhead': self._profile_overhead(),
+            'cprofile_stopped': self.profile_fraction > 0 and not self.profiling,
+            'folded': os.path.abspath(folded),
+            'actions_report': os.path.abspath(actions),
+            'per_action': per_action,
+            'top_frames': leaves.most_common(10),
+        }
+
+
+def request_profile(host, port, seconds, timeout=None):
+    """Ask a running server (over loopback) to profile itself and return its summary"""
+    with socket.create_connection((host, port), timeout=timeout or seconds + 60) as sock:
+        sock.sendall(encode_frame({'action': 'profile', 'seconds': seconds}))
+        reader = FrameReader()
+        while True:
+            for message in reader.frames():
+                if message.get('action') == 'profile':
+                    return message
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('server closed the connection')
+            reader.feed(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile a running chat server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+    json.dump(request_profile(args.host, args.port, args.seconds), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import json
+import re
+import threading
+from datetime import datetime, timezone
+
+from compression import COMPRESSED_FLAG, DecompressedTooLarge, decompress
+
+HEADER_SIZE = 4
+RECV_BUFFER = 16 * 1024  # Постоянный буфер приёма на соединение, которое хоть раз заполнило начальный
+READ_MIN = 4096  # Начальный буфер; меньше свободного места - сдвигаем данные к началу буфера
+PEEK_BYTES = 256  # Сколько байт кадра нужно, чтобы узнать его action до чтения целиком
+DEFAULT_FRAME_LIMIT = 1024 * 1024
+# Файл до 10 МБ в base64 - это около 13.4 МБ JSON
+FRAME_LIMITS = {'file': 16 * 1024 * 1024}
+
+_ACTION_PREFIX = re.compile(rb'\s*\{\s*"action"\s*:\s*"(\w+)"')
+# Конец bare JSON ищем по сырым байтам: вне строки важны скобки и кавычки, внутри - кавычки и escape
+_OUTSIDE_STRING = re.compile(rb'[{}"]')
+_INSIDE_STRING = re.compile(rb'["\\]')
+
+
+def wire_timestamp(millis):
+    """Stored epoch milliseconds as the ISO 8601 UTC string sent to clients"""
+    return datetime.fromtimestamp(millis / 1000, timezone.utc).isoformat(timespec='milliseconds')
+
+
+def encode_frame(message, codec=None):
+    """Encode a message as a length-prefixed JSON frame"""
+    data = json.dumps(message, ensure_ascii=False).encode()
+    if codec:
+        return codec.encode(data)
+    return len(data).to_bytes(HEADER_SIZE, byteorder='big') + data
+
+
+class FrameTooLarge(ValueError):
+    """A frame is bigger than its limit. Non-fatal ones were skipped and the stream stays usable."""
+
+    def __init__(self, size, limit, action=None, fatal=False):
+        super().__init__(f'Frame of {size} bytes exceeds the {limit} byte limit')
+        self.size = size
+        self.limit = limit
+        self.action = action
+        self.fatal = fatal
+
+
+class FrameLimits:
+    """Largest accepted frame per action; actions not listed get `default`"""
+
+    def __init__(self, default=DEFAULT_FRAME_LIMIT, per_action=None):
+        self.default = default
+        self.per_action = dict(FRAME_LIMITS if per_action is None else per_action)
+
+    @property
+    def max_frame(self):
+        return max([self.default, *self.per_action.values()])
+
+    @property
+    def smallest(self):
+        return min([self.default, *self.per_action.values()])
+
+    def limit(self, action):
+        return self.per_action.get(action, self.default)
+
+
+class MemoryBudget:
+    """Bytes that all connections together may hold in partially read frames.
+
+    A reader that needs more than its fixed receive buffer reserves the
+    whole frame here before reading on. When the budget is spent it waits,
+    so the socket is not read and TCP flow control slows that sender down.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            if self.used + size > self.limit:
+                self.waits += 1
+            while self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        if not size:
+            return
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'used': self.used, 'limit': self.limit, 'peak': self.peak, 'waits': self.waits}
+
+
+class FrameReader:
+    """Incremental decoder for the chat wire format.
+
+    Peers write two kinds of frames: a 4-byte big-endian length followed by
+    a JSON object, and bare JSON objects with no prefix at all (the server
+    answers `register` and forwards chat messages that way, the GUI client
+    sends most requests that way). A frame that starts with '{' is decoded
+    as bare JSON, anything else is read as a length prefix; a prefix with
+    COMPRESSED_FLAG set carries a compressed payload.
+
+    Data is received straight into a preallocated buffer: recv_into() the
+    view from writable(), then commit() the byte count (feed() does both for
+    data already in hand). With `limits` set, a prefixed frame over its
+    limit is rejected from the header and its payload skipped unread; an
+    oversize bare frame cannot be skipped and is fatal. Growing past the
+    fixed buffer is paid for from `budget`. The buffer starts at READ_MIN
+    and grows to `capacity` the first time a read fills it, so idle
+    connections hold only a quarter of it.
+
+    The end of a bare frame is found by scanning the raw bytes for braces
+    outside strings, and the scan resumes where the previous read left it.
+    A bare frame that is not valid UTF-8 JSON is dropped whole and raises
+    ValueError; the frames after it still decode.
+    """
+
+    __slots__ = ('capacity', 'buffer', 'start', 'end', 'skip', 'checked', 'reserved', 'frame_size', 'dictionary',
+                 'limits', 'budget', 'scan', 'depth', 'in_string')
+
+    def __init__(self, dictionary=None, limits=None, budget=None, capacity=RECV_BUFFER):
+        self.capacity = capacity
+        self.buffer = bytearray(min(capacity, READ_MIN))
+        self.start = 0
+        self.end = 0
+        self.skip = 0  # Байты отклонённого кадра, которые ещё придут и будут выброшены
+        self.checked = False  # Лимит кадра в начале буфера уже проверен
+        self.reserved = 0
+        self.frame_size = 0  # Байт на проводе у последнего разобранного кадра
+        self.dictionary = dictionary
+        self.limits = limits
+        self.budget = budget
+        # Докуда (от start) просмотрен bare кадр в начале буфера: глубина скобок и внутри ли строки
+        self.scan = 0
+        self.depth = 0
+        self.in_string = False
+
+    def writable(self):
+        """Free part of the buffer to receive into; may wait for the memory budget"""
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.capacity:
+                self._resize(self.capacity)
+        pending = self.end - self.start
+        need = max(self._frame_bytes() or 0, pending + READ_MIN)
+        if self.limits is not None and self._bare() and pending >= self.limits.default:
+            self.start = self.end = 0
+            self._reset_scan()
+            raise FrameTooLarge(pending, self.limits.default, fatal=True)
+        if need > len(self.buffer):
+            if self.limits is None:
+                size = max(need, len(self.buffer) * 2)
+            elif self._bare():
+                # Длина bare кадра неизвестна: растём вдвое, а не на READ_MIN, иначе каждое
+                # чтение копирует весь буфер. Больше лимита расти незачем - там кадр отклоняется
+                size = max(need, min(len(self.buffer) * 2, self.limits.default + READ_MIN))
+            else:
+                size = need
+            self._resize(size)
+        elif self.start + need > len(self.buffer):
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return memoryview(self.buffer)[self.end:]
+
+    def commit(self, count):
+        """Account for `count` bytes written into the view from writable()"""
+        self.end += count
+        if self.end == len(self.buffer) < self.capacity:
+            # Чтение заполнило начальный буфер: соединение активное, даём ему полный
+            self._resize(self.capacity)
+        if self.skip:
+            dropped = min(self.skip, self.end - self.start)
+            self.start += dropped
+            self.skip -= dropped
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            view = self.writable()
+            count = min(len(view), len(data))
+            view[:count] = data[:count]
+            view.release()
+            self.commit(count)
+            data = data[count:]
+
+    def close(self):
+        """Give the grown part of the buffer back to the budget"""
+        self.start = self.end = 0
+        self._reset_scan()
+        self._resize(min(self.capacity, READ_MIN))
+
+    def frames(self):
+        """Yield every complete message currently in the buffer"""
+        while True:
+            # Пропускаем пробелы между bare JSON кадрами
+            while self.start < self.end and self.buffer[self.start] in b' \t\r\n':
+                self.start += 1
+            if self.start == self.end:
+                return
+            if self._bare():
+                message = self._decode_bare()
+            else:
+                message = self._decode_prefixed()
+            if message is None:
+                return
+            yield message
+
+    def _bare(self):
+        return self.start < self.end and self.buffer[self.start] == ord('{')
+
+    def _header(self):
+        """(payload length, compressed) of the prefixed frame at the start of the buffer"""
+        size = int.from_bytes(self.buffer[self.start:self.start + HEADER_SIZE], byteorder='big')
+        return size & ~COMPRESSED_FLAG, bool(size & COMPRESSED_FLAG)
+
+    def _frame_bytes(self):
+        """Buffer space the frame at the start needs, if that is known yet"""
+        if self.end - self.start < HEADER_SIZE or self._bare():
+            return None
+        length, _ = self._header()
+        if not self.checked:
+            # Пока не ясно, пройдёт ли кадр по лимиту, читаем только начало
+            return HEADER_SIZE + min(length, PEEK_BYTES)
+        return HEADER_SIZE + length
+
+    def _resize(self, size):
+        if size == len(self.buffer):
+            return
+        if self.budget is not None:
+            grown = max(0, size - self.capacity)
+            if grown > self.reserved:
+                self.budget.acquire(grown - self.reserved)
+            else:
+                self.budget.release(self.reserved - grown)
+            self.reserved = grown
+        pending = self.end - self.start
+        buffer = bytearray(size)
+        buffer[:pending] = self.buffer[self.start:self.end]
+        self.buffer, self.start, self.end = buffer, 0, pending
+
+    def _check(self, length, compressed):
+        """Reject the frame at the start of the buffer if it is over its limit; False to wait for more bytes"""
+        limits = self.limits
+        if limits is None or self.checked:
+            return True
+        action = None
+        limit = limits.max_frame
+        if length > limits.smallest and not compressed:
+            begin = self.start + HEADER_SIZE
+            if length <= limit and self.end - begin < min(length, PEEK_BYTES):
+                return False
+            match = _ACTION_PREFIX.match(self.buffer, begin, min(self.end, begin + PEEK_BYTES))
+            if match:
+                action = match.group(1).decode()
+                limit = limits.limit(action)
+        if length > limit:
+            self._discard(HEADER_SIZE + length)
+            raise FrameTooLarge(length, limit, action)
+        self.checked = True
+        return True
+
+    def _discard(self, total):
+        dropped = min(total, self.end - self.start)
+        self.start += dropped
+        self.skip = total - dropped
+        self.checked = False
+
+    def _decode_prefixed(self):
+        if self.end - self.start < HEADER_SIZE:
+            return None
+        length, compressed = self._header()
+        if not self._check(length, compressed):
+            return None
+        end = self.start + HEADER_SIZE + length
+        if self.end < end:
+            return None
+        data = bytes(self.buffer[self.start + HEADER_SIZE:end])
+        self.frame_size = HEADER_SIZE + length
+        self.start = end
+        self.checked = False
+        if compressed:
+            max_size = self.limits.max_frame if self.limits is not None else None
+            try:
+                data = decompress(data, self.dictionary, max_size)
+            except DecompressedTooLarge:
+                raise FrameTooLarge(max_size + 1, max_size) from None
+        message = json.loads(data.decode())
+        if self.limits is not None and isinstance(message, dict):
+            # Сжатый кадр или кадр без action в начале проверяем после разбора
+            action = message.get('action')
+            if len(data) > self.limits.limit(action):
+                raise FrameTooLarge(len(data), self.limits.limit(action), action)
+        return message
+
+    def _reset_scan(self):
+        self.scan = 0
+        self.depth = 0
+        self.in_string = False
+
+    def _bare_end(self):
+        """Offset just past the bare frame at the start of the buffer, or None if it is not complete"""
+        buffer = self.buffer
+        position = self.start + self.scan
+        while position < self.end:
+            if self.in_string:
+                match = _INSIDE_STRING.search(buffer, position, self.end)
+                if match is None:
+                    break
+                if match.group() == b'\\':
+                    position = match.end() + 1  # экранированный байт пропускаем, даже если он ещё не пришёл
+                    continue
+                self.in_string = False
+            else:
+                match = _OUTSIDE_STRING.search(buffer, position, self.end)
+                if match is None:
+                    break
+                char = match.group()
+                if char == b'"':
+                    self.in_string = True
+                elif char == b'{':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return match.end()
+            position = match.end()
+        # В следующий раз смотрим только новые байты
+        self.scan = max(position, self.end) - self.start
+        return None
+
+    def _decode_bare(self):
+        end = self._bare_end()
+        if end is None:
+            return None
+        data = bytes(self.buffer[self.start:end])
+        self.frame_size = end - self.start
+        self.start = end
+        self._reset_scan()
+        # Кадр уже снят с буфера: испорченный не сбивает разбор следующих
+        return json.loads(data.decode())
@@ -0,0 +1,166 @@
+"""Request scheduling: a worker pool with per-connection fair queuing.
+
+Connection threads only read and decode frames. Requests run on a fixed
+pool of workers. Each connection has its own FIFO, so its requests still
+run one at a time and in order. Connections with work waiting are served
+round-robin within their priority class, and a flood on one connection
+only grows that connection's queue. Classes are tried in PRIORITIES
+order. Every class except the first may use only part of the pool, so
+chat messages always find a free worker, however much history and file
+work is waiting.
+
+A connection with `max_pending` requests queued is not read until one
+finishes, so TCP slows that sender down. When the expected wait in a
+class goes over `max_wait` seconds, or the whole queue is full, new
+requests of that class are turned away with a retry-after hint instead
+of being queued. Interactive requests are never turned away.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+PRIORITIES = ('interactive', 'session', 'bulk')
+# Всё, что не указано, - interactive
+ACTION_PRIORITY = {
+    'register': 'session',
+    'login': 'session',
+    'file': 'bulk',
+    'thumbnail': 'bulk',
+    'attachment': 'bulk',
+    'conversations': 'bulk',
+}
+CONTACT_PRIORITY = {'history': 'bulk'}
+MAX_RETRY_AFTER = 30
+
+
+def priority_of(message):
+    action = message.get('action')
+    if action == 'batch':
+        # Batch идёт в классе самого тяжёлого из своих запросов
+        requests = message.get('requests')
+        priorities = [priority_of(r) for r in requests if isinstance(r, dict)] if isinstance(requests, list) else []
+        return max(priorities, key=PRIORITIES.index, default=PRIORITIES[0])
+    if action == 'contacts':
+        return CONTACT_PRIORITY.get(message.get('contact_action'), 'interactive')
+    return ACTION_PRIORITY.get(action, 'interactive')
+
+
+class Scheduler:
+    def __init__(self, workers=16, shares=None, max_pending=8, max_queue=1024, max_wait=5.0):
+        self.workers = workers
+        # Доля пула, которую может занять класс; interactive - весь пул
+        shares = shares or {'session': 0.5, 'bulk': 0.5}
+        self.limits = {name: max(1, int(workers * shares.get(name, 1.0))) for name in PRIORITIES}
+        self.max_pending = max_pending
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        # Воркеров будим по одному; отправители и drain ждут отдельно
+        self.work = threading.Condition(self.lock)
+        self.done = threading.Condition(self.lock)
+        self.queues = {}  # {connection: deque of (priority, task, enqueued at)}
+        self.ready = {name: deque() for name in PRIORITIES}  # соединения, чья очередь ждёт свободного воркера
+        self.running = set()
+        self.running_by_class = Counter()
+        self.queued_by_class = Counter()
+        self.service = {name: 0.01 for name in PRIORITIES}  # скользящее среднее времени запроса, с
+        self.completed = Counter()
+        self.shed = Counter()
+        self.waited = Counter()  # сумма ожидания в очереди по классам, с
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, connection, priority, task):
+        """Queue task for connection; returns None, or seconds to retry after if it was turned away.
+
+        Blocks while the connection already has max_pending requests queued.
+        """
+        with self.lock:
+            while self._pending(connection) >= self.max_pending:
+                self.done.wait()
+            if priority != PRIORITIES[0]:
+                wait = self._expected_wait(priority)
+                if wait > self.max_wait or sum(self.queued_by_class.values()) >= self.max_queue:
+                    self.shed[priority] += 1
+                    return min(MAX_RETRY_AFTER, max(1, round(wait)))
+            queue = self.queues.setdefault(connection, deque())
+            queue.append((priority, task, time.monotonic()))
+            self.queued_by_class[priority] += 1
+            if len(queue) == 1 and connection not in self.running:
+                self.ready[priority].append(connection)
+                self.work.notify()
+            return None
+
+    def drain(self, connection):
+        """Wait until everything queued for connection has run, then forget it"""
+        with self.lock:
+            while self.queues.get(connection) or connection in self.running:
+                self.done.wait()
+            self.queues.pop(connection, None)
+
+    def _pending(self, connection):
+        return len(self.queues.get(connection, ())) + (connection in self.running)
+
+    def _expected_wait(self, priority):
+        return self.queued_by_class[priority] * self.service[priority] / self.limits[priority]
+
+    def _pick(self):
+        for priority in PRIORITIES:
+            if self.running_by_class[priority] >= self.limits[priority] or not self.ready[priority]:
+                continue
+            connection = self.ready[priority].popleft()
+            _, task, enqueued = self.queues[connection].popleft()
+            self.queued_by_class[priority] -= 1
+            self.running.add(connection)
+            self.running_by_class[priority] += 1
+            self.waited[priority] += time.monotonic() - enqueued
+            return connection, priority, task
+        return None
+
+    def _work(self):
+        while True:
+            with self.lock:
+                picked = self._pick()
+                while picked is None:
+                    self.work.wait()
+                    picked = self._pick()
+            connection, priority, task = picked
+            started = time.monotonic()
+            try:
+                task()
+            except Exception as e:
+                logging.error(f"Error processing message: {str(e)}")
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.running.discard(connection)
+                self.running_by_class[priority] -= 1
+                self.completed[priority] += 1
+                self.service[priority] += (elapsed - self.service[priority]) * 0.1
+                queue = self.queues.get(connection)
+                if queue:
+                    # В конец очереди своего класса: round-robin между соединениями
+                    self.ready[queue[0][0]].append(connection)
+                    # Сам этот воркер может упереться в лимит класса: пусть посмотрит ещё один
+                    self.work.notify()
+                self.done.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'classes': {name: {
+                    'limit': self.limits[name],
+                    'running': self.running_by_class[name],
+                    'queued': self.queued_by_class[name],
+                    'completed': self.completed[name],
+                    'shed': self.shed[name],
+                    'mean_service_ms': self.service[name] * 1000,
+                    'mean_wait_ms': self.waited[name] / self.completed[name] * 1000 if self.completed[name] else None,
+                } for name in PRIORITIES},
+            }
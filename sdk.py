@@ -0,0 +1,479 @@
+"""Headless asyncio client for the chat server.
+
+AsyncChatClient speaks the wire protocol over one connection, with no GUI:
+it negotiates compression in hello and answers pings. Requests are
+pipelined: each gets a req_id, and many can be in flight at once. Every
+response the server builds for a request carries that req_id. History
+frames may come from the server's cache without one. They carry `contact`
+instead, and the server answers a connection's requests in order, so they
+go to the oldest open request for that conversation. Requests turned away
+with retry_after are sent again after the hint. When the connection drops,
+or the server announces a restart, the client connects again and repeats
+the last login. Everything the server pushes (incoming messages, contact
+changes) comes out of events(). Nothing blocks, so one event loop can
+drive hundreds of clients.
+
+Delivery is at least once. send_message() tags each message with a
+client_id and waits for the server's ack; after a reconnect it sends the
+message again with the same id, and the server stores it only once.
+Incoming messages are acknowledged in batches, at most ACK_DELAY seconds
+late. After each login the server sends again whatever was not
+acknowledged, and messages already seen are not passed to events() twice.
+
+    async with AsyncChatClient('localhost', 5000) as chat:
+        await chat.login('alice', 'secret')
+        await chat.send_message('bob', 'hi')
+        async for event in chat.events():
+            print(event)
+"""
+import asyncio
+import base64
+import hashlib
+import itertools
+import logging
+import random
+import ssl
+import uuid
+from collections import deque
+
+import compression
+import tls
+from protocol import FrameReader, encode_frame
+
+HISTORY_ACTIONS = ('history', 'history_chunk', 'history_end')
+RECONNECT_MAX_DELAY = 30
+ACK_DELAY = 0.2  # Столько секунд копятся подтверждения доставки перед отправкой
+ACK_BATCH = 100  # Или пока не наберётся столько сообщений
+SEEN_IDS = 4096  # Сколько последних id входящих сообщений помнить, чтобы отсеять повторы
+
+
+class ChatError(Exception):
+    """The server answered a request with status 'error'"""
+
+    def __init__(self, response):
+        super().__init__(response.get('message') or 'Unknown error')
+        self.response = response
+        self.retry_after = response.get('retry_after')
+
+
+class Pending:
+    """A request on the wire, waiting for its last response frame"""
+
+    __slots__ = ('future', 'final', 'contacts', 'partial', 'frames')
+
+    def __init__(self, message, future, partial):
+        self.future = future
+        self.partial = partial
+        self.frames = []
+        self.contacts = set()  # Собеседники, чья история придёт на этот запрос
+        action = message.get('action')
+        if action == 'batch':
+            self.final = 'batch'
+            requests = [r for r in message.get('requests', ()) if isinstance(r, dict)]
+        else:
+            self.final = 'history_end' if message.get('stream') else None
+            requests = [message]
+        for request in requests:
+            if request.get('action') == 'contacts' and request.get('contact_action') == 'history':
+                self.contacts.add(request.get('contact_username'))
+
+    def receive(self, frame):
+        """Take one response frame; returns True once it was the last one"""
+        action = frame.get('action')
+        if (self.final is None or action == self.final
+                or (self.final != 'batch' and frame.get('status') == 'error')):
+            self.future.set_result(frame)
+            return True
+        if self.final == 'batch':
+            self.frames.append(frame)
+        if self.partial:
+            self.partial(frame)
+        return False
+
+
+class AsyncChatClient:
+    def __init__(self, host='localhost', port=5000, tls_context=None, compression_dictionary=None,
+                 timeout=60, max_retries=3, reconnect=True):
+        self.host = host
+        self.port = port
+        self.tls_context = tls_context
+        self.tls_sessions = tls.SessionCache()  # Для возобновления TLS-сессии при переподключении
+        self.compression_dictionary = compression_dictionary
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.reconnect = reconnect
+        self.resume = None  # Вызывается при переподключении: запросы, которые уйдут в одном batch с логином
+        self.codec = None
+        self.batch_limit = 0  # Сколько запросов сервер примет в одном batch; 0 - batch не поддерживается
+        self.heartbeat_interval = None
+        self.username = None
+        self.credentials = None  # (username, password) последнего входа, для входа после переподключения
+        self.writer = None
+        self.receiver = None
+        self.pending = {}  # {req_id: Pending}, в порядке отправки
+        self.ids = itertools.count(1)
+        self.ready = asyncio.Event()  # Соединение открыто, и после переподключения вход повторён
+        self.queue = asyncio.Queue()
+        self.closed = False
+        self.reconnecting = None
+        self.acks = {}  # {отправитель: наибольший полученный id}, ещё не отправленные серверу
+        self.unacked = 0
+        self.ack_timer = None
+        self.seen = set()
+        self.seen_order = deque()
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Open the connection and negotiate compression"""
+        self.closed = False
+        await self._open()
+        self.ready.set()
+
+    async def close(self):
+        self._flush_acks()
+        self.closed = True
+        if self.reconnecting:
+            self.reconnecting.cancel()
+        self.ready.clear()
+        writer = self.writer
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        if self.receiver:
+            await asyncio.gather(self.receiver, return_exceptions=True)
+        self.queue.put_nowait(None)
+
+    async def _open(self):
+        context = self.tls_context
+        session = self.tls_sessions.get((self.host, self.port)) if context else None
+        if session is not None:
+            context = tls.ResumingContext(context, session)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                self.host, self.port, ssl=context, server_hostname=self.host if context else None), self.timeout)
+        except ssl.SSLError:
+            # Например, тикет устарел: следующая попытка пойдёт без него
+            self.tls_sessions.discard((self.host, self.port))
+            raise
+        self.writer, self.codec = writer, None
+        self.receiver = asyncio.create_task(self._receive(reader, writer))
+        hello = await self._request(compression.hello(self.compression_dictionary), wait=False)
+        if context:
+            # К этому моменту сервер уже прислал тикет для возобновления сессии
+            self.tls_sessions.store((self.host, self.port), writer.get_extra_info('ssl_object'))
+        self.batch_limit = hello.get('batch', 0)
+        self.heartbeat_interval = hello.get('heartbeat_interval')
+        name = hello.get('compression')
+        if name:
+            use_dictionary = hello.get('dictionary_id') is not None
+            self.codec = compression.FrameCodec(name, hello.get('threshold', compression.DEFAULT_THRESHOLD),
+                                                dictionary=self.compression_dictionary if use_dictionary else None)
+
+    async def _receive(self, reader, writer):
+        frames = FrameReader(self.compression_dictionary)
+        delay = 0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                frames.feed(data)
+                for message in frames.frames():
+                    action = message.get('action')
+                    if action in ('reconnect', 'busy'):
+                        # Сервер перезапускается или переполнен: уходим сами и возвращаемся позже
+                        delay = message.get('after') or message.get('retry_after') or 1
+                        writer.close()
+                        return
+                    self._dispatch(message)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Connection to {self.host}:{self.port} failed: {str(e)}")
+        finally:
+            writer.close()
+            self._lost(writer, delay)
+
+    def _dispatch(self, message):
+        if message.get('action') == 'ping':
+            try:
+                self._write({'action': 'pong'})
+            except ConnectionError:
+                pass
+            return
+        req_id = message.get('req_id')
+        if req_id is not None:
+            pending = self.pending.get(req_id)
+        elif message.get('action') in HISTORY_ACTIONS:
+            # Кадр из кэша истории: он для самого раннего запроса этой переписки
+            pending = next((p for p in self.pending.values() if message.get('contact') in p.contacts), None)
+            req_id = next((i for i, p in self.pending.items() if p is pending), None)
+        else:
+            pending = None
+        if pending is None:
+            if message.get('action') == 'message' and message.get('sender') and not self._received(message):
+                return  # Повторная доставка того, что уже пришло
+            self.queue.put_nowait(message)
+        elif pending.receive(message):
+            del self.pending[req_id]
+
+    def _received(self, message):
+        """Queue an ack for an incoming message; returns False if it was seen before"""
+        message_id, sender = message['id'], message.get('sender')
+        self.acks[sender] = max(self.acks.get(sender, 0), message_id)
+        self.unacked += 1
+        if self.unacked >= ACK_BATCH:
+            self._flush_acks()
+        elif self.ack_timer is None:
+            self.ack_timer = asyncio.get_running_loop().call_later(ACK_DELAY, self._flush_acks)
+        if message_id in self.seen:
+            return False
+        self.seen.add(message_id)
+        self.seen_order.append(message_id)
+        if len(self.seen_order) > SEEN_IDS:
+            self.seen.discard(self.seen_order.popleft())
+        return True
+
+    def _flush_acks(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        acks, self.acks, self.unacked = self.acks, {}, 0
+        if not acks:
+            return
+        try:
+            # Ответа на ack нет: потерянные подтверждения обернутся повторной доставкой
+            self._write({'action': 'ack', 'delivered': acks})
+        except ConnectionError:
+            pass
+
+    def _lost(self, writer, delay):
+        if writer is not self.writer:
+            return
+        self.writer = None
+        was_ready = self.ready.is_set()
+        self.ready.clear()
+        if self.ack_timer is not None:
+            # Неподтверждённое сервер пришлёт снова после входа
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.acks, self.unacked = {}, 0
+        pending, self.pending = self.pending, {}
+        for request in pending.values():
+            if not request.future.done():
+                request.future.set_exception(ConnectionError('Connection lost'))
+        if self.closed:
+            return
+        if was_ready:
+            self.queue.put_nowait({'action': 'disconnected'})
+        if self.reconnect and self.credentials and not self.reconnecting:
+            self.reconnecting = asyncio.create_task(self._reconnect(delay))
+
+    async def _reconnect(self, delay):
+        """Connect again with growing, jittered delays and repeat the last login"""
+        attempt = 0
+        try:
+            while not self.closed:
+                await asyncio.sleep(delay)
+                try:
+                    await self._open()
+                    await self._resume()
+                except ChatError as e:
+                    if not e.retry_after:
+                        logging.error(f"Could not log in again: {str(e)}")
+                        self.queue.put_nowait({'action': 'disconnected', 'message': str(e)})
+                        return
+                except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                    logging.info(f"Reconnect attempt {attempt + 1} failed: {str(e)}")
+                else:
+                    self.ready.set()
+                    self.queue.put_nowait({'action': 'connected'})
+                    return
+                if self.writer is not None:
+                    self.writer.close()
+                attempt += 1
+                # Новый процесс ещё не готов: ждём дольше, с разбросом, чтобы клиенты не пришли разом
+                delay = min(max(delay, 0.5) * 2, RECONNECT_MAX_DELAY) * random.uniform(0.8, 1.2)
+        finally:
+            self.reconnecting = None
+
+    async def _resume(self):
+        login = self.login_request(*self.credentials)
+        extra = self.resume() if self.resume else []
+        if not extra or not self.batch_limit:
+            await self._request(login, wait=False)
+            for request in extra:
+                self.queue.put_nowait(await self._request(request, self.queue.put_nowait, wait=False, check=False))
+            return
+        # Ответы остальных запросов уходят в events(), как если бы пришли сами
+        responses, results = await self._batch([login] + extra, self.queue.put_nowait, wait=False)
+        if results[0].get('status') != 'success':
+            raise ChatError(dict(results[0], retry_after=None))
+
+    def _write(self, message):
+        writer = self.writer
+        if writer is None or writer.is_closing():
+            raise ConnectionError('Not connected')
+        writer.write(encode_frame(message, self.codec))
+        return writer
+
+    async def _roundtrip(self, message, partial=None, wait=True):
+        """Send one request and wait for its last response frame; returns the Pending"""
+        if wait and not self.ready.is_set():
+            await asyncio.wait_for(self.ready.wait(), self.timeout)
+        req_id = next(self.ids)
+        pending = Pending(message, asyncio.get_running_loop().create_future(), partial)
+        writer = self._write(dict(message, req_id=req_id))
+        self.pending[req_id] = pending
+        try:
+            await writer.drain()
+            await asyncio.wait_for(asyncio.shield(pending.future), self.timeout)
+        finally:
+            self.pending.pop(req_id, None)
+        return pending
+
+    async def _request(self, message, partial=None, wait=True, check=True):
+        retries = self.max_retries
+        while True:
+            pending = await self._roundtrip(message, partial, wait)
+            response = pending.future.result()
+            if response.get('status') != 'error':
+                break
+            if response.get('retry_after') and retries > 0:
+                # Сервер перегружен и просит прийти позже
+                retries -= 1
+                await asyncio.sleep(response['retry_after'])
+                continue
+            if check:
+                raise ChatError(response)
+            break
+        if message.get('action') == 'login' and response.get('status') == 'success':
+            self.credentials = (message.get('username'), message.get('password'))
+            self.username = response.get('username', message.get('username'))
+        return response if pending.final != 'batch' else (pending.frames, response)
+
+    async def _batch(self, requests, partial=None, wait=True):
+        frames, response = await self._request({'action': 'batch', 'requests': requests}, partial, wait)
+        results = response.get('results', [])
+        for request, result in zip(requests, results):
+            if request.get('action') == 'login' and result.get('status') == 'success':
+                self.credentials = (request.get('username'), request.get('password'))
+                self.username = request.get('username')
+        return frames, results
+
+    async def request(self, message, partial=None):
+        """Send any request and return its response; partial() gets the frames before the last one.
+
+        Raises ChatError when the server answers with an error.
+        """
+        return await self._request(message, partial)
+
+    async def send(self, message):
+        """Send a message that has no response"""
+        if not self.ready.is_set():
+            await asyncio.wait_for(self.ready.wait(), self.timeout)
+        await self._write(message).drain()
+
+    async def batch(self, requests, partial=None):
+        """Run several requests in one round trip; returns (responses, results)"""
+        return await self._batch(requests, partial)
+
+    async def register(self, username, password):
+        return await self.request({'action': 'register', 'username': username, 'password': password})
+
+    @staticmethod
+    def login_request(username, password):
+        """A login request that asks the server to send again what we have not acknowledged"""
+        return {'action': 'login', 'username': username, 'password': password, 'acks': True}
+
+    async def login(self, username, password):
+        return await self.request(self.login_request(username, password))
+
+    async def send_message(self, receiver, content, client_id=None):
+        """Send a text message; returns the server's ack with the stored `id` and `timestamp`.
+
+        If the connection drops first, the message goes again after the
+        reconnect with the same client_id, up to max_retries times.
+        """
+        message = {'action': 'message', 'receiver': receiver, 'content': content,
+                   'client_id': client_id or uuid.uuid4().hex}
+        retries = self.max_retries
+        while True:
+            try:
+                return await self.request(message)
+            except ConnectionError:
+                if not self.reconnect or self.closed or retries == 0:
+                    raise
+                retries -= 1
+                await asyncio.wait_for(self.ready.wait(), self.timeout)
+
+    async def send_file(self, receiver, file_name, data):
+        """Upload bytes as a file message; returns the server's confirmation"""
+        return await self.request({'action': 'file', 'receiver': receiver, 'file_name': file_name,
+                                   'file_data': base64.b64encode(data).decode()})
+
+    async def history(self, contact, limit=None, before=None, on_chunk=None):
+        """Messages of a conversation, oldest first: the whole of it, or a page before `before`.
+
+        The whole conversation is streamed; on_chunk() gets each chunk as it arrives.
+        """
+        message = {'action': 'contacts', 'contact_action': 'history', 'contact_username': contact}
+        if limit is not None or before is not None:
+            message.update(limit=limit, before=before)
+            return (await self.request(message))['messages']
+        messages = []
+
+        def chunk(frame):
+            messages.extend(frame.get('messages', []))
+            if on_chunk:
+                on_chunk(frame.get('messages', []))
+        message['stream'] = True
+        await self.request(message, chunk)
+        return messages
+
+    async def contacts(self):
+        """Response with `contacts`, `presence` and `version`"""
+        return await self.request({'action': 'contacts', 'contact_action': 'list'})
+
+    async def add_contact(self, contact):
+        return await self.request({'action': 'contacts', 'contact_action': 'add', 'contact_username': contact})
+
+    async def remove_contact(self, contact):
+        return await self.request({'action': 'contacts', 'contact_action': 'remove', 'contact_username': contact})
+
+    async def conversations(self, limit=50):
+        return (await self.request({'action': 'conversations', 'limit': limit}))['conversations']
+
+    async def mark_read(self, contact):
+        return await self.request({'action': 'mark_read', 'contact_username': contact})
+
+    async def thumbnail(self, thumbnail_path):
+        response = await self.request({'action': 'thumbnail', 'thumbnail_path': thumbnail_path})
+        return base64.b64decode(response['data'])
+
+    async def attachment(self, file_path):
+        """Contents of a file sent in one of our conversations, checked against the server's hash"""
+        response = await self.request({'action': 'attachment', 'file_path': file_path})
+        data = base64.b64decode(response['data'])
+        if response.get('sha256') and hashlib.sha256(data).hexdigest() != response['sha256']:
+            raise ValueError(f'{file_path}: checksum mismatch')
+        return data
+
+    async def events(self):
+        """Messages pushed by the server, plus 'disconnected' and 'connected' notices; ends on close()"""
+        while True:
+            event = await self.queue.get()
+            if event is None:
+                return
+            yield event
@@ -1,12 +1,32 @@
 import socket
 import threading
 import json
-import sqlite3
 import os
 import bcrypt
-from datetime import datetime
 import logging
 import base64
+import hashlib
+import argparse
+import signal
+import ssl
+import sys
+import time
+import compression
+import handoff
+import heartbeat
+import profiler
+import protocol
+import scheduler
+from contact_cache import ContactCache
+from history_cache import HistoryCache
+import shards
+import storage
+import thumbnails
+import tls
+import traffic
+from protocol import FrameLimits, FrameReader, FrameTooLarge, MemoryBudget, encode_frame, wire_timestamp
+from session import Session, SessionRegistry
+from storage import SQLiteStorage
 
 # Configure logging
 logging.basicConfig(
@@ -18,124 +38,548 @@ logging.basicConfig(
     ]
 )
 
+HISTORY_CHUNK = 100  # Сообщений в одном кадре потоковой истории
+# Что можно положить в batch: без hello (меняет кодек), register (голый JSON) и тяжёлых file/операторских
+BATCH_ACTIONS = ('login', 'contacts', 'message', 'conversations', 'mark_read', 'thumbnail')
+MAX_BATCH = 100
+REDELIVER_BATCH = 200  # Недоставленных сообщений за одно чтение из хранилища при входе
+BATCH_FLUSH_BYTES = 256 * 1024  # Дольше копить ответы batch не стоит: длинная история уходит частями
+
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    def __init__(self, host='0.0.0.0', port=5000, compression_enabled=True,
+                 compression_threshold=compression.DEFAULT_THRESHOLD, compression_dictionary=None,
+                 tls_context=None, tls_handshake_timeout=10, heartbeat_interval=30, heartbeat_timeout=90,
+                 keepalive=(60, 10, 5), send_timeout=30, thumbnail_workers=2, storage=None,
+                 hot_retention=30 * 86400, compaction_interval=3600, listen_fd=None, drain_timeout=30,
+                 reconnect_spread=10, history_cache_bytes=32 * 1024 * 1024, frame_limits=None,
+                 read_budget_bytes=256 * 1024 * 1024, profile_dir='profiles', recorder=None,
+                 record_dir='recordings', record_raw=False, workers=16,
+                 max_connections=1000, max_queue_wait=5.0):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}  # {client_socket: username}
-        self.setup_database()
-        
-    def setup_database(self):
-        """Initialize SQLite database with required tables"""
-        conn = sqlite3.connect('chat.db')
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create contacts table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                contact_id INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (contact_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Create messages table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                receiver_id INTEGER,
-                content TEXT,
-                file_path TEXT,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        self.listen_fd = listen_fd  # Сокет, унаследованный от предыдущего процесса при перезапуске
+        self.server_socket = None
+        self.sessions = SessionRegistry()  # Состояние каждого соединения: Session по fd и по пользователю
+        self.compression_enabled = compression_enabled
+        self.compression_threshold = compression_threshold
+        self.compression_dictionary = compression_dictionary
+        self.tls_context = tls_context  # None - обычный TCP
+        self.tls_handshake_timeout = tls_handshake_timeout
+        self.heartbeat_interval = heartbeat_interval  # Пингуем сессию после стольких секунд тишины
+        self.heartbeat_timeout = heartbeat_timeout  # ...и выселяем, если тишина длится дольше этого
+        self.keepalive = keepalive  # (idle, interval, count) для TCP keepalive, None - выключен
+        self.send_timeout = send_timeout
+        self.heartbeat_wheel = heartbeat.TimerWheel(tick=1.0)
+        self.thumbnails = thumbnails.ThumbnailPipeline(workers=thumbnail_workers)
+        self.contact_cache = ContactCache()
+        # Готовые кадры history для частых повторных запросов; 0 - кэш выключен
+        self.history_cache = HistoryCache(history_cache_bytes) if history_cache_bytes else None
+        # Все обращения к данным идут через Storage; по умолчанию chat.db + шарды сообщений
+        self.storage = storage if storage is not None else SQLiteStorage()
+        self.hot_retention = hot_retention  # Сообщения старше стольких секунд уходят в архив, 0 - никогда
+        self.compaction_interval = compaction_interval
+        self.drain_timeout = drain_timeout  # Сколько ждать, пока сессии уйдут сами, перед перезапуском
+        self.reconnect_spread = reconnect_spread  # Клиенты возвращаются в течение стольких секунд
+        self.draining = threading.Event()
+        self.restarted = threading.Event()
+        self.frame_limits = frame_limits if frame_limits is not None else FrameLimits()
+        # Общий бюджет на недочитанные большие кадры всех соединений
+        self.read_budget = MemoryBudget(max(read_budget_bytes, self.frame_limits.max_frame))
+        self.profiler = profiler.Profiler(profile_dir)
+        self.recorder = recorder  # traffic.TrafficRecorder, пока идёт запись входящих кадров
+        self.record_dir = record_dir  # Только сюда пишет запись, начатая действием record
+        self.record_raw = record_raw  # Писать без замены данных можно только по флагу командной строки
+        # Запросы выполняет пул с честной очередью по соединениям; 0 - прямо в потоке соединения
+        self.scheduler = scheduler.Scheduler(workers, max_wait=max_queue_wait) if workers else None
+        self.max_connections = max_connections
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        self.rejected_connections = 0
+        self.batch_output = threading.local()  # Ответы batch, который выполняет этот поток
+        self.current_request = threading.local()  # Чей запрос выполняет этот поток и его req_id
         
     def start(self):
         """Start the server and listen for connections"""
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        logging.info(f"Server started on {self.host}:{self.port}")
+        self.server_socket = handoff.listening_socket(self.host, self.port, self.listen_fd)
+        # accept() с таймаутом, чтобы цикл замечал перезапуск
+        self.server_socket.settimeout(1.0)
+        logging.info(f"Server started on {self.host}:{self.port}" + (" (TLS)" if self.tls_context else "")
+                     + (" with an inherited socket" if self.listen_fd is not None else ""))
+        threading.Thread(target=self.reaper_loop, daemon=True).start()
+        if self.scheduler:
+            self.scheduler.start()
+        if self.hot_retention:
+            threading.Thread(target=self.retention_loop, daemon=True).start()
         
-        while True:
-            client_socket, address = self.server_socket.accept()
+        while not self.draining.is_set():
+            try:
+                client_socket, address = self.server_socket.accept()
+            except socket.timeout:
+                continue
             logging.info(f"New connection from {address}")
+            if not self.admit():
+                self.reject_connection(client_socket, address)
+                continue
+            # Маленькие кадры (рукопожатие TLS, ответы) не должны ждать Nagle + delayed ACK
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
             client_thread.start()
+        self.restarted.wait()
+            
+    def admit(self):
+        """Take a connection slot; False when the server is full"""
+        with self.connections_lock:
+            if self.connections >= self.max_connections:
+                self.rejected_connections += 1
+                return False
+            self.connections += 1
+            return True
+            
+    def reject_connection(self, client_socket, address):
+        logging.warning(f"Refusing {address}: {self.connections} connections open")
+        try:
+            if not self.tls_context:
+                # Через TLS до рукопожатия ничего не скажешь: просто закрываем
+                client_socket.settimeout(1.0)
+                client_socket.sendall(encode_frame({'action': 'busy', 'status': 'error', 'message': 'Server busy',
+                                                    'retry_after': handoff.reconnect_delay(self.reconnect_spread,
+                                                                                           minimum=1)}))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+            
+    def restart(self, script, argv):
+        """Hand the listening socket to a new process, drain the sessions and stop"""
+        if self.draining.is_set():
+            return
+        started = time.monotonic()
+        try:
+            process, release_fd = handoff.spawn_successor(self.server_socket, script, argv)
+        except Exception as e:
+            logging.error(f"Restart failed, still serving: {str(e)}")
+            return
+        logging.info(f"Restarting: successor pid {process.pid}, draining {len(self.sessions)} connections")
+        self.draining.set()
+        try:
+            for session in self.sessions.sessions():
+                self.send_reconnect(session.socket)
+            # Клиент закрывает соединение сам, уже отправив всё, что успел: такие запросы дообрабатываются
+            deadline = time.monotonic() + self.drain_timeout
+            while len(self.sessions) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            for session in self.sessions.sessions():
+                self.evict(session.socket, "server restart")
+            deadline = time.monotonic() + 5
+            while len(self.sessions) and time.monotonic() < deadline:
+                time.sleep(0.05)  # даём выселенным потокам дописать текущий запрос
+            self.stop_recording()
+            self.thumbnails.shutdown()
+            self.storage.close()
+        finally:
+            # Новый процесс ждёт этого, прежде чем открыть базы и начать accept()
+            os.close(release_fd)
+            logging.info(f"Handed over to pid {process.pid} after {time.monotonic() - started:.1f}s")
+            self.restarted.set()
+            
+    def send_reconnect(self, client_socket):
+        """Tell a session the server is restarting and when to come back"""
+        # Каждому своя задержка, чтобы логины (bcrypt) не пришли новому процессу разом
+        notice = {'action': 'reconnect', 'after': handoff.reconnect_delay(self.reconnect_spread)}
+        try:
+            self.send_json(client_socket, notice)
+        except OSError:
+            pass
+            
+    def reaper_loop(self):
+        """Ping idle sessions and evict the ones that stopped answering"""
+        while True:
+            time.sleep(self.heartbeat_wheel.tick)
+            for client_socket in self.heartbeat_wheel.advance():
+                try:
+                    self.check_heartbeat(client_socket)
+                except Exception as e:
+                    logging.error(f"Error checking heartbeat: {str(e)}")
+                    
+    def retention_loop(self):
+        """Periodically move old messages out of the hot shards into the archive"""
+        while True:
+            try:
+                started = time.monotonic()
+                moved = self.storage.compact(self.hot_retention)
+                if moved:
+                    logging.info(f"Archived {moved} messages in {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                logging.error(f"Error compacting messages: {str(e)}")
+            time.sleep(self.compaction_interval)
+            
+    def check_heartbeat(self, client_socket):
+        """Called by the timer wheel when a session may have gone quiet"""
+        session = self.sessions.get(client_socket)
+        if session is None:
+            return  # Сессия уже закрыта
+        idle = time.monotonic() - session.last_seen
+        if idle >= self.heartbeat_timeout:
+            self.evict_later(client_socket, f"no traffic for {idle:.0f}s")
+            return
+        if idle < self.heartbeat_interval:
+            # Клиент был активен: просто переносим таймер, пинг не нужен
+            self.heartbeat_wheel.schedule(client_socket, self.heartbeat_interval - idle)
+            return
+        try:
+            # Reaper обслуживает все соединения и не ждёт ни одно из них: если сокет занят
+            # другой записью или его буфер полон, пинг пропускаем, выселит таймаут тишины
+            if not self.send_nowait(client_socket, {'action': 'ping'}):
+                logging.debug(f"Skipped ping to {session.username or 'unknown'}: socket busy")
+        except OSError as e:
+            self.evict_later(client_socket, f"ping failed: {str(e)}")
+            return
+        self.heartbeat_wheel.schedule(client_socket, min(self.heartbeat_interval, self.heartbeat_timeout - idle))
+        
+    def evict_later(self, client_socket, reason):
+        """Evict from a short-lived thread: the presence deltas it pushes may block on other sockets"""
+        self.heartbeat_wheel.cancel(client_socket)
+        threading.Thread(target=self.evict, args=(client_socket, reason), daemon=True).start()
+        
+    def evict(self, client_socket, reason):
+        """Drop a dead session from routing and wake up its handler thread"""
+        username = self.end_session(client_socket)
+        self.heartbeat_wheel.cancel(client_socket)
+        logging.info(f"Evicting session {username or '(not logged in)'}: {reason}")
+        try:
+            # recv() в потоке handle_client вернёт b"", и он сам закроет сокет
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+            
+    def tls_handshake(self, client_socket):
+        """Run the TLS handshake in the connection's own thread, not in accept()"""
+        try:
+            client_socket.settimeout(self.tls_handshake_timeout)
+            tls_socket = self.tls_context.wrap_socket(client_socket, server_side=True)
+            tls_socket.settimeout(None)
+            logging.info(f"TLS handshake done ({tls_socket.version()}, resumed: {tls_socket.session_reused})")
+            return tls_socket
+        except (ssl.SSLError, OSError) as e:
+            logging.warning(f"TLS handshake failed: {str(e)}")
+            client_socket.close()
+            return None
             
     def handle_client(self, client_socket):
         """Handle individual client connections"""
-        buffer = b""
+        try:
+            if self.keepalive:
+                heartbeat.set_keepalive(client_socket, *self.keepalive)
+            if self.send_timeout:
+                heartbeat.set_send_timeout(client_socket, self.send_timeout)
+        except OSError as e:
+            logging.warning(f"Could not set socket options: {str(e)}")
+        if self.tls_context:
+            client_socket = self.tls_handshake(client_socket)
+            if client_socket is None:
+                self.release_connection()
+                return
+        session = Session(client_socket, FrameReader(self.compression_dictionary, self.frame_limits,
+                                                     self.read_budget))
+        reader = session.reader
+        self.sessions.add(session)
+        self.heartbeat_wheel.schedule(client_socket, self.heartbeat_interval)
+        if self.draining.is_set():
+            self.send_reconnect(client_socket)  # принято в последний момент перед перезапуском
         try:
             while True:
-                data = client_socket.recv(8192)
-                if not data:
+                # Читаем сразу в буфер сессии; для большого кадра writable() ждёт бюджета памяти,
+                # и пока он ждёт, сокет не читается - отправителя тормозит окно TCP
+                count = client_socket.recv_into(reader.writable())
+                if not count:
                     break
                     
-                buffer += data
+                session.last_seen = time.monotonic()
+                session.bytes_in += count
+                reader.commit(count)
+                # В одном recv может прийти несколько кадров (или часть кадра)
                 while True:
                     try:
-                        # Ищем начало JSON объекта
-                        start = buffer.find(b'{')
-                        if start == -1:
-                            buffer = b""
-                            break
-                        buffer = buffer[start:]
-                        
-                        # Пробуем декодировать JSON
-                        try:
-                            message = json.loads(buffer.decode())
-                            self.process_message(client_socket, message)
-                            buffer = b""
-                            break
-                        except json.JSONDecodeError:
-                            # Если JSON неполный, ждем следующую порцию данных
-                            break
-                            
+                        for message in reader.frames():
+                            session.frames_in += 1
+                            self.submit_message(client_socket, message)
+                        break
+                    except FrameTooLarge as e:
+                        self.reject_frame(client_socket, e)
                     except Exception as e:
                         logging.error(f"Error processing message: {str(e)}")
-                        buffer = b""
-                        break
                 
+        except FrameTooLarge as e:
+            # Bare JSON без длины нельзя пропустить, не дочитав: соединение закрываем
+            self.reject_frame(client_socket, e)
         except Exception as e:
             logging.error(f"Error handling client: {str(e)}")
         finally:
-            if client_socket in self.clients:
-                del self.clients[client_socket]
+            if self.scheduler:
+                # Всё, что клиент успел прислать до закрытия, дорабатывается, пока сессия ещё на месте
+                self.scheduler.drain(client_socket)
+            reader.close()
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.closed(client_socket)
+            self.end_session(client_socket)
+            # До close(): потом этот fd может достаться новому соединению
+            self.sessions.remove(session)
+            self.heartbeat_wheel.cancel(client_socket)
             client_socket.close()
+            self.release_connection()
+            
+    def release_connection(self):
+        with self.connections_lock:
+            self.connections -= 1
+            
+    def reject_frame(self, client_socket, error):
+        logging.warning(f"Rejected frame from {self.sessions.username(client_socket) or 'unknown'}: {error}")
+        try:
+            self.send_json(client_socket, {
+                'status': 'error',
+                'action': error.action or 'frame',
+                'message': 'Frame too large',
+                'size': error.size,
+                'limit': error.limit,
+            })
+        except OSError:
+            pass
+
+    def start_session(self, client_socket, username):
+        """Route messages for username to this socket and announce presence"""
+        session = self.sessions.get(client_socket)
+        if session is None or session.username == username:
+            return
+        self.end_session(client_socket)
+        self.contact_cache.load(username, lambda: self.storage.contacts(username))
+        self.sessions.login(session, username)
+        self.push_deltas(self.contact_cache.session_opened(username))
+        
+    def end_session(self, client_socket):
+        """Stop routing to this socket; returns the username it was logged in as"""
+        session = self.sessions.get(client_socket)
+        username = self.sessions.logout(session) if session else None
+        if username:
+            self.push_deltas(self.contact_cache.session_closed(username))
+        return username
+        
+    def sessions_of(self, username):
+        return [session.socket for session in self.sessions.of_user(username)]
+        
+    def codec_of(self, client_socket):
+        session = self.sessions.get(client_socket)
+        return session.codec if session else None
+        
+    def push_deltas(self, deltas):
+        """Send contacts_delta messages to every session of the interested users"""
+        for username, delta in deltas.items():
+            for client in self.sessions_of(username):
+                try:
+                    self.send_json(client, delta, reply=False)
+                except OSError as e:
+                    # Выселит reaper; здесь не трогаем, чтобы не уйти в рекурсию
+                    logging.warning(f"Could not push contacts delta to {username}: {str(e)}")
+                    
+    def send_json(self, client_socket, message, bare=False, reply=True):
+        """Send a message as one frame, compressed if the client negotiated it.
+
+        A reply to the request being handled gets its req_id; pushes (reply=False) never do.
+        """
+        session = self.sessions.get(client_socket)
+        codec = session.codec if session else None
+        request = self.current_request
+        if reply and getattr(request, 'socket', None) is client_socket and request.req_id is not None:
+            # Клиент сопоставляет ответ с запросом по req_id
+            message = dict(message, req_id=request.req_id)
+        output = self.batch_output
+        if getattr(output, 'socket', None) is client_socket:
+            if message.get('status') == 'error' and output.result is not None:
+                output.result.update(status='error', message=message.get('message'))
+            bare = False  # Ответы batch идут подряд в одной записи: без длины их не разделить
+        if bare and codec is None:
+            # Старые клиенты получают эти ответы как голый JSON без длины
+            data = json.dumps(message, ensure_ascii=False).encode()
+        else:
+            data = encode_frame(message, codec)
+        self.send_frame(client_socket, data)
+        
+    def send_frame(self, client_socket, data):
+        """Write an already encoded frame"""
+        output = self.batch_output
+        if getattr(output, 'socket', None) is client_socket:
+            # Внутри batch ответы копятся и уходят одной записью
+            output.frames.append(data)
+            output.size += len(data)
+            if output.size < BATCH_FLUSH_BYTES:
+                return
+            data = b''.join(output.frames)
+            output.frames, output.size = [], 0
+        session = self.sessions.get(client_socket)
+        if session is None:
+            client_socket.sendall(data)
+            return
+        with session.send_lock:
+            client_socket.sendall(data)
+            session.frames_out += 1
+            session.bytes_out += len(data)
+            
+    def send_nowait(self, client_socket, message):
+        """Send a small push only if that cannot block; False if the socket is busy or its buffer is full"""
+        session = self.sessions.get(client_socket)
+        if session is None or not session.send_lock.acquire(blocking=False):
+            return False
+        try:
+            if not heartbeat.can_send(client_socket):
+                return False
+            data = encode_frame(message, session.codec)
+            client_socket.sendall(data)
+            session.frames_out += 1
+            session.bytes_out += len(data)
+            return True
+        finally:
+            session.send_lock.release()
+            
+    def submit_message(self, client_socket, message):
+        """Hand a decoded request to the scheduler (or run it here without one)"""
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.frame(client_socket, message, self.sessions.username(client_socket))
+        if self.scheduler is None:
+            self.process_message(client_socket, message)
+            return
+        retry_after = self.scheduler.submit(client_socket, scheduler.priority_of(message),
+                                            lambda: self.process_message(client_socket, message))
+        if retry_after is not None:
+            self.send_busy(client_socket, message, retry_after)
+            
+    def send_busy(self, client_socket, message, retry_after):
+        """Overloaded: answer the request with a retry hint instead of running it"""
+        action = message.get('action')
+        if action == 'contacts':
+            # Ответ приходит под тем же action, что и обычный ответ на этот запрос
+            action = message.get('contact_action') or 'contacts'
+            if action == 'history' and message.get('stream'):
+                action = 'history_end'
+        response = {'status': 'error', 'action': action, 'message': 'Server busy', 'retry_after': retry_after}
+        if message.get('req_id') is not None:
+            response['req_id'] = message['req_id']
+        try:
+            self.send_json(client_socket, response)
+        except OSError:
+            pass
             
     def process_message(self, client_socket, message):
         """Process incoming messages from clients"""
+        request = self.current_request
+        request.socket, request.req_id = client_socket, message.get('req_id')
+        try:
+            self.profiler.call(message.get('action'), self.dispatch_message, client_socket, message)
+        finally:
+            request.socket = request.req_id = None
+        
+    def dispatch_message(self, client_socket, message):
         action = message.get('action')
         
-        if action == 'register':
+        if action == 'hello':
+            self.handle_hello(client_socket, message)
+        elif action == 'ping':
+            self.send_json(client_socket, {'action': 'pong'})
+        elif action == 'pong':
+            pass  # last_seen уже обновлён в handle_client
+        elif action == 'register':
             self.handle_registration(client_socket, message)
         elif action == 'login':
             self.handle_login(client_socket, message)
         elif action == 'message':
             self.handle_message(client_socket, message)
+        elif action == 'ack':
+            self.handle_ack(client_socket, message)
         elif action == 'file':
             self.handle_file_transfer(client_socket, message)
         elif action == 'contacts':
             self.handle_contacts(client_socket, message)
+        elif action == 'thumbnail':
+            self.handle_thumbnail(client_socket, message)
+        elif action == 'attachment':
+            self.handle_attachment(client_socket, message)
+        elif action == 'conversations':
+            self.handle_conversations(client_socket, message)
+        elif action == 'mark_read':
+            self.handle_mark_read(client_socket, message)
+        elif action == 'batch':
+            self.handle_batch(client_socket, message)
+        elif action == 'stats':
+            self.handle_stats(client_socket)
+        elif action == 'profile':
+            self.handle_profile(client_socket, message)
+        elif action == 'record':
+            self.handle_record(client_socket, message)
+            
+    def handle_batch(self, client_socket, message):
+        """Run several requests in order and write all their responses back at once.
+
+        The usual responses come first, in order, followed by a batch frame
+        with one result per request. Storage calls share one transaction
+        where the engine supports it.
+        """
+        requests = message.get('requests')
+        response = {'action': 'batch'}
+        if 'id' in message:
+            response['id'] = message['id']
+        if message.get('req_id') is not None:
+            response['req_id'] = message['req_id']  # последний кадр уходит мимо send_json
+        if not isinstance(requests, list) or not requests or len(requests) > MAX_BATCH:
+            response.update(status='error', message=f'A batch holds 1 to {MAX_BATCH} requests')
+            self.send_json(client_socket, response)
+            return
+        output = self.batch_output
+        output.socket, output.frames, output.size, output.result = client_socket, [], 0, None
+        results = []
+        try:
+            with self.storage.batch():
+                for request in requests:
+                    action = request.get('action') if isinstance(request, dict) else None
+                    result = {'action': action, 'status': 'success'}
+                    results.append(result)
+                    if action not in BATCH_ACTIONS:
+                        result.update(status='error', message='Not allowed in a batch')
+                        continue
+                    output.result = result
+                    try:
+                        self.dispatch_message(client_socket, request)
+                    except OSError:
+                        raise
+                    except Exception as e:
+                        logging.error(f"Error in batch {action}: {str(e)}")
+                        result.update(status='error', message=str(e))
+            frames = output.frames
+            response.update(status='success', results=results)
+        except OSError:
+            raise
+        except Exception as e:
+            # Транзакция откатилась: накопленные ответы не отправляем
+            logging.error(f"Batch failed: {str(e)}")
+            frames = []
+            response.update(status='error', message=str(e))
+        finally:
+            output.socket = output.frames = output.result = None
+        self.send_frame(client_socket, b''.join(frames + [encode_frame(response, self.codec_of(client_socket))]))
+        
+    def handle_hello(self, client_socket, message):
+        """Negotiate per-frame compression for this connection"""
+        if not self.compression_enabled:
+            message = dict(message, compression=[])
+        codec, response = compression.negotiate(message, self.compression_threshold,
+                                                self.compression_dictionary)
+        response['heartbeat_interval'] = self.heartbeat_interval
+        response['batch'] = MAX_BATCH  # Клиент может слать batch не длиннее этого
+        # Ответ на hello ещё не сжимаем: клиент узнает о кодеке только из него
+        self.send_json(client_socket, response)
+        session = self.sessions.get(client_socket)
+        if codec and session:
+            session.codec = codec
+            logging.info(f"Negotiated {codec.name} compression (dictionary: {bool(codec.dictionary)})")
             
     def handle_registration(self, client_socket, message):
         """Handle user registration"""
@@ -143,25 +587,16 @@ class ChatServer:
         password = message.get('password')
         
         try:
-            conn = sqlite3.connect('chat.db')
-            cursor = conn.cursor()
-            
             # Hash password
             hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-            
-            cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)',
-                         (username, hashed_password))
-            conn.commit()
-            
+            self.storage.create_user(username, hashed_password)
             response = {'status': 'success', 'message': 'Registration successful', 'action': 'register'}
-        except sqlite3.IntegrityError:
+        except storage.UserExistsError:
             response = {'status': 'error', 'message': 'Username already exists', 'action': 'register'}
         except Exception as e:
             response = {'status': 'error', 'message': str(e), 'action': 'register'}
-        finally:
-            conn.close()
             
-        client_socket.send(json.dumps(response, ensure_ascii=False).encode())
+        self.send_json(client_socket, response, bare=True)
         
     def handle_login(self, client_socket, message):
         """Handle user login"""
@@ -170,15 +605,15 @@ class ChatServer:
         
         logging.info(f"Login attempt for user: {username}")
         
+        held = False
         try:
-            conn = sqlite3.connect('chat.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT id, password FROM users WHERE username = ?', (username,))
-            result = cursor.fetchone()
+            password_hash = self.storage.password_hash(username)
             
-            if result and bcrypt.checkpw(password.encode(), result[1]):
-                self.clients[client_socket] = username
+            if password_hash and bcrypt.checkpw(password.encode(), password_hash):
+                if message.get('acks'):
+                    # До маршрутизации: новые сообщения пойдут только после недоставленных
+                    held = self.hold_forwards(client_socket)
+                self.start_session(client_socket, username)
                 response = {
                     'status': 'success',
                     'message': 'Login successful',
@@ -195,13 +630,10 @@ class ChatServer:
                 logging.warning(f"Login failed for user: {username}")
                 
             # Отправляем ответ
-            response_data = json.dumps(response, ensure_ascii=False).encode()
-            # Отправляем размер данных
-            size_data = len(response_data).to_bytes(4, byteorder='big')
-            client_socket.send(size_data)
-            # Отправляем данные
-            client_socket.send(response_data)
+            self.send_json(client_socket, response)
             logging.info(f"Sent login response to {username}")
+            if held:
+                self.redeliver(client_socket, username)
             
         except Exception as e:
             logging.error(f"Error during login: {str(e)}")
@@ -210,60 +642,142 @@ class ChatServer:
                 'message': str(e),
                 'action': 'login'
             }
-            response_data = json.dumps(response, ensure_ascii=False).encode()
-            size_data = len(response_data).to_bytes(4, byteorder='big')
-            client_socket.send(size_data)
-            client_socket.send(response_data)
+            self.send_json(client_socket, response)
         finally:
-            conn.close()
+            if held:
+                self.release_forwards(client_socket)
         
     def handle_message(self, client_socket, message):
-        """Handle text messages"""
-        sender = self.clients.get(client_socket)
+        """Handle text messages.
+
+        A message with a client_id is stored once however often it is sent,
+        and the sender gets an ack with the stored id. Without one there is
+        no reply.
+        """
+        sender = self.sessions.username(client_socket)
         receiver = message.get('receiver')
         content = message.get('content')
+        client_id = message.get('client_id')
+        ack = {'action': 'message', 'client_id': client_id, 'receiver': receiver}
         
         if not all([sender, receiver, content]):
+            if client_id is not None:
+                self.send_json(client_socket, dict(ack, status='error', message='Missing receiver or content'))
             return
             
         try:
-            conn = sqlite3.connect('chat.db')
-            cursor = conn.cursor()
-            
-            # Get user IDs
-            cursor.execute('SELECT id FROM users WHERE username = ?', (sender,))
-            sender_id = cursor.fetchone()[0]
-            cursor.execute('SELECT id FROM users WHERE username = ?', (receiver,))
-            receiver_id = cursor.fetchone()[0]
-            
-            # Store message
-            cursor.execute('''
-                INSERT INTO messages (sender_id, receiver_id, content)
-                VALUES (?, ?, ?)
-            ''', (sender_id, receiver_id, content))
-            conn.commit()
+            stored = self.storage.store_message(sender, receiver, content, client_id=client_id)
+            self.invalidate_history(sender, receiver)
             
-            # Forward message to receiver if online
-            for client, username in self.clients.items():
-                if username == receiver:
-                    forward_message = {
-                        'action': 'message',
-                        'sender': sender,
-                        'content': content,
-                        'timestamp': datetime.now().isoformat(),
-                        'receiver': receiver
-                    }
-                    client.send(json.dumps(forward_message, ensure_ascii=False).encode())
-                    break
+            # Forward message to every session of the receiver (one per device)
+            for client in self.sessions_of(receiver):
+                try:
+                    self.forward(client, self.delivery(stored), bare=True)
+                except OSError as e:
+                    # Мёртвый сокет не должен оставаться в маршрутизации; получатель
+                    # получит сообщение при следующем входе
+                    self.evict(client, f"forward failed: {str(e)}")
                     
         except Exception as e:
             logging.error(f"Error handling message: {str(e)}")
-        finally:
-            conn.close()
+            if client_id is not None:
+                self.send_json(client_socket, dict(ack, status='error', message=str(e)))
+            return
+        if client_id is not None:
+            self.send_json(client_socket, dict(ack, status='success', id=stored.id,
+                                               timestamp=wire_timestamp(stored.sent_at)))
+            
+    def delivery(self, row):
+        """The frame that brings a stored message to its receiver"""
+        message = {
+            'action': 'message',
+            'sender': row.sender,
+            'receiver': row.receiver,
+            'content': row.content,
+            'id': row.id,
+            'timestamp': wire_timestamp(row.sent_at)
+        }
+        if row.file_path:
+            message['is_file'] = True
+            message['file_path'] = row.file_path
+        if row.thumbnail_path:
+            message['thumbnail_path'] = row.thumbnail_path
+            message['image'] = json.loads(row.file_meta) if row.file_meta else None
+        return message
+        
+    def forward(self, client_socket, message, bare=False):
+        """Push a new message to one session of its receiver, behind a redelivery still running there"""
+        session = self.sessions.get(client_socket)
+        if session is not None:
+            with session.send_lock:
+                if session.backlog is not None:
+                    session.backlog.append((message, bare))
+                    return
+        self.send_json(client_socket, message, bare=bare, reply=False)
+        
+    def hold_forwards(self, client_socket):
+        """Queue new messages for this session until release_forwards(); False if it is gone"""
+        session = self.sessions.get(client_socket)
+        if session is None:
+            return False
+        with session.send_lock:
+            session.backlog = []
+        return True
+        
+    def release_forwards(self, client_socket):
+        """Send the messages queued during redelivery, in arrival order, then forward directly again"""
+        session = self.sessions.get(client_socket)
+        if session is None:
+            return
+        while True:
+            with session.send_lock:
+                queued = session.backlog
+                session.backlog = [] if queued else None
+            if not queued:
+                return
+            # Отправляем вне блокировки: пришедшие тем временем встанут в очередь за этими
+            for message, bare in queued:
+                try:
+                    self.send_json(client_socket, message, bare=bare, reply=False)
+                except OSError as e:
+                    with session.send_lock:
+                        session.backlog = None
+                    # Неподтверждённое придёт при следующем входе
+                    self.evict(client_socket, f"forward failed: {str(e)}")
+                    return
+                    
+    def redeliver(self, client_socket, username):
+        """Push every message username's clients have not acknowledged yet, oldest first"""
+        after = 0
+        try:
+            while True:
+                rows = self.storage.undelivered(username, after, REDELIVER_BATCH)
+                for row in rows:
+                    self.send_json(client_socket, dict(self.delivery(row), redelivered=True), reply=False)
+                if len(rows) < REDELIVER_BATCH:
+                    return
+                after = rows[-1].id
+        except OSError:
+            raise
+        except Exception as e:
+            logging.error(f"Error redelivering messages to {username}: {str(e)}")
+            
+    def handle_ack(self, client_socket, message):
+        """Move the delivery cursors of the logged-in user; acks get no reply"""
+        username = self.sessions.username(client_socket)
+        delivered = message.get('delivered')
+        if not username or not isinstance(delivered, dict):
+            return
+        cursors = {contact: message_id for contact, message_id in delivered.items()
+                   if isinstance(message_id, int)}
+        try:
+            self.storage.mark_delivered(username, cursors)
+        except Exception as e:
+            logging.error(f"Error storing delivery acks: {str(e)}")
             
     def handle_file_transfer(self, client_socket, message):
         """Handle file transfers"""
-        sender = self.clients.get(client_socket)
+        sender = self.sessions.username(client_socket)
         receiver = message.get('receiver')
         file_data = message.get('file_data')
         file_name = message.get('file_name')
@@ -277,17 +791,10 @@ class ChatServer:
                 'status': 'error',
                 'message': 'Missing required file transfer data'
             }
-            response_data = json.dumps(response, ensure_ascii=False).encode()
-            size_data = len(response_data).to_bytes(4, byteorder='big')
-            client_socket.send(size_data)
-            client_socket.send(response_data)
+            self.send_json(client_socket, response)
             return
             
         try:
-            # Create files directory if it doesn't exist
-            if not os.path.exists('files'):
-                os.makedirs('files')
-                
             # Декодируем file_data из base64
             try:
                 file_bytes = base64.b64decode(file_data)
@@ -299,23 +806,13 @@ class ChatServer:
                     'status': 'error',
                     'message': f'Error decoding file data: {str(e)}'
                 }
-                response_data = json.dumps(response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                self.send_json(client_socket, response)
                 return
             
-            # Save file with normalized path
-            timestamp = datetime.now().timestamp()
-            safe_filename = f"{timestamp}_{file_name}"
-            file_path = os.path.join('files', safe_filename)
-            # Нормализуем путь для хранения и передачи
-            file_path = os.path.normpath(file_path)
-            file_path_for_clients = file_path.replace('\\', '/')
-            
             try:
-                with open(file_path, 'wb') as f:
-                    f.write(file_bytes)
+                # Путь уже нормализован; клиентам и в БД отдаём его с прямыми слэшами
+                file_path = self.storage.save_file(file_name, file_bytes)
+                file_path_for_clients = file_path.replace('\\', '/')
                 logging.info(f"File saved successfully at {file_path}")
             except Exception as e:
                 logging.error(f"Error saving file: {str(e)}")
@@ -324,28 +821,24 @@ class ChatServer:
                     'status': 'error',
                     'message': f'Error saving file: {str(e)}'
                 }
-                response_data = json.dumps(response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                self.send_json(client_socket, response)
                 return
                 
+            # Для изображений размеры и MIME читаем из заголовка сразу, а превью
+            # рисуется в фоне; путь к нему известен заранее
+            image_meta = thumbnails.probe(file_path)
+            thumbnail_for_clients = None
+            if image_meta:
+                self.thumbnails.submit(file_path, image_meta)
+                thumbnail_for_clients = thumbnails.thumbnail_path(file_path_for_clients)
+                
             # Store file reference in database
-            conn = sqlite3.connect('chat.db')
-            cursor = conn.cursor()
-            
             try:
-                cursor.execute('SELECT id FROM users WHERE username = ?', (sender,))
-                sender_id = cursor.fetchone()[0]
-                cursor.execute('SELECT id FROM users WHERE username = ?', (receiver,))
-                receiver_id = cursor.fetchone()[0]
-                
-                # Сохраняем путь с прямыми слэшами в БД
-                cursor.execute('''
-                    INSERT INTO messages (sender_id, receiver_id, file_path, content)
-                    VALUES (?, ?, ?, ?)
-                ''', (sender_id, receiver_id, file_path_for_clients, f"[File: {file_name}]"))
-                conn.commit()
+                stored = self.storage.store_message(sender, receiver, f"[File: {file_name}]",
+                                                    file_path=file_path_for_clients,
+                                                    thumbnail_path=thumbnail_for_clients,
+                                                    file_meta=json.dumps(image_meta) if image_meta else None)
+                self.invalidate_history(sender, receiver)
                 logging.info(f"File reference stored in database for {file_name}")
             except Exception as e:
                 logging.error(f"Error storing file in database: {str(e)}")
@@ -354,33 +847,18 @@ class ChatServer:
                     'status': 'error',
                     'message': f'Error storing file in database: {str(e)}'
                 }
-                response_data = json.dumps(response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                self.send_json(client_socket, response)
                 return
             
-            # Forward file to receiver if online
-            for client, username in self.clients.items():
-                if username == receiver:
-                    try:
-                        forward_message = {
-                            'action': 'message',
-                            'sender': sender,
-                            'content': f"[File: {file_name}]",
-                            'is_file': True,
-                            'file_path': file_path_for_clients, # Отправляем путь с прямыми слэшами
-                            'timestamp': datetime.now().isoformat()
-                        }
-                        # Отправляем размер данных
-                        json_data = json.dumps(forward_message, ensure_ascii=False).encode()
-                        size_data = len(json_data).to_bytes(4, byteorder='big')
-                        client.send(size_data)
-                        client.send(json_data)
-                        logging.info(f"File forwarded to {receiver}")
-                    except Exception as e:
-                        logging.error(f"Error forwarding file: {str(e)}")
-                    break
+            # Forward file to every session of the receiver
+            for client in self.sessions_of(receiver):
+                try:
+                    self.forward(client, self.delivery(stored))
+                    logging.info(f"File forwarded to {receiver}")
+                except OSError as e:
+                    self.evict(client, f"forward failed: {str(e)}")
+                except Exception as e:
+                    logging.error(f"Error forwarding file: {str(e)}")
                     
             # Отправляем подтверждение отправителю
             try:
@@ -389,12 +867,13 @@ class ChatServer:
                     'status': 'success',
                     'file_name': file_name,
                     'file_path': file_path_for_clients, # Отправляем путь с прямыми слэшами
-                    'timestamp': datetime.now().isoformat()
+                    'id': stored.id,
+                    'timestamp': wire_timestamp(stored.sent_at)
                 }
-                response_data = json.dumps(confirmation, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                if image_meta:
+                    confirmation['thumbnail_path'] = thumbnail_for_clients
+                    confirmation['image'] = image_meta
+                self.send_json(client_socket, confirmation)
                 logging.info(f"Sent confirmation to sender {sender}")
             except Exception as e:
                 logging.error(f"Error sending confirmation: {str(e)}")
@@ -407,114 +886,414 @@ class ChatServer:
                     'status': 'error',
                     'message': str(e)
                 }
-                response_data = json.dumps(error_response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                self.send_json(client_socket, error_response)
             except:
                 pass
-        finally:
-            conn.close()
             
+    def handle_conversations(self, client_socket, message):
+        """Return the inbox: one row per conversation, most recent first"""
+        username = self.sessions.username(client_socket)
+        try:
+            limit = max(1, min(int(message.get('limit') or 50), 500))
+        except (TypeError, ValueError):
+            self.send_json(client_socket, {'status': 'error', 'action': 'conversations',
+                                           'message': 'limit must be a number'})
+            return
+        try:
+            conversations = [{
+                'contact': row.contact,
+                'last_message': row.last_message,
+                'last_sender': row.last_sender,
+                'last_activity': wire_timestamp(row.last_activity) if row.last_activity else None,
+                'unread_count': row.unread_count,
+                'last_message_id': row.last_message_id
+            } for row in self.storage.conversations(username, limit)]
+            response = {'status': 'success', 'action': 'conversations', 'conversations': conversations}
+        except Exception as e:
+            logging.error(f"Error loading conversations: {str(e)}")
+            response = {'status': 'error', 'action': 'conversations', 'message': str(e)}
+        self.send_json(client_socket, response)
+        
+    def handle_mark_read(self, client_socket, message):
+        """Move the read cursor of one conversation to its latest message"""
+        username = self.sessions.username(client_socket)
+        contact_username = message.get('contact_username')
+        try:
+            self.storage.mark_read(username, contact_username)
+            response = {'status': 'success', 'action': 'mark_read', 'contact': contact_username}
+        except Exception as e:
+            logging.error(f"Error marking conversation read: {str(e)}")
+            response = {'status': 'error', 'action': 'mark_read', 'message': str(e)}
+        self.send_json(client_socket, response)
+        
+    def handle_thumbnail(self, client_socket, message):
+        """Send a cached image thumbnail to a participant of the conversation"""
+        username = self.sessions.username(client_socket)
+        thumbnail_path = message.get('thumbnail_path')
+        response = {'action': 'thumbnail', 'thumbnail_path': thumbnail_path}
+        try:
+            # Отдаём превью только участникам переписки, где оно было отправлено
+            file_path = self.storage.thumbnail_source(username, thumbnail_path) if username else None
+            if not file_path:
+                response.update(status='error', message='Thumbnail not found')
+            else:
+                path = self.thumbnails.wait(os.path.normpath(file_path))
+                if path is None:
+                    response.update(status='error', message='Thumbnail is not available')
+                else:
+                    with open(path, 'rb') as f:
+                        response.update(status='success', data=base64.b64encode(f.read()).decode())
+        except Exception as e:
+            logging.error(f"Error sending thumbnail: {str(e)}")
+            response.update(status='error', message=str(e))
+        self.send_json(client_socket, response)
+
+    def handle_attachment(self, client_socket, message):
+        """Send a stored file to a participant of the conversation it was sent in"""
+        username = self.sessions.username(client_socket)
+        file_path = message.get('file_path')
+        response = {'action': 'attachment', 'file_path': file_path}
+        try:
+            source = self.storage.attachment_source(username, file_path) if username and file_path else None
+            if not source:
+                response.update(status='error', message='File not found')
+            else:
+                with open(os.path.normpath(source), 'rb') as f:
+                    data = f.read()
+                # По sha256 клиент проверяет загрузку и находит файл в своём кэше
+                response.update(status='success', size=len(data), sha256=hashlib.sha256(data).hexdigest(),
+                                data=base64.b64encode(data).decode())
+        except FileNotFoundError:
+            response.update(status='error', message='File not found')
+        except Exception as e:
+            logging.error(f"Error sending attachment: {str(e)}")
+            response.update(status='error', message=str(e))
+        self.send_json(client_socket, response)
+            
+    def history_entry(self, row):
+        entry = {
+            'id': row.id,
+            'sender': row.sender,
+            'content': row.content,
+            'file_path': row.file_path,
+            'timestamp': wire_timestamp(row.sent_at)
+        }
+        if row.thumbnail_path:
+            entry['thumbnail_path'] = row.thumbnail_path
+            entry['image'] = json.loads(row.file_meta) if row.file_meta else None
+        return entry
+        
+    def stream_history(self, client_socket, username, contact, codec):
+        """Send a whole conversation as history_chunk frames and a history_end marker.
+
+        Only one chunk is held at a time. A failure still ends the stream,
+        with an error history_end. Returns all frames joined, for the
+        history cache, or None once they outgrow what the cache would keep.
+        """
+        frames = []
+        size = 0
+        count = 0
+        limit = self.history_cache.max_entry_bytes if self.history_cache else 0
+        try:
+            for rows in self.storage.iter_history(username, contact, batch=HISTORY_CHUNK):
+                frame = encode_frame({'action': 'history_chunk', 'contact': contact,
+                                      'messages': [self.history_entry(row) for row in rows]}, codec)
+                self.send_frame(client_socket, frame)
+                count += len(rows)
+                if frames is not None:
+                    size += len(frame)
+                    if size <= limit:
+                        frames.append(frame)
+                    else:
+                        frames = None  # больше, чем кэш согласится хранить: дальше не копим
+        except OSError:
+            raise
+        except Exception as e:
+            # Поток всегда заканчивается маркером, иначе клиент будет ждать его вечно
+            self.send_json(client_socket, {'status': 'error', 'action': 'history_end', 'contact': contact,
+                                           'count': count, 'message': str(e)})
+            return None
+        end = encode_frame({'status': 'success', 'action': 'history_end', 'contact': contact, 'count': count},
+                           codec)
+        self.send_frame(client_socket, end)
+        return b''.join(frames + [end]) if frames is not None and size + len(end) <= limit else None
+        
+    def invalidate_history(self, sender, receiver):
+        if self.history_cache:
+            self.history_cache.invalidate(sender, receiver)
+            
+    def operator_only(self, client_socket, action):
+        """Whether an operator request came over loopback; answers 'Not allowed' otherwise"""
+        try:
+            peer = client_socket.getpeername()[0]
+        except OSError:
+            return False
+        if peer not in ('127.0.0.1', '::1'):
+            self.send_json(client_socket, {'status': 'error', 'action': action, 'message': 'Not allowed'})
+            return False
+        return True
+        
+    def handle_stats(self, client_socket):
+        """Server metrics for operators; only answered on loopback connections"""
+        if not self.operator_only(client_socket, 'stats'):
+            return
+        response = {
+            'status': 'success',
+            'action': 'stats',
+            'connections': len(self.sessions),
+            'sessions': self.sessions.logged_in(),
+            'history_cache': self.history_cache.stats() if self.history_cache else None,
+            'read_budget': self.read_budget.stats(),
+            'scheduler': self.scheduler.stats() if self.scheduler else None,
+            'rejected_connections': self.rejected_connections,
+        }
+        self.send_json(client_socket, response)
+        
+    def handle_profile(self, client_socket, message):
+        """Profile the server for a few seconds (loopback only); answers when the window closes"""
+        if not self.operator_only(client_socket, 'profile'):
+            return
+        try:
+            summary = self.profile(float(message.get('seconds', 10)))
+            response = dict(summary, status='success', action='profile')
+        except (RuntimeError, ValueError) as e:
+            response = {'status': 'error', 'action': 'profile', 'message': str(e)}
+        self.send_json(client_socket, response)
+        
+    def handle_record(self, client_socket, message):
+        """Start or stop recording inbound traffic (loopback only)"""
+        if not self.operator_only(client_socket, 'record'):
+            return
+        try:
+            if message.get('stop'):
+                summary = self.stop_recording()
+                if summary is None:
+                    raise RuntimeError('Not recording')
+            else:
+                summary = self.start_recording(self.recording_path(message.get('path') or 'traffic.jsonl.gz'),
+                                               redact=not self.record_raw, overwrite=False)
+            response = dict(summary, status='success', action='record')
+        except (RuntimeError, ValueError, OSError) as e:
+            response = {'status': 'error', 'action': 'record', 'message': str(e)}
+        self.send_json(client_socket, response)
+        
+    def recording_path(self, name):
+        """Where a recording requested over the wire goes: a new file directly in record_dir"""
+        # Из сети приходит только имя файла: ни каталогов, ни перезаписи существующих файлов
+        if not isinstance(name, str) or name in ('.', '..') or os.path.basename(name) != name \
+                or (os.altsep and os.altsep in name):
+            raise ValueError('path must be a file name; recordings go to the server\'s record directory')
+        os.makedirs(self.record_dir, exist_ok=True)
+        return os.path.join(self.record_dir, name)
+        
+    def start_recording(self, path, redact=True, overwrite=True):
+        if self.recorder is not None:
+            raise RuntimeError(f'Already recording to {self.recorder.path}')
+        self.recorder = traffic.TrafficRecorder(path, redact, overwrite)
+        logging.info(f"Recording traffic to {path}" + ("" if redact else " (not redacted)"))
+        return {'path': os.path.abspath(path)}
+        
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return None
+        summary = recorder.close()
+        logging.info(f"Recorded {summary['frames']} frames from {summary['connections']} connections "
+                     f"to {summary['path']}")
+        return summary
+        
+    def profile(self, seconds):
+        logging.info(f"Profiling for {seconds:g}s")
+        summary = self.profiler.run(seconds)
+        logging.info(f"Profile written to {summary['folded']} ({summary['samples']} samples, "
+                     f"sampler overhead {summary['sampler_overhead']:.2%})")
+        return summary
+        
     def handle_contacts(self, client_socket, message):
         """Handle contact management"""
-        username = self.clients.get(client_socket)
+        username = self.sessions.username(client_socket)
         action = message.get('contact_action')
         contact_username = message.get('contact_username')
         
         try:
-            conn = sqlite3.connect('chat.db')
-            cursor = conn.cursor()
-            
             if action == 'add':
                 # Проверяем, существует ли контакт
-                cursor.execute('SELECT id FROM users WHERE username = ?', (contact_username,))
-                contact = cursor.fetchone()
-                if not contact:
+                if not self.storage.user_exists(contact_username):
                     response = {'status': 'error', 'message': 'Contact user does not exist', 'action': 'contacts'}
-                    response_data = json.dumps(response, ensure_ascii=False).encode()
-                    size_data = len(response_data).to_bytes(4, byteorder='big')
-                    client_socket.send(size_data)
-                    client_socket.send(response_data)
+                    self.send_json(client_socket, response)
                 else:
-                    # Добавляем только если такой связи еще нет
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO contacts (user_id, contact_id)
-                        SELECT u1.id, u2.id
-                        FROM users u1, users u2
-                        WHERE u1.username = ? AND u2.username = ?
-                    ''', (username, contact_username))
-                    conn.commit()
-                    # После добавления сразу отправляем обновленный список контактов
-                    cursor.execute('''
-                        SELECT u.username
-                        FROM contacts c
-                        JOIN users u ON c.contact_id = u.id
-                        JOIN users u2 ON c.user_id = u2.id
-                        WHERE u2.username = ?
-                    ''', (username,))
-                    contacts = [row[0] for row in cursor.fetchall()]
-                    response = {'status': 'success', 'message': 'Contact added successfully', 'contacts': contacts, 'action': 'contacts'}
-                    response_data = json.dumps(response, ensure_ascii=False).encode()
-                    size_data = len(response_data).to_bytes(4, byteorder='big')
-                    client_socket.send(size_data)
-                    client_socket.send(response_data)
+                    self.storage.add_contact(username, contact_username)
+                    # Вместо полного списка все сессии пользователя получают contacts_delta
+                    delta = self.contact_cache.add(username, contact_username) if username else None
+                    response = {'status': 'success', 'message': 'Contact added successfully', 'action': 'contacts',
+                                'contact': contact_username,
+                                'version': delta['version'] if delta else self.contact_cache.snapshot(username)[2]}
+                    self.send_json(client_socket, response)
+                    if delta:
+                        self.push_deltas({username: delta})
+                return
+                
+            elif action == 'remove':
+                self.storage.remove_contact(username, contact_username)
+                delta = self.contact_cache.remove(username, contact_username) if username else None
+                response = {'status': 'success', 'message': 'Contact removed', 'action': 'contacts',
+                            'contact': contact_username,
+                            'version': delta['version'] if delta else self.contact_cache.snapshot(username)[2]}
+                self.send_json(client_socket, response)
+                if delta:
+                    self.push_deltas({username: delta})
                 return
                 
             elif action == 'list':
-                cursor.execute('''
-                    SELECT u.username
-                    FROM contacts c
-                    JOIN users u ON c.contact_id = u.id
-                    JOIN users u2 ON c.user_id = u2.id
-                    WHERE u2.username = ?
-                ''', (username,))
-                contacts = [row[0] for row in cursor.fetchall()]
-                response = {'status': 'success', 'contacts': contacts, 'action': 'contacts'}
-                response_data = json.dumps(response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                # Список берём из кэша, загруженного при входе; присутствие - из таблицы сессий
+                contacts, presence, version = self.contact_cache.snapshot(username)
+                response = {'status': 'success', 'contacts': contacts, 'presence': presence,
+                            'version': version, 'action': 'contacts'}
+                self.send_json(client_socket, response)
                 
             elif action == 'history':
-                # Получаем id пользователей
-                cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
-                user_id = cursor.fetchone()[0]
-                cursor.execute('SELECT id FROM users WHERE username = ?', (contact_username,))
-                contact_id = cursor.fetchone()[0]
-                # Получаем все сообщения между двумя пользователями
-                cursor.execute('''
-                    SELECT sender_id, content, file_path, sent_at
-                    FROM messages
-                    WHERE (sender_id = ? AND receiver_id = ?)
-                       OR (sender_id = ? AND receiver_id = ?)
-                    ORDER BY sent_at ASC
-                ''', (user_id, contact_id, contact_id, user_id))
-                messages = []
-                for row in cursor.fetchall():
-                    sender = username if row[0] == user_id else contact_username
-                    messages.append({
-                        'sender': sender,
-                        'content': row[1],
-                        'file_path': row[2],
-                        'timestamp': row[3]
-                    })
-                response = {'status': 'success', 'action': 'history', 'messages': messages}
-                response_data = json.dumps(response, ensure_ascii=False).encode()
-                size_data = len(response_data).to_bytes(4, byteorder='big')
-                client_socket.send(size_data)
-                client_socket.send(response_data)
+                # Без limit - вся переписка, как раньше; с limit - страница перед before
+                limit = message.get('limit')
+                limit = min(int(limit), 500) if limit else None
+                before = message.get('before')
+                before = int(before) if before is not None else None
+                # Вся переписка по желанию клиента идёт потоком кадров; страница и так ограничена
+                stream = bool(message.get('stream')) and limit is None and before is None
+                codec = self.codec_of(client_socket)
+                key = (username, contact_username, before, limit, stream,
+                       (codec.name, codec.dictionary is not None) if codec else None)
+                ticket = None
+                if self.history_cache:
+                    frame = self.history_cache.get(key)
+                    if frame is not None:
+                        self.send_frame(client_socket, frame)
+                        return
+                    ticket = self.history_cache.reserve(HistoryCache.conversation(username, contact_username))
+                try:
+                    if stream:
+                        frame = self.stream_history(client_socket, username, contact_username, codec)
+                    else:
+                        rows = self.storage.history(username, contact_username, before, limit)
+                        # Кадры истории могут прийти из кэша без req_id: клиент узнаёт их по contact
+                        response = {'status': 'success', 'action': 'history', 'contact': contact_username,
+                                    'messages': [self.history_entry(row) for row in rows]}
+                        if limit:
+                            response['has_more'] = len(rows) == limit
+                        frame = encode_frame(response, codec)
+                        self.send_frame(client_socket, frame)
+                except Exception:
+                    if ticket:
+                        self.history_cache.release(ticket)
+                    raise
+                if ticket:
+                    if frame is not None:
+                        self.history_cache.put(key, ticket, frame)
+                    else:
+                        self.history_cache.release(ticket)
                 return
                 
         except Exception as e:
             response = {'status': 'error', 'message': str(e), 'action': action or 'contacts'}
-            response_data = json.dumps(response, ensure_ascii=False).encode()
-            size_data = len(response_data).to_bytes(4, byteorder='big')
-            client_socket.send(size_data)
-            client_socket.send(response_data)
-        finally:
-            conn.close()
+            self.send_json(client_socket, response)
 
 if __name__ == '__main__':
-    server = ChatServer()
-    server.start() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help='refuse compression in hello negotiation')
+    parser.add_argument('--compression-threshold', type=int, default=compression.DEFAULT_THRESHOLD,
+                        help='frames smaller than this many bytes are never compressed')
+    parser.add_argument('--compression-dict', help='shared dictionary trained with compression.py')
+    parser.add_argument('--tls-cert', help='PEM certificate; enables TLS together with --tls-key')
+    parser.add_argument('--tls-key', help='PEM private key for --tls-cert')
+    parser.add_argument('--heartbeat-interval', type=float, default=30,
+                        help='seconds of silence before the server pings a session')
+    parser.add_argument('--heartbeat-timeout', type=float, default=90,
+                        help='seconds of silence after which a session is evicted')
+    parser.add_argument('--keepalive', type=int, nargs=3, default=[60, 10, 5], metavar=('IDLE', 'INTERVAL', 'COUNT'),
+                        help='TCP keepalive settings (0 0 0 disables)')
+    parser.add_argument('--storage', choices=storage.ENGINES, default='sqlite',
+                        help='storage engine; memory keeps nothing across restarts (benchmarks only)')
+    parser.add_argument('--shard-dir', default='shards', help='directory with the message shards')
+    parser.add_argument('--archive-dir', default='archive', help='directory for archived message segments')
+    parser.add_argument('--hot-days', type=float, default=30,
+                        help='messages older than this move to the compressed archive (0 keeps everything hot)')
+    parser.add_argument('--compaction-interval', type=float, default=3600,
+                        help='seconds between archive compaction runs')
+    parser.add_argument('--shards', type=int, default=shards.DEFAULT_SHARD_COUNT,
+                        help='number of message shards (change with shards.py rebalance)')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='seconds a restart waits for sessions to disconnect before closing them')
+    parser.add_argument('--reconnect-spread', type=float, default=10,
+                        help='clients are told to reconnect at a random point within this many seconds')
+    parser.add_argument('--history-cache-mb', type=float, default=32,
+                        help='memory for cached history pages (0 disables the cache)')
+    parser.add_argument('--max-frame', type=int, default=protocol.DEFAULT_FRAME_LIMIT,
+                        help='largest accepted frame in bytes for actions without their own limit')
+    parser.add_argument('--max-frame-for', action='append', default=[], metavar='ACTION=BYTES',
+                        help='frame limit for one action, e.g. file=16777216 (repeatable)')
+    parser.add_argument('--read-budget-mb', type=float, default=256,
+                        help='memory all connections may hold in partially received large frames')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='where profiles started by the profile action or SIGUSR1 are written')
+    parser.add_argument('--profile-seconds', type=float, default=30, help='length of a SIGUSR1 profile')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='threads that run requests (0 runs them on the connection threads, unscheduled)')
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help='connections beyond this are refused with a busy notice')
+    parser.add_argument('--max-queue-wait', type=float, default=5.0,
+                        help='history, file and login requests are refused with retry_after when the '
+                             'expected queue wait is longer than this many seconds')
+    parser.add_argument('--record', metavar='PATH', help='record inbound traffic for traffic.py replay')
+    parser.add_argument('--record-raw', action='store_true',
+                        help='keep message text, file contents and passwords in the recording '
+                             '(also for recordings started with the record action)')
+    parser.add_argument('--record-dir', default='recordings',
+                        help='where recordings started with the record action are written')
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--handoff-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    per_action = dict(protocol.FRAME_LIMITS)
+    for item in args.max_frame_for:
+        action, _, size = item.partition('=')
+        if not size.isdigit():
+            parser.error(f'--max-frame-for expects ACTION=BYTES, got {item!r}')
+        per_action[action] = int(size)
+    dictionary = compression.load_dictionary(args.compression_dict) if args.compression_dict else None
+    tls_context = tls.server_context(args.tls_cert, args.tls_key) if args.tls_cert else None
+    if args.handoff_fd is not None:
+        # Перезапуск: базы ещё открыты старым процессом, ждём, пока он их отпустит
+        handoff.wait_for_predecessor(args.handoff_fd)
+    if args.storage == 'sqlite':
+        backend = storage.open_storage('sqlite', shard_dir=args.shard_dir, shard_count=args.shards,
+                                       archive_dir=args.archive_dir)
+    else:
+        backend = storage.open_storage(args.storage)
+    server = ChatServer(host=args.host, port=args.port, compression_enabled=args.compression,
+                        compression_threshold=args.compression_threshold,
+                        compression_dictionary=dictionary, tls_context=tls_context,
+                        heartbeat_interval=args.heartbeat_interval, heartbeat_timeout=args.heartbeat_timeout,
+                        keepalive=tuple(args.keepalive) if any(args.keepalive) else None,
+                        storage=backend, hot_retention=args.hot_days * 86400,
+                        compaction_interval=args.compaction_interval, listen_fd=args.listen_fd,
+                        drain_timeout=args.drain_timeout, reconnect_spread=args.reconnect_spread,
+                        history_cache_bytes=int(args.history_cache_mb * 1024 * 1024),
+                        frame_limits=FrameLimits(args.max_frame, per_action),
+                        read_budget_bytes=int(args.read_budget_mb * 1024 * 1024), profile_dir=args.profile_dir,
+                        record_dir=args.record_dir, record_raw=args.record_raw, workers=args.workers,
+                        max_connections=args.max_connections, max_queue_wait=args.max_queue_wait)
+    if args.record:
+        server.start_recording(args.record, redact=not args.record_raw)
+    if hasattr(signal, 'SIGHUP'):
+        # Запись принадлежит процессу: новый процесс после перезапуска её не продолжает
+        successor_args = traffic.without_recording(sys.argv[1:])
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=server.restart, args=(os.path.abspath(__file__), successor_args)).start())
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+            target=server.profile, args=(args.profile_seconds,), daemon=True).start())
+    try:
+        server.start()
+    finally:
+        server.stop_recording()
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""Behaviour of the running server that storage checks cannot see: routing and delivery.
+
+    python server_checks.py [--check NAME]
+
+Each check spawns its own server (memory storage) in a temporary directory
+and talks to it over plain sockets.
+"""
+import argparse
+import contextlib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from loadgen import SERVER_SCRIPT, free_port, wait_for_port
+from protocol import FrameReader, encode_frame
+
+TIMEOUT = 10
+
+
+@contextlib.contextmanager
+def running_server(*args):
+    """Yield the port of a fresh server"""
+    with tempfile.TemporaryDirectory(prefix='chat-checks-') as workdir:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                                   '--storage', 'memory'] + list(args),
+                                  cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for_port('127.0.0.1', port, 30):
+                raise RuntimeError('server did not start listening')
+            yield port
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+class Peer:
+    """A blocking client connection that reads frames on demand"""
+
+    def __init__(self, port, receive_buffer=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receive_buffer:
+            # До connect: окно TCP согласуется при установке соединения
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.settimeout(TIMEOUT)
+        self.sock.connect(('127.0.0.1', port))
+        self.reader = FrameReader()
+        self.frames = []
+
+    def send(self, message):
+        self.sock.sendall(encode_frame(message))
+
+    def receive(self, timeout=TIMEOUT):
+        """Next frame from the server, or None if none came within timeout"""
+        deadline = time.monotonic() + timeout
+        while not self.frames:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            if not data:
+                raise ConnectionError('server closed the connection')
+            self.reader.feed(data)
+            for message in self.reader.frames():
+                if message.get('action') == 'ping':
+                    self.send({'action': 'pong'})
+                else:
+                    self.frames.append(message)
+        return self.frames.pop(0)
+
+    def expect(self, action, timeout=TIMEOUT):
+        """Skip frames until one with this action arrives"""
+        deadline = time.monotonic() + timeout
+        while True:
+            message = self.receive(max(0.0, deadline - time.monotonic()))
+            if message is None:
+                raise AssertionError(f'no {action} frame within {timeout}s')
+            if message.get('action') == action:
+                return message
+
+    def request(self, message):
+        self.send(message)
+        response = self.expect(message['action'])
+        assert response.get('status') == 'success', response
+        return response
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def connect(port, username, register=False, receive_buffer=None, **login):
+    peer = Peer(port, receive_buffer)
+    if register:
+        peer.request({'action': 'register', 'username': username, 'password': f'pw-{username}'})
+    peer.request(dict({'action': 'login', 'username': username, 'password': f'pw-{username}'}, **login))
+    return peer
+
+
+def check_every_session_gets_forwards():
+    with running_server() as port:
+        alice = connect(port, 'alice', register=True)
+        phone = connect(port, 'bob', register=True)
+        laptop = connect(port, 'bob')
+        alice.send({'action': 'message', 'receiver': 'bob', 'content': 'hi'})
+        alice.request({'action': 'file', 'receiver': 'bob', 'file_name': 'note.txt', 'file_data': 'aGk='})
+        for session in (phone, laptop):
+            text = session.expect('message')
+            assert (text['sender'], text['content']) == ('alice', 'hi'), text
+            file = session.expect('message')
+            assert file.get('is_file') and file['content'] == '[File: note.txt]', file
+
+
+def send_acked(peer, receiver, contents, tag):
+    """Send messages with client ids and wait until each is stored; returns their ids"""
+    for number, content in enumerate(contents):
+        peer.send({'action': 'message', 'receiver': receiver, 'content': content, 'client_id': f'{tag}-{number}'})
+    acks = [peer.expect('message') for _ in contents]
+    assert all(ack.get('status') == 'success' for ack in acks), acks
+    return {ack['id'] for ack in acks}
+
+
+def check_drop_during_redelivery():
+    """A message sent while redelivery runs must not be acked ahead of older ones"""
+    with running_server() as port:
+        alice = connect(port, 'alice', register=True)
+        connect(port, 'bob', register=True).close()
+        # Столько, чтобы повторная доставка не поместилась в буферы сокетов и шла долго
+        offline = send_acked(alice, 'bob', [f'{number} ' + 'x' * 4000 for number in range(3000)], 'offline')
+        bob = connect(port, 'bob', receive_buffer=4096, acks=True)
+        seen = set()
+        while len(seen) < 100:
+            seen.add(bob.expect('message')['id'])
+        live = send_acked(alice, 'bob', ['live'], 'live').pop()
+        # Как SDK: подтверждаем наибольший id от отправителя и обрываем соединение на середине
+        while len(seen) < len(offline) // 2 and live not in seen:
+            seen.add(bob.expect('message')['id'])
+        bob.send({'action': 'ack', 'delivered': {'alice': max(seen)}})
+        time.sleep(0.5)
+        bob.close()
+        bob = connect(port, 'bob', acks=True)
+        while True:
+            message = bob.receive(timeout=2)
+            if message is None:
+                break
+            if message.get('action') == 'message':
+                assert message.get('redelivered'), message
+                seen.add(message['id'])
+        missing = (offline | {live}) - seen
+        assert not missing, f'{len(missing)} messages never delivered'
+
+
+CHECKS = [check_every_session_gets_forwards, check_drop_during_redelivery]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='append', help='run only this check (repeatable)')
+    args = parser.parse_args(argv)
+    failures = 0
+    for check in CHECKS:
+        if args.check and check.__name__ not in args.check:
+            continue
+        try:
+            check()
+            print(f'{check.__name__:<40} ok')
+        except Exception:
+            failures += 1
+            print(f'{check.__name__:<40} FAILED')
+            traceback.print_exc()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
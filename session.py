@@ -0,0 +1,103 @@
+"""Per-connection state of the chat server.
+
+A Session holds what the server keeps for one connection: the socket,
+who is logged in on it, its receive buffer (a FrameReader), the lock that
+keeps frames from different threads apart, the negotiated codec, the time
+of the last incoming frame, traffic counters and the messages held back
+while redelivery after login is still running. It uses __slots__, so a
+session costs one small fixed-size object instead of an entry in a
+separate dict for every field.
+
+SessionRegistry finds a session by socket fd and the sessions of a user,
+both in O(1).
+"""
+import threading
+import time
+
+
+class Session:
+    """State of one client connection"""
+
+    __slots__ = ('socket', 'fd', 'username', 'reader', 'send_lock', 'codec', 'last_seen', 'connected_at',
+                 'frames_in', 'bytes_in', 'frames_out', 'bytes_out', 'backlog')
+
+    def __init__(self, sock, reader):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.username = None
+        self.reader = reader
+        self.send_lock = threading.Lock()
+        self.codec = None  # FrameCodec, только после hello
+        self.last_seen = self.connected_at = time.monotonic()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.backlog = None  # [(message, bare)] новых сообщений, пока идёт повторная доставка
+
+    def __repr__(self):
+        return f'<Session fd={self.fd} user={self.username}>'
+
+
+class SessionRegistry:
+    """Open sessions by socket fd, and logged-in sessions by username"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_fd = {}  # {fd: Session}
+        self.by_user = {}  # {username: [Session]}, обычно одна
+
+    def add(self, session):
+        with self.lock:
+            self.by_fd[session.fd] = session
+
+    def remove(self, session):
+        """Forget the session; the socket must still be open, so its fd is not reused yet"""
+        with self.lock:
+            if self.by_fd.get(session.fd) is session:
+                del self.by_fd[session.fd]
+            self._unlink(session)
+
+    def get(self, sock):
+        """Session of an open socket, or None"""
+        return self.by_fd.get(sock.fileno())
+
+    def username(self, sock):
+        session = self.by_fd.get(sock.fileno())
+        return session.username if session else None
+
+    def login(self, session, username):
+        with self.lock:
+            self._unlink(session)
+            session.username = username
+            self.by_user.setdefault(username, []).append(session)
+
+    def logout(self, session):
+        """Returns the username the session was logged in as"""
+        with self.lock:
+            username = session.username
+            self._unlink(session)
+            return username
+
+    def _unlink(self, session):
+        username = session.username
+        if username is None:
+            return
+        session.username = None
+        sessions = self.by_user.get(username)
+        if sessions and session in sessions:
+            sessions.remove(session)
+            if not sessions:
+                del self.by_user[username]
+
+    def of_user(self, username):
+        return list(self.by_user.get(username, ()))
+
+    def sessions(self):
+        return list(self.by_fd.values())
+
+    def logged_in(self):
+        return sum(len(sessions) for sessions in list(self.by_user.values()))
+
+    def __len__(self):
+        return len(self.by_fd)
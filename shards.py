@@ -0,0 +1,634 @@
+"""Message storage partitioned across several SQLite files.
+
+Users and contacts stay in the small directory database (chat.db). Each
+conversation's messages and its two summary rows live in one shard chosen
+by hashing the pair of user ids, so an insert and its summary update are
+a single transaction on a single file. Every shard has its own writer
+connection and lock, so writes to different shards never wait for each
+other.
+
+Split an existing chat.db, or move shards to a new shard count:
+
+    python shards.py split chat.db --out shards --count 8
+    python shards.py rebalance shards --out shards-16 --count 16
+"""
+import argparse
+import glob
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from archive import SEGMENT_RECORDS
+
+DEFAULT_SHARD_COUNT = 4
+SCHEMA_VERSION = 3
+PREVIEW_LENGTH = 100  # Символов последнего сообщения в сводке диалога
+IMPORT_BATCH = 5000
+
+MESSAGE_COLUMNS = ('id', 'conversation_id', 'sender_id', 'receiver_id', 'sent_at', 'content', 'file_path',
+                   'thumbnail_path', 'file_meta', 'client_id')
+CONVERSATION_COLUMNS = ('user_id', 'peer_id', 'last_message_id', 'last_sender_id', 'last_preview',
+                        'last_activity', 'unread_count', 'read_cursor', 'delivered_cursor')
+# Источники старых версий без курсора доставки: всё, что в них есть, уже доставлено
+CONVERSATION_DEFAULTS = {'delivered_cursor': 'COALESCE(last_message_id, 0)'}
+
+# Версия 2: время - целые миллисекунды UTC, у строки есть id диалога, id сообщений выдаёт сервер.
+# Целые столбцы идут первыми, текст - в конце строки.
+# Версия 3: id сообщения, выданный клиентом, и курсор доставки получателю.
+MESSAGES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        conversation_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        sent_at INTEGER NOT NULL,
+        content TEXT,
+        file_path TEXT,
+        thumbnail_path TEXT,
+        file_meta TEXT,
+        client_id TEXT
+    )
+'''
+# Сводка по диалогам: одна строка на (пользователь, собеседник)
+CONVERSATIONS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        peer_id INTEGER NOT NULL,
+        last_message_id INTEGER,
+        last_sender_id INTEGER,
+        last_preview TEXT,
+        last_activity INTEGER,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        read_cursor INTEGER NOT NULL DEFAULT 0,
+        delivered_cursor INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, peer_id)
+    )
+'''
+SCHEMA = (
+    MESSAGES_TABLE.format(name='messages'),
+    'CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_messages_thumbnail
+    ON messages (thumbnail_path) WHERE thumbnail_path IS NOT NULL
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_messages_file
+    ON messages (file_path) WHERE file_path IS NOT NULL
+    ''',
+    # Повтор сообщения с тем же client_id находит уже записанное
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client
+    ON messages (conversation_id, sender_id, client_id) WHERE client_id IS NOT NULL
+    ''',
+    CONVERSATIONS_TABLE.format(name='conversations'),
+    '''
+    CREATE INDEX IF NOT EXISTS idx_conversations_inbox
+    ON conversations (user_id, last_activity DESC, last_message_id DESC)
+    ''',
+    'CREATE TABLE IF NOT EXISTS shard_meta (key TEXT PRIMARY KEY, value TEXT)',
+)
+
+# Сообщения, записанные до курсоров доставки, считаются доставленными
+MARK_DELIVERED = 'UPDATE conversations SET delivered_cursor = COALESCE(last_message_id, 0);'
+# Версия 1 хранила время строкой CURRENT_TIMESTAMP; julianday понимает оба её формата
+TEXT_TO_MILLIS = "COALESCE(CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER), 0)"
+MIGRATE_V1 = f'''
+    BEGIN;
+    {MESSAGES_TABLE.format(name='messages_v2')};
+    INSERT INTO messages_v2 (id, conversation_id, sender_id, receiver_id, sent_at,
+                             content, file_path, thumbnail_path, file_meta)
+    SELECT id, (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id), sender_id, receiver_id,
+           {TEXT_TO_MILLIS.format(column='sent_at')}, content, file_path, thumbnail_path, file_meta
+    FROM messages;
+    DROP TABLE messages;
+    ALTER TABLE messages_v2 RENAME TO messages;
+    {CONVERSATIONS_TABLE.format(name='conversations_v2')};
+    INSERT INTO conversations_v2 ({', '.join(CONVERSATION_COLUMNS[:-1])})
+    SELECT user_id, peer_id, last_message_id, last_sender_id, last_preview,
+           {TEXT_TO_MILLIS.format(column='last_activity')}, unread_count, read_cursor
+    FROM conversations;
+    DROP TABLE conversations;
+    ALTER TABLE conversations_v2 RENAME TO conversations;
+    {MARK_DELIVERED}
+    COMMIT;
+'''
+MIGRATE_V2 = f'''
+    BEGIN;
+    ALTER TABLE messages ADD COLUMN client_id TEXT;
+    ALTER TABLE conversations ADD COLUMN delivered_cursor INTEGER NOT NULL DEFAULT 0;
+    {MARK_DELIVERED}
+    COMMIT;
+'''
+
+
+def shard_index(user_a, user_b, count):
+    """Both directions of a conversation map to the same shard"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return zlib.crc32(f'{low}:{high}'.encode()) % count
+
+
+def conversation_id(user_a, user_b):
+    """One integer per unordered pair of users: the lower id in the high 32 bits"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return (low << 32) | high
+
+
+def now_millis():
+    return time.time_ns() // 1_000_000
+
+
+def to_millis(value):
+    """Epoch milliseconds from a stored time of any schema version"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)  # CURRENT_TIMESTAMP - всегда UTC
+    return round(moment.timestamp() * 1000)
+
+
+def migrate(conn):
+    """Bring a shard written by an older version up to SCHEMA_VERSION"""
+    columns = table_columns(conn, 'messages')
+    if columns and 'conversation_id' not in columns:
+        started = time.monotonic()
+        conn.executescript(MIGRATE_V1)
+        conn.execute('VACUUM')  # вернуть место, освобождённое старыми строками и индексами
+        logging.info(f"Migrated message shard to schema {SCHEMA_VERSION} in {time.monotonic() - started:.1f}s")
+    elif columns and 'client_id' not in columns:
+        # Только новые столбцы: строки не переписываются
+        conn.executescript(MIGRATE_V2)
+        logging.info(f"Migrated message shard to schema {SCHEMA_VERSION}")
+
+
+def update_conversations(cursor, sender_id, receiver_id, message_id, content, sent_at):
+    """Maintain both sides' conversation summaries; runs inside the insert transaction"""
+    preview = (content or '')[:PREVIEW_LENGTH]
+    # У отправителя своё сообщение сразу прочитано, у получателя растёт счётчик
+    cursor.execute('''
+        INSERT INTO conversations (user_id, peer_id, last_message_id, last_sender_id,
+                                   last_preview, last_activity, unread_count, read_cursor)
+        VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_sender_id = excluded.last_sender_id,
+            last_preview = excluded.last_preview,
+            last_activity = excluded.last_activity,
+            read_cursor = excluded.read_cursor,
+            unread_count = 0
+    ''', (sender_id, receiver_id, message_id, sender_id, preview, sent_at, message_id))
+    cursor.execute('''
+        INSERT INTO conversations (user_id, peer_id, last_message_id, last_sender_id,
+                                   last_preview, last_activity, unread_count, read_cursor)
+        VALUES (?, ?, ?, ?, ?, ?, 1, 0)
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_sender_id = excluded.last_sender_id,
+            last_preview = excluded.last_preview,
+            last_activity = excluded.last_activity,
+            unread_count = unread_count + 1
+    ''', (receiver_id, sender_id, message_id, sender_id, preview, sent_at))
+
+
+class Shard:
+    """One SQLite file with its own long-lived writer connection"""
+
+    def __init__(self, path, index, count):
+        self.path = path
+        self.index = index
+        self.write_lock = threading.Lock()
+        self.writer = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL: читатели не ждут писателя и наоборот
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        migrate(self.writer)
+        for statement in SCHEMA:
+            self.writer.execute(statement)
+        stored = dict(self.writer.execute('SELECT key, value FROM shard_meta').fetchall())
+        if stored and (stored.get('count') != str(count) or stored.get('index') != str(index)):
+            raise ValueError(f"{path} belongs to shard {stored.get('index')} of {stored.get('count')}, "
+                             f"not {index} of {count}; use 'python shards.py rebalance'")
+        self.writer.execute("INSERT OR REPLACE INTO shard_meta (key, value) "
+                            "VALUES ('count', ?), ('index', ?), ('schema', ?)",
+                            (str(count), str(index), str(SCHEMA_VERSION)))
+        self.writer.commit()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+
+
+class ShardedMessageStore:
+    """Messages and conversation summaries spread over N SQLite files"""
+
+    def __init__(self, directory='shards', count=DEFAULT_SHARD_COUNT):
+        os.makedirs(directory, exist_ok=True)
+        existing = glob.glob(os.path.join(directory, 'messages-*.db'))
+        if existing and len(existing) != count:
+            raise ValueError(f'{directory} has {len(existing)} shards but {count} were requested; '
+                             f"use 'python shards.py rebalance'")
+        self.directory = directory
+        self.shards = [Shard(os.path.join(directory, f'messages-{i:04d}.db'), i, count) for i in range(count)]
+        # id сообщений общие для всех шардов: по ним упорядочиваются диалоги из разных файлов
+        self.id_lock = threading.Lock()
+        self.floor = 0
+        self.reset_sequence()
+
+    def reset_sequence(self, floor=0):
+        """Continue message ids after the largest one on disk (or floor, e.g. the archive's)"""
+        with self.id_lock:
+            self.floor = max(floor, self.floor)
+            self.next_id = max([self.floor] + [
+                shard.writer.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+                for shard in self.shards]) + 1
+
+    def shard_for(self, user_a, user_b):
+        return self.shards[shard_index(user_a, user_b, len(self.shards))]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def is_empty(self):
+        for shard in self.shards:
+            conn = shard.connect()
+            try:
+                if conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+                    return False
+            finally:
+                conn.close()
+        return True
+
+    def insert(self, sender_id, receiver_id, content, file_path=None, thumbnail_path=None, file_meta=None,
+               client_id=None):
+        """Store a message and update both conversation summaries; returns (message id, sent_at).
+
+        If the sender already stored a message with this client_id in the
+        conversation, nothing is written and that message's id and time are
+        returned.
+        """
+        shard = self.shard_for(sender_id, receiver_id)
+        conversation = conversation_id(sender_id, receiver_id)
+        with shard.write_lock:
+            if client_id is not None:
+                row = shard.writer.execute(
+                    'SELECT id, sent_at FROM messages WHERE conversation_id = ? AND sender_id = ? AND client_id = ?',
+                    (conversation, sender_id, client_id)).fetchone()
+                if row:
+                    return row[0], row[1]
+            # id выдаётся под замком шарда: внутри диалога id растут в порядке записи,
+            # и курсор доставки не перескочит через сообщение, которое ещё пишется
+            with self.id_lock:
+                message_id = self.next_id
+                self.next_id += 1
+            sent_at = now_millis()
+            cursor = shard.writer.cursor()
+            try:
+                cursor.execute('''
+                    INSERT INTO messages (id, conversation_id, sender_id, receiver_id, sent_at,
+                                          content, file_path, thumbnail_path, file_meta, client_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (message_id, conversation, sender_id, receiver_id, sent_at,
+                      content, file_path, thumbnail_path, file_meta, client_id))
+                update_conversations(cursor, sender_id, receiver_id, message_id, content, sent_at)
+                shard.writer.commit()
+            except Exception:
+                shard.writer.rollback()
+                raise
+        return message_id, sent_at
+
+    def history(self, user_id, contact_id, before=None, limit=None):
+        """Newest limit messages between two users with id < before, oldest first"""
+        conn = self.shard_for(user_id, contact_id).connect()
+        try:
+            rows = conn.execute('''
+                SELECT id, sender_id, content, file_path, sent_at, thumbnail_path, file_meta
+                FROM messages
+                WHERE conversation_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (conversation_id(user_id, contact_id), before if before is not None else 2 ** 63 - 1,
+                  limit if limit is not None else -1)).fetchall()
+        finally:
+            conn.close()
+        rows.reverse()
+        return rows
+
+    def iter_history(self, user_id, contact_id, batch):
+        """The whole conversation in lists of at most batch rows, oldest first"""
+        conversation = conversation_id(user_id, contact_id)
+        shard = self.shard_for(user_id, contact_id)
+        after = 0
+        while True:
+            # Отдельный запрос на каждую пачку: между пачками шард не держит читающую транзакцию
+            conn = shard.connect()
+            try:
+                rows = conn.execute('''
+                    SELECT id, sender_id, content, file_path, sent_at, thumbnail_path, file_meta
+                    FROM messages
+                    WHERE conversation_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (conversation, after, batch)).fetchall()
+            finally:
+                conn.close()
+            if rows:
+                yield rows
+            if len(rows) < batch:
+                return
+            after = rows[-1][0]
+
+    def archive_older_than(self, cutoff, archive, batch=SEGMENT_RECORDS, chunk=500):
+        """Move messages sent before cutoff (epoch milliseconds) into archive segments.
+
+        Rows are read without the writer lock and deleted in small
+        transactions afterwards, so senders wait for at most one chunk.
+        Conversation summaries stay in the shard.
+        """
+        moved = 0
+        for shard in self.shards:
+            while True:
+                conn = shard.connect()
+                try:
+                    # id растут вместе со временем: берём самые старые строки по первичному ключу
+                    rows = conn.execute('''
+                        SELECT id, sender_id, receiver_id, content, file_path, sent_at, thumbnail_path, file_meta
+                        FROM messages ORDER BY id LIMIT ?
+                    ''', (batch,)).fetchall()
+                finally:
+                    conn.close()
+                old = []
+                for row in rows:
+                    if row[5] >= cutoff:
+                        break
+                    old.append(list(row))
+                if not old:
+                    break
+                # Сначала сегмент становится видимым, потом строки удаляются из шарда
+                archive.write(old)
+                ids = [row[0] for row in old]
+                for start in range(0, len(ids), chunk):
+                    part = ids[start:start + chunk]
+                    with shard.write_lock:
+                        shard.writer.execute(
+                            f"DELETE FROM messages WHERE id IN ({', '.join('?' * len(part))})", part)
+                        shard.writer.commit()
+                moved += len(old)
+                if len(old) < len(rows) or len(rows) < batch:
+                    break
+        return moved
+
+    def conversations(self, user_id, limit):
+        """Inbox rows for a user: one indexed query per shard, merged by activity"""
+        per_shard = []
+        for shard in self.shards:
+            conn = shard.connect()
+            try:
+                per_shard.append(conn.execute('''
+                    SELECT peer_id, last_preview, last_sender_id, last_activity, unread_count, last_message_id
+                    FROM conversations
+                    WHERE user_id = ?
+                    ORDER BY last_activity DESC, last_message_id DESC
+                    LIMIT ?
+                ''', (user_id, limit)).fetchall())
+            finally:
+                conn.close()
+        merged = heapq.merge(*per_shard, key=lambda row: (row[3] or 0, row[5] or 0), reverse=True)
+        return [row for _, row in zip(range(limit), merged)]
+
+    def mark_read(self, user_id, peer_id):
+        shard = self.shard_for(user_id, peer_id)
+        with shard.write_lock:
+            # Курсор просто переставляется на последнее сообщение, сами сообщения не читаем
+            shard.writer.execute('''
+                UPDATE conversations
+                SET read_cursor = last_message_id, unread_count = 0
+                WHERE user_id = ? AND peer_id = ?
+            ''', (user_id, peer_id))
+            shard.writer.commit()
+
+    def mark_delivered(self, user_id, cursors):
+        """Move user_id's delivery cursors forward; cursors maps a peer id to the highest id received.
+
+        A cursor never goes back and never past the conversation's last message.
+        """
+        by_shard = {}
+        for peer_id, message_id in cursors.items():
+            by_shard.setdefault(self.shard_for(user_id, peer_id), []).append((message_id, user_id, peer_id))
+        for shard, rows in by_shard.items():
+            with shard.write_lock:
+                shard.writer.executemany('''
+                    UPDATE conversations
+                    SET delivered_cursor = max(delivered_cursor, min(?, COALESCE(last_message_id, 0)))
+                    WHERE user_id = ? AND peer_id = ?
+                ''', rows)
+                shard.writer.commit()
+
+    def undelivered(self, user_id, after, limit):
+        """Messages to user_id above its delivery cursors and above after, oldest first"""
+        per_shard = []
+        for shard in self.shards:
+            conn = shard.connect()
+            try:
+                # Сводки без новых сообщений отсекаются сразу, остальные читаются по индексу диалога
+                per_shard.append(conn.execute('''
+                    SELECT m.id, m.sender_id, m.content, m.file_path, m.sent_at, m.thumbnail_path, m.file_meta
+                    FROM conversations c
+                    JOIN messages m
+                        ON m.conversation_id = (min(c.user_id, c.peer_id) << 32) | max(c.user_id, c.peer_id)
+                        AND m.id > max(c.delivered_cursor, ?) AND m.receiver_id = c.user_id
+                    WHERE c.user_id = ? AND c.last_message_id > max(c.delivered_cursor, ?)
+                    ORDER BY m.id
+                    LIMIT ?
+                ''', (after, user_id, after, limit)).fetchall())
+            finally:
+                conn.close()
+        return [row for _, row in zip(range(limit), heapq.merge(*per_shard))]
+
+    def find_thumbnail_source(self, user_id, thumbnail_path):
+        """Original file behind a thumbnail, if user_id took part in that conversation"""
+        for shard in self.shards:
+            conn = shard.connect()
+            try:
+                row = conn.execute('''
+                    SELECT file_path FROM messages
+                    WHERE thumbnail_path = ? AND (sender_id = ? OR receiver_id = ?)
+                    LIMIT 1
+                ''', (thumbnail_path, user_id, user_id)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                return row[0]
+        return None
+
+    def has_attachment(self, user_id, file_path):
+        """Whether file_path was sent in a conversation of user_id"""
+        for shard in self.shards:
+            conn = shard.connect()
+            try:
+                row = conn.execute('''
+                    SELECT 1 FROM messages
+                    WHERE file_path = ? AND (sender_id = ? OR receiver_id = ?)
+                    LIMIT 1
+                ''', (file_path, user_id, user_id)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                return True
+        return False
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def copy_into(store, source_paths, messages_table='messages', conversations_table='conversations'):
+    """Copy messages (and summaries, or rebuild them) from source files into store's shards"""
+    copied = 0
+    have_summaries = False
+    for path in source_paths:
+        source = sqlite3.connect(path)
+        try:
+            # Источник может быть любой версии: chat.db до шардов, шард версии 1 или 2
+            available = table_columns(source, messages_table)
+            if not available:
+                continue
+            columns = [c for c in MESSAGE_COLUMNS if c in available and c != 'conversation_id']
+            rows = source.execute(f"SELECT {', '.join(columns)} FROM {messages_table} ORDER BY id")
+            insert = (f"INSERT OR IGNORE INTO messages ({', '.join(MESSAGE_COLUMNS)}) "
+                      f"VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})")
+            while True:
+                batch = rows.fetchmany(IMPORT_BATCH)
+                if not batch:
+                    break
+                by_shard = {}
+                for values in batch:
+                    row = dict(zip(columns, values))
+                    row['conversation_id'] = conversation_id(row['sender_id'], row['receiver_id'])
+                    row['sent_at'] = to_millis(row.get('sent_at'))
+                    by_shard.setdefault(store.shard_for(row['sender_id'], row['receiver_id']), []).append(
+                        tuple(row.get(c) for c in MESSAGE_COLUMNS))
+                for shard, shard_rows in by_shard.items():
+                    with shard.write_lock:
+                        shard.writer.executemany(insert, shard_rows)
+                        shard.writer.commit()
+                copied += len(batch)
+
+            summary_rows = []
+            available = table_columns(source, conversations_table)
+            if available:
+                select = [c if c in available else CONVERSATION_DEFAULTS[c] for c in CONVERSATION_COLUMNS]
+                summary_rows = source.execute(f"SELECT {', '.join(select)} FROM {conversations_table}").fetchall()
+            if summary_rows:
+                have_summaries = True
+                by_shard = {}
+                activity = CONVERSATION_COLUMNS.index('last_activity')
+                for row in summary_rows:
+                    row = row[:activity] + (to_millis(row[activity]),) + row[activity + 1:]
+                    by_shard.setdefault(store.shard_for(row[0], row[1]), []).append(row)
+                for shard, shard_rows in by_shard.items():
+                    with shard.write_lock:
+                        shard.writer.executemany(
+                            f"INSERT OR REPLACE INTO conversations ({', '.join(CONVERSATION_COLUMNS)}) "
+                            f"VALUES ({', '.join('?' * len(CONVERSATION_COLUMNS))})", shard_rows)
+                        shard.writer.commit()
+        finally:
+            source.close()
+    if not have_summaries:
+        for shard in store.shards:
+            rebuild_conversations(shard)
+    store.reset_sequence()
+    return copied
+
+
+def rebuild_conversations(shard):
+    """Recompute summaries from a shard's messages; existing messages count as read and delivered"""
+    with shard.write_lock:
+        shard.writer.execute('DELETE FROM conversations')
+        shard.writer.execute('''
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_sender_id,
+                                       last_preview, last_activity, unread_count, read_cursor, delivered_cursor)
+            SELECT pairs.user_id, pairs.peer_id, m.id, m.sender_id,
+                   substr(m.content, 1, ?), m.sent_at, 0, m.id, m.id
+            FROM (
+                SELECT user_id, peer_id, MAX(id) AS id FROM (
+                    SELECT sender_id AS user_id, receiver_id AS peer_id, id FROM messages
+                    UNION ALL
+                    SELECT receiver_id, sender_id, id FROM messages
+                ) GROUP BY user_id, peer_id
+            ) pairs
+            JOIN messages m ON m.id = pairs.id
+        ''', (PREVIEW_LENGTH,))
+        shard.writer.commit()
+
+
+def import_legacy(db_path, store):
+    """One-time move of messages kept in chat.db (before sharding) into the shards.
+
+    The old tables are renamed to *_legacy rather than dropped.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if not table_columns(conn, 'messages'):
+            return 0
+    finally:
+        conn.close()
+    if not store.is_empty():
+        raise ValueError(f'{db_path} still has a messages table but the shards are not empty')
+    logging.info(f"Importing messages from {db_path} into {len(store.shards)} shards")
+    copied = copy_into(store, [db_path])
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('ALTER TABLE messages RENAME TO messages_legacy')
+        if table_columns(conn, 'conversations'):
+            conn.execute('ALTER TABLE conversations RENAME TO conversations_legacy')
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Imported {copied} messages; old tables kept as messages_legacy/conversations_legacy")
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split or rebalance sharded message storage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    split = subparsers.add_parser('split', help='copy messages from a single chat.db into shards')
+    split.add_argument('database')
+    split.add_argument('--out', default='shards')
+    split.add_argument('--count', type=int, default=DEFAULT_SHARD_COUNT)
+    rebalance = subparsers.add_parser('rebalance', help='copy an existing shard directory to a new shard count')
+    rebalance.add_argument('directory')
+    rebalance.add_argument('--out', required=True)
+    rebalance.add_argument('--count', type=int, required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'split':
+        sources = [args.database]
+    else:
+        sources = sorted(glob.glob(os.path.join(args.directory, 'messages-*.db')))
+        if not sources:
+            raise SystemExit(f'No shards found in {args.directory}')
+    if os.path.abspath(args.out) in {os.path.abspath(os.path.dirname(s)) for s in sources}:
+        raise SystemExit('--out must be a different directory than the source')
+    store = ShardedMessageStore(args.out, args.count)
+    try:
+        if not store.is_empty():
+            raise SystemExit(f'{args.out} already contains messages')
+        copied = copy_into(store, sources)
+    finally:
+        store.close()
+    print(f'Copied {copied} messages into {args.count} shards in {args.out}')
+
+
+if __name__ == '__main__':
+    main()
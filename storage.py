@@ -0,0 +1,636 @@
+"""Storage backends behind the chat server.
+
+The server's handlers only talk to a Storage: users, contacts, messages
+(with conversation summaries) and file blobs. Two engines implement it:
+
+- SQLiteStorage: chat.db for users and contacts, message shards (shards.py)
+  for messages. This is what production runs.
+- MemoryStorage: everything in process memory, messages kept in
+  array-backed columns. Nothing survives a restart; it exists so
+  benchmarks can measure protocol and routing cost without disk I/O.
+
+Both must pass `python storage_conformance.py`.
+"""
+import bisect
+import heapq
+import os
+import sqlite3
+import threading
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import shards
+from archive import Archive
+
+# Время (sent_at, last_activity) у обоих движков - целые миллисекунды от эпохи, UTC
+MessageRow = namedtuple('MessageRow', 'id sender receiver content file_path sent_at thumbnail_path file_meta')
+ConversationRow = namedtuple('ConversationRow',
+                             'contact last_message last_sender last_activity unread_count last_message_id')
+
+ENGINES = ('sqlite', 'memory')
+HISTORY_BATCH = 200  # Сообщений в одной пачке iter_history
+
+
+class UserExistsError(Exception):
+    pass
+
+
+class Storage:
+    """Interface the server handlers use. Users are addressed by username."""
+
+    def __init__(self, files_dir='files'):
+        self.files_dir = files_dir
+
+    # Users
+    def create_user(self, username, password_hash):
+        """Raises UserExistsError if the name is taken"""
+        raise NotImplementedError
+
+    def password_hash(self, username):
+        """Stored bcrypt hash, or None for an unknown user"""
+        raise NotImplementedError
+
+    def user_exists(self, username):
+        raise NotImplementedError
+
+    # Contacts
+    def add_contact(self, username, contact):
+        """Returns False if the link already existed"""
+        raise NotImplementedError
+
+    def remove_contact(self, username, contact):
+        raise NotImplementedError
+
+    def contacts(self, username):
+        raise NotImplementedError
+
+    # Messages
+    def store_message(self, sender, receiver, content, file_path=None, thumbnail_path=None, file_meta=None,
+                      client_id=None):
+        """Store a message, update both conversation summaries and return its MessageRow.
+
+        A client_id the sender already used in this conversation stores
+        nothing and returns the row with the first message's id and time.
+        """
+        raise NotImplementedError
+
+    def history(self, username, contact, before=None, limit=None):
+        """MessageRows between the two users, oldest first.
+
+        With limit, only the newest limit messages whose id is below before
+        (a page); page further back by passing the smallest id returned.
+        """
+        raise NotImplementedError
+
+    def iter_history(self, username, contact, batch=HISTORY_BATCH):
+        """The whole conversation as lists of at most batch MessageRows, oldest first.
+
+        Engines override this to read batch by batch instead of loading the
+        conversation at once.
+        """
+        rows = self.history(username, contact)
+        for start in range(0, len(rows), batch):
+            yield rows[start:start + batch]
+
+    def conversations(self, username, limit):
+        """ConversationRows for the inbox, most recent first"""
+        raise NotImplementedError
+
+    def mark_read(self, username, contact):
+        raise NotImplementedError
+
+    def mark_delivered(self, username, cursors):
+        """Record what username's client received: cursors maps a contact to the highest message id from them"""
+        raise NotImplementedError
+
+    def undelivered(self, username, after=0, limit=HISTORY_BATCH):
+        """MessageRows sent to username above its delivery cursors (and above after), oldest first.
+
+        Messages already moved to cold storage are not included.
+        """
+        raise NotImplementedError
+
+    def thumbnail_source(self, username, thumbnail_path):
+        """Original file behind a thumbnail, if username took part in that conversation"""
+        raise NotImplementedError
+
+    def attachment_source(self, username, file_path):
+        """file_path itself if it was sent in a conversation username took part in, else None"""
+        raise NotImplementedError
+
+    def compact(self, max_age):
+        """Move messages older than max_age seconds to cold storage; returns how many moved"""
+        return 0
+
+    # Files
+    def save_file(self, file_name, data):
+        """Write an attachment and return its path.
+
+        Both engines keep blobs on disk: the thumbnail pipeline and clients
+        refer to attachments by path.
+        """
+        os.makedirs(self.files_dir, exist_ok=True)
+        file_path = os.path.normpath(os.path.join(self.files_dir, f"{datetime.now().timestamp()}_{file_name}"))
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    @contextmanager
+    def batch(self):
+        """Group the calls made inside (by this thread) into one transaction where the engine can.
+
+        Nested batches join the outer one.
+        """
+        yield
+
+    def close(self):
+        pass
+
+
+class BatchConnection:
+    """The connection of an open batch: commit and close wait for the end of the batch"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_path='chat.db', shard_dir='shards', shard_count=shards.DEFAULT_SHARD_COUNT,
+                 files_dir='files', archive_dir='archive'):
+        super().__init__(files_dir)
+        self.db_path = db_path
+        self.local = threading.local()  # BatchConnection открытого в этом потоке batch()
+        # Сообщения и сводки диалогов живут в шардах, chat.db - только пользователи и контакты
+        self.messages = shards.ShardedMessageStore(shard_dir, shard_count)
+        # Старые сообщения уезжают из шардов в сжатые сегменты архива
+        self.archive = Archive(archive_dir)
+        # id не должны повториться, даже если все сообщения уже в архиве
+        self.messages.reset_sequence(floor=self.archive.max_id())
+        self.setup_database()
+
+    def setup_database(self):
+        """Initialize SQLite database with required tables"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS contacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                contact_id INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (contact_id) REFERENCES users (id)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+        # Базы до шардирования хранили сообщения прямо в chat.db - переносим их один раз
+        shards.import_legacy(self.db_path, self.messages)
+
+    def connect(self):
+        batch = getattr(self.local, 'batch', None)
+        if batch is not None:
+            return batch
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @contextmanager
+    def batch(self):
+        """One chat.db transaction for users and contacts; messages still commit per shard"""
+        if getattr(self.local, 'batch', None) is not None:
+            yield
+            return
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        self.local.batch = BatchConnection(conn)
+        try:
+            yield
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.local.batch = None
+            conn.close()
+
+    def user_ids(self, conn, *usernames):
+        """Ids in the order of usernames; raises KeyError for an unknown name"""
+        found = dict(conn.execute(
+            f"SELECT username, id FROM users WHERE username IN ({', '.join('?' * len(usernames))})",
+            usernames).fetchall())
+        return [found[name] for name in usernames]
+
+    def create_user(self, username, password_hash):
+        conn = self.connect()
+        try:
+            conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password_hash))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            raise UserExistsError(username)
+        finally:
+            conn.close()
+
+    def password_hash(self, username):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def user_exists(self, username):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def add_contact(self, username, contact):
+        conn = self.connect()
+        try:
+            # Добавляем только если такой связи еще нет
+            cursor = conn.execute('''
+                INSERT INTO contacts (user_id, contact_id)
+                SELECT u1.id, u2.id
+                FROM users u1, users u2
+                WHERE u1.username = ? AND u2.username = ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM contacts c WHERE c.user_id = u1.id AND c.contact_id = u2.id
+                  )
+            ''', (username, contact))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def remove_contact(self, username, contact):
+        conn = self.connect()
+        try:
+            conn.execute('''
+                DELETE FROM contacts
+                WHERE user_id = (SELECT id FROM users WHERE username = ?)
+                  AND contact_id = (SELECT id FROM users WHERE username = ?)
+            ''', (username, contact))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def contacts(self, username):
+        conn = self.connect()
+        try:
+            rows = conn.execute('''
+                SELECT u.username
+                FROM contacts c
+                JOIN users u ON c.contact_id = u.id
+                JOIN users u2 ON c.user_id = u2.id
+                WHERE u2.username = ?
+            ''', (username,)).fetchall()
+            return [row[0] for row in rows]
+        finally:
+            conn.close()
+
+    def store_message(self, sender, receiver, content, file_path=None, thumbnail_path=None, file_meta=None,
+                      client_id=None):
+        conn = self.connect()
+        try:
+            sender_id, receiver_id = self.user_ids(conn, sender, receiver)
+        finally:
+            conn.close()
+        message_id, sent_at = self.messages.insert(sender_id, receiver_id, content, file_path, thumbnail_path,
+                                                   file_meta, client_id)
+        return MessageRow(message_id, sender, receiver, content, file_path, sent_at, thumbnail_path, file_meta)
+
+    def history(self, username, contact, before=None, limit=None):
+        conn = self.connect()
+        try:
+            user_id, contact_id = self.user_ids(conn, username, contact)
+        finally:
+            conn.close()
+        # Свежая часть переписки лежит в одном шарде, всё, что старше, - в архиве
+        rows = self.messages.history(user_id, contact_id, before, limit)
+        if limit is None or len(rows) < limit:
+            older_than = rows[0][0] if rows else before
+            cold = self.archive.history(user_id, contact_id, older_than,
+                                        None if limit is None else limit - len(rows))
+            # Во время переноса строка может на миг оказаться в обоих местах;
+            # сегменты, записанные до версии 2, хранят время строкой
+            hot_ids = {row[0] for row in rows}
+            rows = [(r[0], r[1], r[3], r[4], shards.to_millis(r[5]), r[6], r[7])
+                    for r in cold if r[0] not in hot_ids] + rows
+        return [MessageRow(row[0], username if row[1] == user_id else contact,
+                           contact if row[1] == user_id else username, *row[2:])
+                for row in rows]
+
+    def iter_history(self, username, contact, batch=HISTORY_BATCH):
+        conn = self.connect()
+        try:
+            user_id, contact_id = self.user_ids(conn, username, contact)
+        finally:
+            conn.close()
+        cold = ((r[0], r[1], r[3], r[4], shards.to_millis(r[5]), r[6], r[7])
+                for r in self.archive.iter_history(user_id, contact_id))
+        hot = (row for rows in self.messages.iter_history(user_id, contact_id, batch) for row in rows)
+        chunk = []
+        last_id = 0
+        for row in heapq.merge(cold, hot, key=lambda r: r[0]):
+            if row[0] == last_id:
+                continue  # строка в архиве и ещё не удалена из шарда
+            last_id = row[0]
+            chunk.append(MessageRow(row[0], username if row[1] == user_id else contact,
+                                    contact if row[1] == user_id else username, *row[2:]))
+            if len(chunk) == batch:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def conversations(self, username, limit):
+        conn = self.connect()
+        try:
+            user_id, = self.user_ids(conn, username)
+            rows = self.messages.conversations(user_id, limit)
+            # Сводки лежат в шардах, имена собеседников - в chat.db
+            ids = {r[0] for r in rows} | {r[2] for r in rows if r[2] is not None}
+            names = dict(conn.execute(
+                f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(ids))})", tuple(ids)
+            ).fetchall()) if ids else {}
+        finally:
+            conn.close()
+        return [ConversationRow(names.get(r[0]), r[1], names.get(r[2]), r[3], r[4], r[5]) for r in rows]
+
+    def mark_read(self, username, contact):
+        conn = self.connect()
+        try:
+            user_id, contact_id = self.user_ids(conn, username, contact)
+        finally:
+            conn.close()
+        self.messages.mark_read(user_id, contact_id)
+
+    def mark_delivered(self, username, cursors):
+        if not cursors:
+            return
+        conn = self.connect()
+        try:
+            user_id, = self.user_ids(conn, username)
+            # Неизвестные имена просто пропускаем
+            ids = dict(conn.execute(
+                f"SELECT username, id FROM users WHERE username IN ({', '.join('?' * len(cursors))})",
+                tuple(cursors)).fetchall())
+        finally:
+            conn.close()
+        self.messages.mark_delivered(user_id, {ids[name]: message_id for name, message_id in cursors.items()
+                                               if name in ids})
+
+    def undelivered(self, username, after=0, limit=HISTORY_BATCH):
+        conn = self.connect()
+        try:
+            user_id, = self.user_ids(conn, username)
+            rows = self.messages.undelivered(user_id, after, limit)
+            ids = {row[1] for row in rows}
+            names = dict(conn.execute(
+                f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(ids))})", tuple(ids)
+            ).fetchall()) if ids else {}
+        finally:
+            conn.close()
+        return [MessageRow(row[0], names.get(row[1]), username, *row[2:]) for row in rows]
+
+    def thumbnail_source(self, username, thumbnail_path):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        return (self.messages.find_thumbnail_source(row[0], thumbnail_path)
+                or self.archive.thumbnail_source(row[0], thumbnail_path))
+
+    def attachment_source(self, username, file_path):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        if self.messages.has_attachment(row[0], file_path) or self.archive.has_attachment(row[0], file_path):
+            return file_path
+        return None
+
+    def compact(self, max_age):
+        cutoff = shards.now_millis() - int(max_age * 1000)
+        moved = self.messages.archive_older_than(cutoff, self.archive)
+        self.archive.merge()
+        return moved
+
+    def close(self):
+        self.messages.close()
+
+
+class MemoryStorage(Storage):
+    """In-process engine for benchmarks; one lock, nothing is persisted.
+
+    Message columns are parallel arrays indexed by message id - 1, so a
+    million short messages cost tens of bytes each plus the text itself
+    instead of a dict or tuple per row. Rarely used columns are sparse dicts.
+    There is no cold tier, so compact() moves nothing.
+    """
+
+    def __init__(self, files_dir='files'):
+        super().__init__(files_dir)
+        self.lock = threading.Lock()
+        self.user_index = {}  # {username: user id}
+        self.usernames = ['']  # id -> username, id 0 не используется
+        self.hashes = [b'']
+        self.contact_lists = {}  # {user id: list of contact ids в порядке добавления}
+        self.sender = array('l')
+        self.receiver = array('l')
+        self.sent_at = array('q')
+        self.content = []
+        self.file_paths = {}  # {row: file_path}
+        self.thumbnail_paths = {}  # {row: thumbnail_path}
+        self.file_meta = {}  # {row: file_meta}
+        self.client_ids = {}  # {(sender id, receiver id, client_id): row}
+        self.threads = {}  # {conversation id: array of rows}
+        # {user id: {peer id: [last_message_id, last_sender_id, preview, sent_at, unread, delivered_cursor]}}
+        self.summaries = {}
+
+    def _id(self, username):
+        user_id = self.user_index.get(username)
+        if user_id is None:
+            raise KeyError(username)
+        return user_id
+
+    def create_user(self, username, password_hash):
+        with self.lock:
+            if username in self.user_index:
+                raise UserExistsError(username)
+            self.user_index[username] = len(self.usernames)
+            self.usernames.append(username)
+            self.hashes.append(password_hash)
+
+    def password_hash(self, username):
+        with self.lock:
+            user_id = self.user_index.get(username)
+            return self.hashes[user_id] if user_id else None
+
+    def user_exists(self, username):
+        return username in self.user_index
+
+    def add_contact(self, username, contact):
+        with self.lock:
+            user_id, contact_id = self.user_index.get(username), self.user_index.get(contact)
+            if not user_id or not contact_id:
+                return False
+            contacts = self.contact_lists.setdefault(user_id, [])
+            if contact_id in contacts:
+                return False
+            contacts.append(contact_id)
+            return True
+
+    def remove_contact(self, username, contact):
+        with self.lock:
+            contacts = self.contact_lists.get(self.user_index.get(username), [])
+            contact_id = self.user_index.get(contact)
+            if contact_id in contacts:
+                contacts.remove(contact_id)
+
+    def contacts(self, username):
+        with self.lock:
+            return [self.usernames[i] for i in self.contact_lists.get(self.user_index.get(username), ())]
+
+    def store_message(self, sender, receiver, content, file_path=None, thumbnail_path=None, file_meta=None,
+                      client_id=None):
+        with self.lock:
+            sender_id, receiver_id = self._id(sender), self._id(receiver)
+            if client_id is not None:
+                row = self.client_ids.get((sender_id, receiver_id, client_id))
+                if row is not None:
+                    return self._row(row)
+                self.client_ids[(sender_id, receiver_id, client_id)] = len(self.content)
+            row = len(self.content)
+            message_id = row + 1
+            now = shards.now_millis()
+            self.sender.append(sender_id)
+            self.receiver.append(receiver_id)
+            self.sent_at.append(now)
+            self.content.append(content)
+            if file_path is not None:
+                self.file_paths[row] = file_path
+            if thumbnail_path is not None:
+                self.thumbnail_paths[row] = thumbnail_path
+            if file_meta is not None:
+                self.file_meta[row] = file_meta
+            self.threads.setdefault(shards.conversation_id(sender_id, receiver_id), array('l')).append(row)
+            preview = (content or '')[:shards.PREVIEW_LENGTH]
+            outbox = self.summaries.setdefault(sender_id, {})
+            delivered = outbox[receiver_id][5] if receiver_id in outbox else 0
+            outbox[receiver_id] = [message_id, sender_id, preview, now, 0, delivered]
+            inbox = self.summaries.setdefault(receiver_id, {})
+            unread, delivered = (inbox[sender_id][4] + 1, inbox[sender_id][5]) if sender_id in inbox else (1, 0)
+            inbox[sender_id] = [message_id, sender_id, preview, now, unread, delivered]
+            return self._row(row)
+
+    def _row(self, row):
+        return MessageRow(row + 1, self.usernames[self.sender[row]], self.usernames[self.receiver[row]],
+                          self.content[row], self.file_paths.get(row), self.sent_at[row],
+                          self.thumbnail_paths.get(row), self.file_meta.get(row))
+
+    def history(self, username, contact, before=None, limit=None):
+        with self.lock:
+            user_id, contact_id = self._id(username), self._id(contact)
+            rows = self.threads.get(shards.conversation_id(user_id, contact_id), array('l'))
+            # Номер строки = id - 1 и растёт, поэтому страницу находит bisect
+            end = bisect.bisect_left(rows, before - 1) if before is not None else len(rows)
+            start = max(0, end - limit) if limit is not None else 0
+            return [self._row(row) for row in rows[start:end]]
+
+    def iter_history(self, username, contact, batch=HISTORY_BATCH):
+        after = 0
+        while True:
+            with self.lock:
+                rows = self.threads.get(shards.conversation_id(self._id(username), self._id(contact)), array('l'))
+                start = bisect.bisect_right(rows, after - 1)
+                chunk = [self._row(row) for row in rows[start:start + batch]]
+            if chunk:
+                yield chunk
+            if len(chunk) < batch:
+                return
+            after = chunk[-1].id
+
+    def conversations(self, username, limit):
+        with self.lock:
+            user_id = self._id(username)
+            # Сортировка по (время, id) - как индекс idx_conversations_inbox
+            rows = sorted(((s[3], s[0], peer, s) for peer, s in self.summaries.get(user_id, {}).items()),
+                          reverse=True)[:limit]
+            return [ConversationRow(self.usernames[peer], s[2], self.usernames[s[1]], s[3], s[4], s[0])
+                    for _, _, peer, s in rows]
+
+    def mark_read(self, username, contact):
+        with self.lock:
+            summary = self.summaries.get(self._id(username), {}).get(self._id(contact))
+            if summary:
+                summary[4] = 0
+
+    def mark_delivered(self, username, cursors):
+        with self.lock:
+            summaries = self.summaries.get(self._id(username), {})
+            for contact, message_id in cursors.items():
+                summary = summaries.get(self.user_index.get(contact))
+                if summary:
+                    summary[5] = max(summary[5], min(message_id, summary[0]))
+
+    def undelivered(self, username, after=0, limit=HISTORY_BATCH):
+        with self.lock:
+            user_id = self._id(username)
+            found = []
+            for peer, summary in self.summaries.get(user_id, {}).items():
+                cursor = max(summary[5], after)
+                if summary[0] <= cursor:
+                    continue
+                rows = self.threads[shards.conversation_id(user_id, peer)]
+                found.extend(row for row in rows[bisect.bisect_right(rows, cursor - 1):]
+                             if self.receiver[row] == user_id)
+            return [self._row(row) for row in sorted(found)[:limit]]
+
+    def thumbnail_source(self, username, thumbnail_path):
+        with self.lock:
+            user_id = self.user_index.get(username)
+            for row, path in self.thumbnail_paths.items():
+                if path == thumbnail_path and user_id in (self.sender[row], self.receiver[row]):
+                    return self.file_paths.get(row)
+            return None
+
+    def attachment_source(self, username, file_path):
+        with self.lock:
+            user_id = self.user_index.get(username)
+            for row, path in self.file_paths.items():
+                if path == file_path and user_id in (self.sender[row], self.receiver[row]):
+                    return file_path
+            return None
+
+
+def open_storage(engine='sqlite', **options):
+    """Build a Storage by engine name, as accepted by server.py --storage"""
+    if engine == 'sqlite':
+        return SQLiteStorage(**options)
+    if engine == 'memory':
+        return MemoryStorage(files_dir=options.get('files_dir', 'files'))
+    raise ValueError(f'Unknown storage engine: {engine}')
@@ -0,0 +1,274 @@
+"""Behaviour every storage engine must share, checked against each engine.
+
+    python storage_conformance.py [--engine sqlite|memory]
+
+Each check gets a fresh, empty storage in its own temporary directory.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import storage
+
+
+def make_storage(engine, workdir):
+    if engine == 'sqlite':
+        return storage.SQLiteStorage(db_path=os.path.join(workdir, 'chat.db'),
+                                     shard_dir=os.path.join(workdir, 'shards'),
+                                     files_dir=os.path.join(workdir, 'files'),
+                                     archive_dir=os.path.join(workdir, 'archive'))
+    return storage.MemoryStorage(files_dir=os.path.join(workdir, 'files'))
+
+
+def with_users(s, *names):
+    for name in names:
+        s.create_user(name, f'hash-{name}'.encode())
+
+
+def check_users(s):
+    with_users(s, 'alice')
+    assert s.user_exists('alice')
+    assert not s.user_exists('bob')
+    assert s.password_hash('alice') == b'hash-alice'
+    assert s.password_hash('bob') is None
+    try:
+        s.create_user('alice', b'other')
+    except storage.UserExistsError:
+        pass
+    else:
+        raise AssertionError('duplicate username was accepted')
+    assert s.password_hash('alice') == b'hash-alice'
+
+
+def check_contacts(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    assert s.contacts('alice') == []
+    assert s.add_contact('alice', 'bob') is True
+    assert s.add_contact('alice', 'bob') is False
+    assert s.add_contact('alice', 'carol') is True
+    assert sorted(s.contacts('alice')) == ['bob', 'carol']
+    assert s.contacts('bob') == []  # связь односторонняя
+    s.remove_contact('alice', 'bob')
+    s.remove_contact('alice', 'bob')
+    assert s.contacts('alice') == ['carol']
+
+
+def check_batch(s):
+    with s.batch():
+        with_users(s, 'alice', 'bob', 'carol')
+        assert s.add_contact('alice', 'bob') is True
+        with s.batch():
+            assert s.add_contact('alice', 'carol') is True
+        # Внутри batch видно всё, что в нём уже сделано
+        assert sorted(s.contacts('alice')) == ['bob', 'carol']
+        try:
+            s.create_user('bob', b'again')
+            raise AssertionError('duplicate user created')
+        except storage.UserExistsError:
+            pass
+    assert sorted(s.contacts('alice')) == ['bob', 'carol']
+    assert s.password_hash('bob') == b'hash-bob'
+
+
+def check_history(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    started = int(time.time() * 1000)
+    first = s.store_message('alice', 'bob', 'hi bob')
+    second = s.store_message('bob', 'alice', 'hi alice')
+    s.store_message('alice', 'carol', 'hi carol')
+    assert second.id > first.id
+    assert (first.sender, first.receiver, first.content) == ('alice', 'bob', 'hi bob')
+    rows = s.history('alice', 'bob')
+    assert [(r.sender, r.receiver, r.content) for r in rows] == [('alice', 'bob', 'hi bob'),
+                                                                 ('bob', 'alice', 'hi alice')]
+    assert rows == [first, second]
+    assert s.history('bob', 'alice') == rows
+    # Время - целые миллисекунды UTC, и в истории то же значение, что вернула запись
+    assert isinstance(rows[0].sent_at, int) and started - 1000 <= rows[0].sent_at <= started + 60000
+    assert rows[0].file_path is None and rows[0].thumbnail_path is None and rows[0].file_meta is None
+    assert s.history('bob', 'carol') == []
+
+
+def check_unknown_user(s):
+    with_users(s, 'alice')
+    for call in (lambda: s.store_message('alice', 'nobody', 'x'), lambda: s.history('alice', 'nobody')):
+        try:
+            call()
+        except KeyError:
+            continue
+        raise AssertionError('unknown user was accepted')
+
+
+def check_files(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    path = s.save_file('photo.jpg', b'\xff\xd8data')
+    with open(path, 'rb') as f:
+        assert f.read() == b'\xff\xd8data'
+    client_path = path.replace('\\', '/')
+    s.store_message('alice', 'bob', '[File: photo.jpg]', file_path=client_path,
+                    thumbnail_path=client_path + '.thumb.jpg', file_meta='{"width": 1}')
+    row = s.history('bob', 'alice')[0]
+    assert (row.file_path, row.thumbnail_path, row.file_meta) == (client_path, client_path + '.thumb.jpg',
+                                                                  '{"width": 1}')
+    assert s.thumbnail_source('bob', client_path + '.thumb.jpg') == client_path
+    assert s.thumbnail_source('carol', client_path + '.thumb.jpg') is None
+    assert s.thumbnail_source('alice', 'files/missing.thumb.jpg') is None
+    assert s.attachment_source('alice', client_path) == client_path
+    assert s.attachment_source('bob', client_path) == client_path
+    assert s.attachment_source('carol', client_path) is None
+    assert s.attachment_source('bob', 'files/missing.jpg') is None
+    assert s.attachment_source('nobody', client_path) is None
+
+
+def check_conversations(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    assert s.conversations('alice', 10) == []
+    s.store_message('bob', 'alice', 'one')
+    s.store_message('bob', 'alice', 'two')
+    last = s.store_message('carol', 'alice', 'x' * 500)
+    inbox = s.conversations('alice', 10)
+    assert [c.contact for c in inbox] == ['carol', 'bob']
+    assert [c.unread_count for c in inbox] == [1, 2]
+    assert inbox[0].last_message_id == last.id and inbox[0].last_sender == 'carol'
+    assert inbox[0].last_activity == last.sent_at
+    assert inbox[0].last_message == 'x' * 100
+    assert inbox[1].last_message == 'two'
+    assert len(s.conversations('alice', 1)) == 1
+    # Своё сообщение непрочитанным не считается и сбрасывает счётчик
+    assert s.conversations('bob', 10)[0].unread_count == 0
+    s.store_message('alice', 'bob', 'reply')
+    bob_row = [c for c in s.conversations('alice', 10) if c.contact == 'bob'][0]
+    assert bob_row.unread_count == 0 and bob_row.last_sender == 'alice'
+    assert s.conversations('alice', 10)[0].contact == 'bob'
+    s.mark_read('alice', 'carol')
+    assert all(c.unread_count == 0 for c in s.conversations('alice', 10))
+    assert s.conversations('bob', 10)[0].unread_count == 1
+
+
+def check_history_pages(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    ids = []
+    for i in range(10):
+        ids.append(s.store_message('alice' if i % 2 else 'bob', 'bob' if i % 2 else 'alice', f'm{i}').id)
+        s.store_message('alice', 'carol', f'other {i}')
+    page = s.history('alice', 'bob', limit=4)
+    assert [r.content for r in page] == ['m6', 'm7', 'm8', 'm9']
+    page = s.history('alice', 'bob', before=page[0].id, limit=4)
+    assert [r.content for r in page] == ['m2', 'm3', 'm4', 'm5']
+    page = s.history('alice', 'bob', before=page[0].id, limit=4)
+    assert [r.content for r in page] == ['m0', 'm1']
+    assert s.history('alice', 'bob', before=ids[0], limit=4) == []
+    assert [r.content for r in s.history('alice', 'bob', before=ids[5])] == ['m0', 'm1', 'm2', 'm3', 'm4']
+
+
+def check_history_stream(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    for i in range(25):
+        s.store_message('alice' if i % 2 else 'bob', 'bob' if i % 2 else 'alice', f'm{i}')
+        s.store_message('alice', 'carol', f'other {i}')
+    chunks = list(s.iter_history('bob', 'alice', batch=10))
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    assert [r for c in chunks for r in c] == s.history('alice', 'bob')
+    assert list(s.iter_history('bob', 'carol', batch=10)) == []
+    assert [len(c) for c in s.iter_history('alice', 'bob', batch=25)] == [25]
+    try:
+        list(s.iter_history('alice', 'nobody'))
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('unknown user was accepted')
+
+
+def check_compaction(s):
+    """Moving old messages to cold storage (where the engine has one) is invisible to readers"""
+    with_users(s, 'alice', 'bob', 'carol')
+    path = s.save_file('old.png', b'png')
+    s.store_message('alice', 'carol', '[File: old.png]', file_path=path, thumbnail_path=path + '.thumb.jpg')
+    for i in range(300):
+        s.store_message('alice' if i % 3 else 'bob', 'bob' if i % 3 else 'alice', f'old {i}')
+    before = s.history('alice', 'bob')
+    inbox = s.conversations('alice', 10)
+    time.sleep(1.1)  # compact() принимает возраст в секундах
+    s.store_message('bob', 'alice', 'new')
+    moved = s.compact(1)
+    assert moved in (0, 301)  # 0 - у движка нет холодного хранилища
+    after = s.history('alice', 'bob')
+    assert after[:-1] == before and after[-1].content == 'new'
+    page = s.history('alice', 'bob', limit=50)
+    assert [r.content for r in page] == [f'old {i}' for i in range(251, 300)] + ['new']
+    page = s.history('alice', 'bob', before=page[0].id, limit=1000)
+    assert page == before[:251]
+    assert s.thumbnail_source('carol', path + '.thumb.jpg') == path
+    assert s.thumbnail_source('bob', path + '.thumb.jpg') is None
+    assert s.attachment_source('carol', path) == path
+    assert s.attachment_source('bob', path) is None
+    assert [c.contact for c in s.conversations('alice', 10)] == ['bob', 'carol']
+    assert s.conversations('alice', 10)[1] == inbox[1]
+    assert [r for c in s.iter_history('bob', 'alice', batch=64) for r in c] == after
+    s.compact(1)  # повторный запуск ничего не дублирует
+    assert s.history('alice', 'bob') == after
+
+
+def check_delivery(s):
+    with_users(s, 'alice', 'bob', 'carol')
+    first = s.store_message('alice', 'bob', 'hi', client_id='a1')
+    again = s.store_message('alice', 'bob', 'hi', client_id='a1')
+    assert again == first
+    assert len(s.history('alice', 'bob')) == 1
+    # client_id различается по отправителю и диалогу
+    other = s.store_message('bob', 'alice', 'hi', client_id='a1')
+    assert other.id != first.id
+    third = s.store_message('alice', 'carol', 'hi', client_id='a1')
+    assert third.id not in (first.id, other.id)
+    second = s.store_message('carol', 'bob', 'yo')
+    last = s.store_message('alice', 'bob', 'again')
+    assert [r.id for r in s.undelivered('bob')] == [first.id, second.id, last.id]
+    assert [r.sender for r in s.undelivered('bob')] == ['alice', 'carol', 'alice']
+    assert s.undelivered('bob')[0] == first
+    assert [r.id for r in s.undelivered('bob', limit=2)] == [first.id, second.id]
+    assert [r.id for r in s.undelivered('bob', after=first.id)] == [second.id, last.id]
+    s.mark_delivered('bob', {'alice': first.id, 'nobody': 1})
+    assert [r.id for r in s.undelivered('bob')] == [second.id, last.id]
+    s.mark_delivered('bob', {'alice': 0, 'carol': 10 ** 9})  # курсор не идёт назад и не дальше диалога
+    assert [r.id for r in s.undelivered('bob')] == [last.id]
+    after_carol = s.store_message('carol', 'bob', 'more')
+    assert [r.id for r in s.undelivered('bob')] == [last.id, after_carol.id]
+    assert [r.id for r in s.undelivered('alice')] == [other.id]
+    assert s.undelivered('carol') == [third]
+
+
+CHECKS = [check_users, check_contacts, check_batch, check_history, check_unknown_user, check_files, check_conversations,
+          check_history_pages, check_history_stream, check_compaction, check_delivery]
+
+
+def run(engine):
+    failures = 0
+    for check in CHECKS:
+        with tempfile.TemporaryDirectory(prefix='chat-storage-') as workdir:
+            s = make_storage(engine, workdir)
+            try:
+                check(s)
+                print(f'{engine:<7} {check.__name__:<22} ok')
+            except Exception:
+                failures += 1
+                print(f'{engine:<7} {check.__name__:<22} FAILED')
+                traceback.print_exc()
+            finally:
+                s.close()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=storage.ENGINES, action='append',
+                        help='engine to check (default: all)')
+    args = parser.parse_args(argv)
+    failures = sum(run(engine) for engine in args.engine or storage.ENGINES)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
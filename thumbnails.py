@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+META_SUFFIX = '.meta.json'
+
+
+def thumbnail_path(file_path):
+    """Thumbnails are cached on disk right next to the original blob"""
+    return file_path + THUMBNAIL_SUFFIX
+
+
+def thumbnail_size(width, height, box=THUMBNAIL_SIZE):
+    """Size Image.thumbnail() will produce, so clients can reserve space early"""
+    scale = min(1.0, box[0] / width, box[1] / height) if width and height else 1.0
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def probe(file_path):
+    """Read image dimensions and MIME type from the header, or None if not an image"""
+    try:
+        with Image.open(file_path) as image:
+            return {
+                'width': image.width,
+                'height': image.height,
+                'mime': Image.MIME.get(image.format, 'application/octet-stream'),
+            }
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+
+class ThumbnailPipeline:
+    """Background worker pool that renders thumbnails and metadata for image attachments"""
+
+    def __init__(self, workers=2, size=THUMBNAIL_SIZE, quality=80):
+        self.size = size
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self.lock = threading.Lock()
+        self.pending = {}  # {file_path: Future}
+
+    def submit(self, file_path, meta):
+        """Queue a thumbnail for file_path; returns the future"""
+        with self.lock:
+            future = self.pending.get(file_path)
+            if future is None:
+                future = self.executor.submit(self._render, file_path, meta)
+                self.pending[file_path] = future
+                future.add_done_callback(lambda f, path=file_path: self._finished(path))
+            return future
+
+    def _finished(self, file_path):
+        with self.lock:
+            self.pending.pop(file_path, None)
+
+    def _render(self, file_path, meta):
+        target = thumbnail_path(file_path)
+        temporary = target + '.tmp'
+        try:
+            with Image.open(file_path) as image:
+                image.draft('RGB', self.size)  # JPEG декодируется сразу в уменьшенном размере
+                image.thumbnail(self.size)
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(temporary, 'JPEG', quality=self.quality, optimize=True)
+            os.replace(temporary, target)
+            meta = dict(meta, thumbnail_width=image.width, thumbnail_height=image.height)
+            with open(file_path + META_SUFFIX, 'w') as f:
+                json.dump(meta, f)
+            logging.info(f"Thumbnail ready for {file_path}")
+            return target
+        except Exception as e:
+            logging.error(f"Error rendering thumbnail for {file_path}: {str(e)}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return None
+
+    def wait(self, file_path, timeout=5):
+        """Return the thumbnail path once it exists, waiting for a running job if needed"""
+        target = thumbnail_path(file_path)
+        with self.lock:
+            future = self.pending.get(file_path)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception:
+                return None
+        return target if os.path.exists(target) else None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,135 @@
+"""TLS helpers for the chat server and clients.
+
+Generate a throwaway certificate for local testing and benchmarks:
+
+    python tls.py generate --out-dir certs
+    python server.py --tls-cert certs/server.crt --tls-key certs/server.key
+"""
+import argparse
+import datetime
+import ipaddress
+import os
+import ssl
+import threading
+
+
+def generate_test_certificate(cert_path, key_path, hostname='localhost', days=30):
+    """Write a self-signed certificate valid for hostname and 127.0.0.1"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName(hostname),
+            x509.IPAddress(ipaddress.ip_address('127.0.0.1')),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    os.chmod(key_path, 0o600)
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return cert_path, key_path
+
+
+def server_context(cert_path, key_path, tickets=2):
+    """Server-side context; TLS 1.3 session tickets let clients resume"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_path, key_path)
+    context.num_tickets = tickets
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class SessionCache:
+    """Remembers the last TLS session per server so reconnects can resume"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get(self, address):
+        with self.lock:
+            return self.sessions.get(address)
+
+    def store(self, address, tls_socket):
+        # В TLS 1.3 тикет приходит после рукопожатия, поэтому вызывать
+        # это стоит после первого полученного ответа
+        session = tls_socket.session
+        if session is not None and session.has_ticket:
+            with self.lock:
+                self.sessions[address] = session
+
+    def discard(self, address):
+        with self.lock:
+            self.sessions.pop(address, None)
+
+
+class ResumingContext:
+    """Stand-in for an SSLContext that resumes `session` on an asyncio connection.
+
+    asyncio has no parameter for the session to resume; its TLS layer only
+    calls wrap_bio() on the context it was given, so that is all this wraps.
+    """
+
+    def __init__(self, context, session):
+        self.context = context
+        self.session = session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None):
+        return self.context.wrap_bio(incoming, outgoing, server_side, server_hostname, session=self.session)
+
+
+def wrap_client_socket(context, sock, host, session_cache=None):
+    """Wrap a connected socket, resuming a cached session when possible"""
+    address = sock.getpeername()[:2]
+    session = session_cache.get(address) if session_cache else None
+    try:
+        return context.wrap_socket(sock, server_hostname=host, session=session)
+    except ssl.SSLError:
+        # Не удалось (например, тикет устарел) - следующая попытка пойдёт без него
+        if session_cache:
+            session_cache.discard(address)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TLS utilities for the chat server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate = subparsers.add_parser('generate', help='create a self-signed test certificate')
+    generate.add_argument('--out-dir', default='certs')
+    generate.add_argument('--hostname', default='localhost')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    cert, key = generate_test_certificate(os.path.join(args.out_dir, 'server.crt'),
+                                          os.path.join(args.out_dir, 'server.key'), args.hostname)
+    print(f'Wrote {cert} and {key}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,541 @@
+"""Record the requests a server receives and replay them against another one.
+
+A recording is a gzip file of JSON lines. The first line is a header. Each
+other line is [microseconds since start, connection id, kind, ...]:
+
+    [t, c, "o", username]   connection seen for the first time (username if
+                            it was already logged in)
+    [t, c, "m", message]    decoded inbound frame
+    [t, c, "c"]             connection closed
+
+By default, message text and file contents are replaced with filler of the
+same length, and passwords with a fixed string. Sizes and timing survive,
+the data does not.
+
+    python server.py --record traffic.jsonl.gz
+    python traffic.py info traffic.jsonl.gz
+    python traffic.py replay traffic.jsonl.gz --speed 10 --output new.json
+    python loadgen.py compare base.json new.json
+"""
+import argparse
+import collections
+import gzip
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import compression
+import loadgen
+from loadgen import Stats, git_revision, percentile, run_parallel, summarize
+from protocol import FrameReader, encode_frame
+
+FORMAT = 'chat-traffic'
+VERSION = 1
+REPLAY_PASSWORD = 'replay'
+# Запросы операторов в запись не попадают
+NOT_RECORDED = {'stats', 'profile', 'record'}
+# Ответ сервера на пинг клиента воспроизводится сам; записанные pong не отправляем
+NOT_REPLAYED = {'pong'}
+
+
+def redact(message):
+    """Same shape and sizes, no user data"""
+    redacted = dict(message)
+    if 'password' in redacted:
+        redacted['password'] = REPLAY_PASSWORD
+    if isinstance(redacted.get('content'), str):
+        redacted['content'] = 'x' * len(redacted['content'])
+    if isinstance(redacted.get('file_data'), str):
+        # 'A' в base64 - нулевые байты, длина та же
+        redacted['file_data'] = 'A' * len(redacted['file_data'])
+    return redacted
+
+
+class TrafficRecorder:
+    """Appends decoded inbound frames of a running server to a recording"""
+
+    def __init__(self, path, redact_data=True, overwrite=True):
+        self.path = path
+        self.redact_data = redact_data
+        self.lock = threading.Lock()
+        # 'x': существующий файл не трогаем, даже если он появился после проверки
+        self.file = gzip.open(path, 'wt' if overwrite else 'xt', encoding='utf-8', compresslevel=6)
+        self.started = time.monotonic()
+        self.connections = {}  # {client_socket: connection id}, только открытые
+        self.opened = 0  # сколько соединений попало в запись; он же последний выданный id
+        self.frames = 0
+        self.flushed = self.started
+        self._write({'format': FORMAT, 'version': VERSION, 'started_at': datetime.now().isoformat(),
+                     'redacted': redact_data})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def _now(self):
+        return int((time.monotonic() - self.started) * 1e6)
+
+    def frame(self, client_socket, message, username=None):
+        if message.get('action') in NOT_RECORDED:
+            return
+        if self.redact_data:
+            message = redact(message)
+        with self.lock:
+            if self.file is None:
+                return
+            connection = self.connections.get(client_socket)
+            if connection is None:
+                # Соединения, открытые до начала записи, появляются с первым кадром
+                self.opened += 1
+                connection = self.connections[client_socket] = self.opened
+                self._write([self._now(), connection, 'o', username])
+            self._write([self._now(), connection, 'm', message])
+            self.frames += 1
+            # Сервер могут убить без закрытия файла: теряем не больше секунды записи
+            if time.monotonic() - self.flushed > 1.0:
+                self.file.flush()
+                self.flushed = time.monotonic()
+
+    def closed(self, client_socket):
+        with self.lock:
+            # Закрытое соединение забываем, иначе долгая запись копит все сокеты подряд
+            connection = self.connections.pop(client_socket, None)
+            if connection is not None and self.file is not None:
+                self._write([self._now(), connection, 'c'])
+
+    def close(self):
+        """Finish the file; returns a summary"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return {'path': os.path.abspath(self.path), 'connections': self.opened,
+                    'frames': self.frames, 'seconds': round(time.monotonic() - self.started, 3)}
+
+
+def without_recording(argv):
+    """Server arguments minus --record, for the process that replaces it.
+
+    --record-raw and --record-dir stay: they also apply to recordings
+    started later with the record action.
+    """
+    cleaned = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--record':
+            skip = True
+        elif not arg.startswith('--record='):
+            cleaned.append(arg)
+    return cleaned
+
+
+def lines(f):
+    """Lines of a recording; one from a killed server just ends early"""
+    try:
+        yield from f
+    except EOFError:
+        return
+
+
+def load(path):
+    """Read a recording; returns (header, {connection id: {'user', 'events', 'closed'}})"""
+    connections = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} traffic recording')
+        for line in lines(f):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # последняя строка оборванной записи
+            moment, connection, kind = record[0] / 1e6, record[1], record[2]
+            if kind == 'o':
+                connections[connection] = {'user': record[3], 'opened': moment, 'events': [], 'closed': None}
+            elif kind == 'm':
+                connections[connection]['events'].append((moment, record[3]))
+            elif kind == 'c':
+                connections[connection]['closed'] = moment
+    return header, connections
+
+
+def duration(connections):
+    """Seconds from the start of the recording to its last event"""
+    ends = [c['closed'] or (c['events'][-1][0] if c['events'] else c['opened']) for c in connections.values()]
+    return max(ends, default=0)
+
+
+def expectation(message):
+    """(name for the stats, response actions that answer it), or None when no reply comes"""
+    action = message.get('action')
+    if action in ('message', 'pong', 'ack'):
+        return None
+    if action == 'ping':
+        return 'ping', {'pong'}
+    if action == 'contacts':
+        sub = message.get('contact_action')
+        if sub == 'history':
+            return 'history', {'history_end', 'history'} if message.get('stream') else {'history'}
+        return f'contacts_{sub}', {'contacts', sub}
+    return action, {action}
+
+
+def requests_in(message):
+    """The message itself, or the requests a batch carries"""
+    if message.get('action') == 'batch':
+        return [r for r in message.get('requests') or () if isinstance(r, dict)]
+    return [message]
+
+
+def delivery_key(sender, message):
+    """What the receiver will see of a message or file, to time its delivery"""
+    if message.get('action') == 'file':
+        return sender, message.get('receiver'), f"[File: {message.get('file_name')}]"
+    return sender, message.get('receiver'), message.get('content')
+
+
+def accounts(connections):
+    """Users the recording needs before it starts: {username: password}.
+
+    Users registered inside the recording register themselves during the
+    replay. Everyone else who logs in, is logged in already or is written
+    to gets an account up front.
+    """
+    registered = set()
+    needed = {}
+    for connection in connections.values():
+        if connection['user']:
+            needed.setdefault(connection['user'], REPLAY_PASSWORD)
+        for _, frame in connection['events']:
+            for message in requests_in(frame):
+                action = message.get('action')
+                if action == 'register':
+                    registered.add(message.get('username'))
+                elif action == 'login':
+                    needed[message.get('username')] = message.get('password')
+                for field in ('receiver', 'contact_username'):
+                    if message.get(field):
+                        needed.setdefault(message[field], REPLAY_PASSWORD)
+    return {user: password for user, password in needed.items() if user and user not in registered}
+
+
+class ReplayConnection:
+    """One recorded connection played against the target server"""
+
+    def __init__(self, host, port, stats, deliveries, timeout, dictionary=None):
+        self.stats = stats
+        self.deliveries = deliveries  # {(sender, receiver, content): deque of send times}, общий
+        self.timeout = timeout
+        self.dictionary = dictionary
+        self.codec = None
+        self.username = None  # с кем вошли (или входим) на этом соединении
+        self.lock = threading.Lock()
+        self.pending = []  # [(name, expected actions, sent at)]
+        self.answered = threading.Condition(self.lock)
+        self.closed = False
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.reader = threading.Thread(target=self._receive, daemon=True)
+        self.reader.start()
+
+    def _receive(self):
+        reader = FrameReader(self.dictionary)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                reader.feed(data)
+                for message in reader.frames():
+                    self._dispatch(message)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.closed = True
+            self.answered.notify_all()
+
+    def _dispatch(self, message):
+        action = message.get('action')
+        now = time.perf_counter()
+        if action == 'ping':
+            try:
+                self.send({'action': 'pong'})
+            except OSError:
+                pass
+            return
+        if action == 'message' and 'sender' in message:
+            key = (message.get('sender'), self.username, message.get('content'))
+            with self.lock:
+                sent = self.deliveries.get(key)
+                started = sent.popleft() if sent else None
+            if started is not None:
+                kind = 'file_delivery' if message.get('is_file') else 'message_delivery'
+                self.stats.record(kind, (now - started) * 1000)
+            return
+        if action == 'hello' and message.get('compression'):
+            use_dictionary = message.get('dictionary_id') is not None
+            self.codec = compression.FrameCodec(message['compression'], message['threshold'],
+                                                dictionary=self.dictionary if use_dictionary else None)
+        with self.lock:
+            for index, (name, expected, started) in enumerate(self.pending):
+                if action in expected:
+                    del self.pending[index]
+                    break
+            else:
+                return
+            self.answered.notify_all()
+        if name is None:
+            return
+        if message.get('status') == 'error':
+            self.stats.error(name, message.get('message', 'error'))
+        else:
+            self.stats.record(name, (now - started) * 1000)
+
+    def send(self, message):
+        self.sock.sendall(encode_frame(message, self.codec))
+
+    def request(self, message, timed=True):
+        """Send a recorded frame; remembers what answers it"""
+        expected = expectation(message)
+        for sub in requests_in(message):
+            if sub.get('action') == 'login':
+                # Кадры после login уходят, не дожидаясь ответа, как и в записи
+                self.username = sub.get('username')
+        started = time.perf_counter()
+        with self.lock:
+            if expected:
+                self.pending.append((expected[0] if timed else None, expected[1], started))
+            for sub in requests_in(message):
+                if sub.get('action') in ('message', 'file') and self.username:
+                    self.deliveries.setdefault(delivery_key(self.username, sub),
+                                               collections.deque()).append(started)
+        try:
+            self.send(message)
+        except OSError as e:
+            self.stats.error(expected[0] if expected else message.get('action'), type(e).__name__)
+
+    def wait_idle(self):
+        """Wait until every request sent so far has its answer; False on timeout or disconnect"""
+        deadline = time.monotonic() + self.timeout
+        with self.lock:
+            while self.pending and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.answered.wait(remaining)
+            return not self.pending
+
+    def finish(self):
+        """Close and count requests that never got an answer"""
+        with self.lock:
+            for name, _, _ in self.pending:
+                if name is not None:
+                    self.stats.error(name, 'no response')
+            self.pending = []
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Replayer:
+    """Plays recorded connections against one server; speed None means as fast as answers come back"""
+
+    def __init__(self, target, speed, passwords, timeout, dictionary=None):
+        self.target = target
+        self.speed = speed
+        self.passwords = passwords
+        self.timeout = timeout
+        self.dictionary = dictionary
+        self.stats = Stats()
+        self.deliveries = {}
+        self.lateness = []  # мс отставания от расписания записи
+        self.started = time.monotonic()
+
+    def wait_until(self, moment):
+        if self.speed is None:
+            return
+        delay = self.started + moment / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.lateness.append(-delay * 1000)
+
+    def play(self, connection):
+        self.wait_until(connection['opened'])
+        try:
+            client = ReplayConnection(*self.target, self.stats, self.deliveries, self.timeout, self.dictionary)
+        except OSError as e:
+            self.stats.error('connect', type(e).__name__)
+            return
+        try:
+            user = connection['user']
+            if user:
+                # Сессия была открыта до начала записи: входим без замера
+                client.request({'action': 'login', 'username': user,
+                                'password': self.passwords.get(user, REPLAY_PASSWORD)}, timed=False)
+                client.wait_idle()
+            for moment, message in connection['events']:
+                if message.get('action') in NOT_REPLAYED:
+                    continue
+                if self.speed is None:
+                    client.wait_idle()
+                self.wait_until(moment)
+                client.request(message)
+            if connection['closed'] is not None:
+                self.wait_until(connection['closed'])
+            client.wait_idle()
+        finally:
+            client.finish()
+
+
+def create_accounts(target, passwords, timeout, workers=32):
+    """Register users the recording expects to exist, before the timed part"""
+    setup = Stats()
+
+    def register(item):
+        username, password = item
+        try:
+            client = ReplayConnection(*target, setup, {}, timeout)
+        except OSError:
+            return
+        client.request({'action': 'register', 'username': username, 'password': password})
+        client.wait_idle()
+        client.finish()
+
+    run_parallel(list(passwords.items()), register, workers)
+    return summarize(*setup.snapshot(), 1)
+
+
+def run(args):
+    header, connections = load(args.recording)
+    speed = None if args.speed == 'max' else float(args.speed)
+    server_process = None
+    host, port = args.host, args.port
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix='chat-replay-')
+        port = port or loadgen.free_port()
+        server_process = subprocess.Popen(
+            [sys.executable, loadgen.SERVER_SCRIPT, '--host', host, '--port', str(port)] + list(args.server_arg),
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not loadgen.wait_for_port(host, port, 30):
+            server_process.kill()
+            raise SystemExit('server did not start listening')
+        loadgen.log(f'spawned server pid={server_process.pid} port={port} in {workdir}')
+    dictionary = compression.load_dictionary(args.compression_dict) if args.compression_dict else None
+    try:
+        passwords = accounts(connections)
+        setup = create_accounts((host, port), passwords, args.timeout)
+        loadgen.log(f'created {len(passwords)} accounts; replaying {len(connections)} connections '
+                    f'at speed {args.speed}')
+        replayer = Replayer((host, port), speed, passwords, args.timeout, dictionary)
+        threads = [threading.Thread(target=replayer.play, args=(c,), daemon=True) for c in connections.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - replayer.started
+    finally:
+        if server_process:
+            server_process.terminate()
+            try:
+                server_process.wait(10)
+            except subprocess.TimeoutExpired:
+                server_process.kill()
+
+    actions = summarize(*replayer.stats.snapshot(), elapsed)
+    total_ops = sum(v['count'] for k, v in actions.items() if not k.endswith('_delivery'))
+    lateness = sorted(replayer.lateness)
+    return {
+        'meta': {
+            'tool': 'replay',
+            'started_at': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'parameters': vars(args),
+            'recording': {'path': os.path.abspath(args.recording), 'header': header,
+                          'connections': len(connections), 'seconds': duration(connections)},
+        },
+        'setup': {'accounts': len(passwords), 'actions': setup},
+        'steady': {
+            'duration_s': elapsed,
+            'total_ops': total_ops,
+            'throughput_ops_s': total_ops / elapsed if elapsed else None,
+            'actions': actions,
+        },
+        # Насколько отправка отставала от расписания записи: большое отставание значит,
+        # что упёрлись в сам replay или сервер не успевал
+        'schedule': {'late_frames': len(lateness), 'late_p50_ms': percentile(lateness, 0.5),
+                     'late_p99_ms': percentile(lateness, 0.99)},
+        'server': {'pid': server_process.pid if server_process else None},
+    }
+
+
+def info(args):
+    header, connections = load(args.recording)
+    counts = collections.Counter()
+    for connection in connections.values():
+        for _, message in connection['events']:
+            name = expectation(message)
+            counts[name[0] if name else message.get('action')] += 1
+    json.dump({'header': header, 'connections': len(connections), 'seconds': duration(connections),
+               'frames': sum(counts.values()), 'actions': dict(counts.most_common()),
+               'accounts_needed': len(accounts(connections))}, sys.stdout, indent=2)
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded chat traffic')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = subparsers.add_parser('replay', help='drive a server with a recording and print JSON results')
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('--speed', default='1',
+                               help='time scale: 1 as recorded, 10 ten times faster, max without pauses')
+    replay_parser.add_argument('--host', default='127.0.0.1')
+    replay_parser.add_argument('--port', type=int, default=0, help='server port (default: random when spawning)')
+    replay_parser.add_argument('--no-spawn', dest='spawn', action='store_false',
+                               help='use an already running (empty) server instead of spawning one')
+    replay_parser.add_argument('--server-arg', action='append', default=[],
+                               help='extra argument passed to the spawned server.py (repeatable)')
+    replay_parser.add_argument('--compression-dict', help='shared dictionary, if the recording negotiated one')
+    replay_parser.add_argument('--timeout', type=float, default=30.0)
+    replay_parser.add_argument('--output', help='write JSON here instead of stdout')
+
+    info_parser = subparsers.add_parser('info', help='summarize a recording')
+    info_parser.add_argument('recording')
+
+    args = parser.parse_args(argv)
+    if args.command == 'info':
+        info(args)
+        return
+    if args.speed != 'max':
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error('--speed must be a positive number or max')
+    result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        loadgen.log(f'results written to {args.output}')
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Checks of modules that work without a server: frame parsing and client caches.
+
+    python unit_checks.py [--check NAME]
+
+Each check that touches the disk gets its own temporary directory.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+from attachment_cache import AttachmentCache
+from protocol import FrameLimits, FrameReader, encode_frame
+
+
+class CountingReader(FrameReader):
+    """FrameReader that counts how often its buffer is reallocated"""
+
+    def __init__(self, *args, **kwargs):
+        self.resizes = 0
+        super().__init__(*args, **kwargs)
+
+    def _resize(self, size):
+        if size != len(self.buffer):
+            self.resizes += 1
+        super()._resize(size)
+
+
+def decode_all(reader, data, chunk):
+    """Feed data in chunks; returns decoded frames, with the type name of each error in their place"""
+    decoded = []
+    for offset in range(0, len(data), chunk):
+        reader.feed(data[offset:offset + chunk])
+        while True:
+            try:
+                decoded.extend(reader.frames())
+                break
+            except ValueError as e:
+                decoded.append(type(e).__name__)
+    return decoded
+
+
+def check_cache_keeps_foreign_files():
+    with tempfile.TemporaryDirectory(prefix='chat-unit-') as workdir:
+        cache = AttachmentCache(workdir, 1024 * 1024)
+        kept = cache.put('files/a.txt', b'hello')
+        orphan = os.path.join(workdir, 'f' * 64 + '.bin')
+        for path in (orphan, orphan + '.tmp', os.path.join(workdir, 'notes.txt')):
+            with open(path, 'wb') as f:
+                f.write(b'x')
+        os.mkdir(os.path.join(workdir, 'photos'))
+        os.mkdir(os.path.join(workdir, 'e' * 64))
+
+        cache = AttachmentCache(workdir, 1024 * 1024)
+        assert cache.get('files/a.txt') == kept
+        # Свои недописанные блобы убраны, чужой файл и каталоги на месте
+        assert not os.path.exists(orphan) and not os.path.exists(orphan + '.tmp')
+        assert os.path.isfile(os.path.join(workdir, 'notes.txt'))
+        assert os.path.isdir(os.path.join(workdir, 'photos'))
+        assert os.path.isdir(os.path.join(workdir, 'e' * 64))
+
+
+def check_large_bare_frame():
+    message = {'action': 'file', 'file_name': 'a "quoted" {name}.bin', 'file_data': 'QUJD' * 250000}
+    data = json.dumps(message).encode()
+    reader = CountingReader(limits=FrameLimits(2 * 1024 * 1024))
+    assert decode_all(reader, data, 4096) == [message]
+    # Рост вдвое: около log2(1 MiB / 4 KiB) перевыделений, а не одно на каждое чтение
+    assert reader.resizes <= 12, reader.resizes
+    assert reader.frame_size == len(data)
+
+
+def check_bad_utf8_bare_frame():
+    data = (b'{"action": "message", "content": "\xff\xfe caf\xe9"}'
+            + '{"action": "message", "content": "дальше"}'.encode()
+            + encode_frame({'action': 'ping'}))
+    for chunk in (len(data), 7, 1):
+        decoded = decode_all(FrameReader(limits=FrameLimits()), data, chunk)
+        assert decoded == ['UnicodeDecodeError', {'action': 'message', 'content': 'дальше'},
+                           {'action': 'ping'}], (chunk, decoded)
+
+
+CHECKS = [check_cache_keeps_foreign_files, check_large_bare_frame, check_bad_utf8_bare_frame]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='append', help='run only this check (repeatable)')
+    args = parser.parse_args(argv)
+    failures = 0
+    for check in CHECKS:
+        if args.check and check.__name__ not in args.check:
+            continue
+        try:
+            check()
+            print(f'{check.__name__:<40} ok')
+        except Exception:
+            failures += 1
+            print(f'{check.__name__:<40} FAILED')
+            traceback.print_exc()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()